@@ -0,0 +1,582 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Micro-benchmarks for the HekaClient hot path.
+
+Each benchmark is registered with the `benchmark` decorator on a setup
+function. The setup function returns a `(fn, cleanup)` 2-tuple, where
+`fn` is the zero argument callable being measured and `cleanup` is
+either None or a callable that releases anything the setup acquired.
+
+For every benchmark three numbers are recorded:
+
+ns
+  Wall clock nanoseconds per call (best of several repeats).
+gc_objects
+  Garbage collector tracked objects left behind per call, i.e. the
+  cyclic garbage that the collector will eventually have to clean up.
+pb_objects
+  Protobuf objects (`Message`, `Field` and `Header`) constructed per
+  call, in any thread. These are the bulk of what the Message path
+  allocates, and are freed again without leaving any garbage, so
+  `gc_objects` doesn't see them. None if the protobuf implementation
+  in use doesn't let their constructors be wrapped (the C++ one).
+
+Results are plain dictionaries that can be dumped as JSON and later
+compared against a stored baseline with `compare`.
+
+"""
+from __future__ import absolute_import
+import gc
+import logging
+import os
+import platform
+import socket
+import struct
+import sys
+import threading
+import timeit
+
+from heka.client import HekaClient
+from heka.encoders import JsonEncoder, ProtobufEncoder
+from heka.message import Field, Header, Message
+
+_BENCHMARKS = []
+
+FLAT_FIELDS = {'userid': 25, 'req_time': 4.5, 'path': '/some/path',
+               'cached': True}
+NESTED_FIELDS = {'userid': 25, 'req_time': 4.5,
+                 'request': {'path': '/some/path', 'method': 'GET',
+                             'headers': {'accept': 'text/html',
+                                         'agent': 'bench'}}}
+HMAC_CONFIG = {'signer': 'bench', 'key_version': 1, 'hash_function': 'SHA1',
+               'key': 'some_key'}
+PB_CLASSES = (Message, Field, Header)
+
+
+def benchmark(name):
+    """Register the decorated setup function as benchmark `name`."""
+    def register(setup):
+        _BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def benchmark_names():
+    return [name for name, setup in _BENCHMARKS]
+
+
+class NullStream(object):
+    """Stream that throws everything away."""
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class NullSink(object):
+    """Local UDP and TCP listeners that read and discard everything sent
+    to them, so that the network streams can be measured without a heka
+    router.
+
+    """
+    def __init__(self):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.udp_port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(('127.0.0.1', 0))
+        self.tcp.listen(5)
+        self.tcp_port = self.tcp.getsockname()[1]
+        self._running = True
+        for target in (self._drain_udp, self._accept_tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _drain_udp(self):
+        while self._running:
+            try:
+                self.udp.recv(65536)
+            except socket.error:
+                return
+
+    def _accept_tcp(self):
+        while self._running:
+            try:
+                conn, addr = self.tcp.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._drain_tcp, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _drain_tcp(self, conn):
+        while self._running:
+            try:
+                if not conn.recv(65536):
+                    break
+            except socket.error:
+                break
+        conn.close()
+
+    def close(self):
+        self._running = False
+        for sock in (self.udp, self.tcp):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+
+def _client(**kwargs):
+    return HekaClient(NullStream(), 'bench', **kwargs)
+
+
+def _sample_msg(fields=FLAT_FIELDS):
+    client = _client()
+    return client._build_message('bench', 'bench', 6, 'some payload',
+                                 fields, None)
+
+
+@benchmark('client.heka')
+def _heka():
+    client = _client()
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.heka.traced')
+def _heka_traced():
+    from heka.tracing import Tracer
+    client = _client(tracer=Tracer(rate=1.0))
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.heka.json')
+def _heka_json():
+    client = _client(encoder=JsonEncoder)
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.heka.message')
+def _heka_message():
+    # a filter makes the client build a Message
+    client = _client(filters=[lambda msg: True])
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.heka.message.reused')
+def _heka_message_reused():
+    client = _client(filters=[lambda msg: True], reuse_messages=True)
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.heka.background')
+def _heka_background():
+    # what the calling thread pays, the sender thread does the rest
+    from heka.sender import BackgroundSender
+    sender = BackgroundSender(max_queue_size=1000000)
+    client = _client(sender=sender)
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), sender.close
+
+
+@benchmark('client.heka.routed')
+def _heka_routed():
+    from heka.streams import Route, RoutingStream
+    stream = RoutingStream(NullStream(), [
+        Route(NullStream(), types='timer counter'),
+        Route(NullStream(), max_severity='critical', tee=True)])
+    client = HekaClient(stream, 'bench')
+    return (lambda: client.heka('bench', payload='some payload',
+                                fields=FLAT_FIELDS)), None
+
+
+@benchmark('client.define')
+def _define():
+    client = _client()
+    emit = client.define('bench', [(name, type(value))
+                                   for name, value in FLAT_FIELDS.items()])
+    values = FLAT_FIELDS.values()
+    return (lambda: emit(payload='some payload', *values)), None
+
+
+@benchmark('client.heka_many.100')
+def _heka_many():
+    client = _client()
+    events = [('bench', None, None, 'some payload', FLAT_FIELDS)] * 100
+    return (lambda: client.heka_many(events)), None
+
+
+@benchmark('client.incr_many.100')
+def _incr_many():
+    client = _client()
+    names = ['bench%d' % i for i in range(100)]
+    return (lambda: client.incr_many(names)), None
+
+
+@benchmark('client.incr')
+def _incr():
+    client = _client()
+    return (lambda: client.incr('bench')), None
+
+
+@benchmark('client.timer')
+def _timer():
+    client = _client()
+
+    def fn():
+        with client.timer('bench'):
+            pass
+    return fn, None
+
+
+@benchmark('client.timer.disabled')
+def _timer_disabled():
+    client = _client(disabled_timers=['bench'])
+
+    def fn():
+        with client.timer('bench'):
+            pass
+    return fn, None
+
+
+@benchmark('client.timer.sampled')
+def _timer_sampled():
+    client = _client()
+
+    def fn():
+        with client.timer('bench', rate=0.01):
+            pass
+    return fn, None
+
+
+@benchmark('client._flatten_fields.flat')
+def _flatten_flat():
+    client = _client()
+    return (lambda: client._flatten_fields(Message(), FLAT_FIELDS)), None
+
+
+@benchmark('client._flatten_fields.nested')
+def _flatten_nested():
+    client = _client()
+    return (lambda: client._flatten_fields(Message(), NESTED_FIELDS)), None
+
+
+@benchmark('ProtobufEncoder.encode')
+def _encode():
+    encoder = ProtobufEncoder()
+    msg = _sample_msg()
+    return (lambda: encoder.encode(msg)), None
+
+
+@benchmark('ProtobufEncoder.encode.hmac')
+def _encode_hmac():
+    encoder = ProtobufEncoder(HMAC_CONFIG)
+    msg = _sample_msg()
+    return (lambda: encoder.encode(msg)), None
+
+
+@benchmark('ProtobufEncoder.encode_args')
+def _encode_args():
+    encoder = ProtobufEncoder()
+    client = _client()
+    return (lambda: encoder.encode_args(client, 'bench', 'bench', 6,
+                                        'some payload', FLAT_FIELDS,
+                                        None)), None
+
+
+@benchmark('ProtobufEncoder.encode_args.nested')
+def _encode_args_nested():
+    encoder = ProtobufEncoder()
+    client = _client()
+    return (lambda: encoder.encode_args(client, 'bench', 'bench', 6,
+                                        'some payload', NESTED_FIELDS,
+                                        None)), None
+
+
+@benchmark('ProtobufEncoder.encode_args.array')
+def _encode_args_array():
+    import array
+    encoder = ProtobufEncoder()
+    client = _client()
+    fields = {'latencies': array.array('d', [i / 10.0 for i in range(1000)])}
+    return (lambda: encoder.encode_args(client, 'bench', 'bench', 6,
+                                        'some payload', fields, None)), None
+
+
+@benchmark('JsonEncoder.encode')
+def _json_encode():
+    encoder = JsonEncoder()
+    msg = _sample_msg()
+    return (lambda: encoder.encode(msg)), None
+
+
+@benchmark('JsonEncoder.encode_args')
+def _json_encode_args():
+    encoder = JsonEncoder()
+    client = _client()
+    return (lambda: encoder.encode_args(client, 'bench', 'bench', 6,
+                                        'some payload', FLAT_FIELDS,
+                                        None)), None
+
+
+@benchmark('JsonEncoder.encode_args.hmac')
+def _json_encode_args_hmac():
+    encoder = JsonEncoder(HMAC_CONFIG)
+    client = _client()
+    return (lambda: encoder.encode_args(client, 'bench', 'bench', 6,
+                                        'some payload', FLAT_FIELDS,
+                                        None)), None
+
+
+@benchmark('filters.severity_max')
+def _severity_max():
+    from heka.filters import severity_max_provider
+    filter_fn = severity_max_provider(severity=4)
+    msg = _sample_msg()
+    return (lambda: filter_fn(msg)), None
+
+
+@benchmark('filters.type_blacklist')
+def _type_blacklist():
+    from heka.filters import type_blacklist_provider
+    filter_fn = type_blacklist_provider(types=['timer', 'oldstyle'])
+    msg = _sample_msg()
+    return (lambda: filter_fn(msg)), None
+
+
+@benchmark('filters.type_whitelist')
+def _type_whitelist():
+    from heka.filters import type_whitelist_provider
+    filter_fn = type_whitelist_provider(types=['timer', 'bench'])
+    msg = _sample_msg()
+    return (lambda: filter_fn(msg)), None
+
+
+@benchmark('filters.type_severity_max')
+def _type_severity_max():
+    from heka.filters import type_severity_max_provider
+    filter_fn = type_severity_max_provider(
+        types={'bench': {'severity': 4}, 'timer': {'severity': 6}})
+    msg = _sample_msg()
+    return (lambda: filter_fn(msg)), None
+
+
+def _encoded():
+    return ProtobufEncoder().encode(_sample_msg())
+
+
+@benchmark('streams.UdpStream')
+def _udp_stream():
+    from heka.streams import UdpStream
+    sink = NullSink()
+    stream = UdpStream('127.0.0.1', sink.udp_port)
+    data = _encoded()
+
+    def cleanup():
+        stream.socket.close()
+        sink.close()
+    return (lambda: stream.write(data)), cleanup
+
+
+@benchmark('streams.TcpStream')
+def _tcp_stream():
+    from heka.streams import TcpStream
+    sink = NullSink()
+    stream = TcpStream('127.0.0.1', sink.tcp_port)
+    data = _encoded()
+
+    def cleanup():
+        for sock in stream.sockets:
+            sock.close()
+        sink.close()
+    return (lambda: stream.write(data)), cleanup
+
+
+@benchmark('streams.FileStream')
+def _file_stream():
+    from heka.streams import FileStream
+    stream = FileStream(os.devnull)
+    data = _encoded()
+
+    def fn():
+        stream.write(data)
+        stream.flush()
+    return fn, stream.filestream.close
+
+
+@benchmark('streams.StdOutStream')
+def _stdout_stream():
+    from heka.streams import StdOutStream
+    stream = StdOutStream()
+    data = _encoded()
+    old_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    def fn():
+        stream.write(data)
+        stream.flush()
+
+    def cleanup():
+        sys.stdout.close()
+        sys.stdout = old_stdout
+    return fn, cleanup
+
+
+@benchmark('streams.StdLibLoggingStream')
+def _stdlib_stream():
+    from heka.streams import StdLibLoggingStream
+    stream = StdLibLoggingStream('heka.bench')
+    stream.logger.propagate = False
+    stream.logger.addHandler(logging.NullHandler())
+    # same layout as the StdlibPayloadEncoder output
+    data = struct.pack('B10s', logging.INFO, 'bench') + 'some payload'
+    return (lambda: stream.write(data)), None
+
+
+@benchmark('streams.DebugCaptureStream')
+def _debug_stream():
+    from heka.streams import DebugCaptureStream
+    stream = DebugCaptureStream()
+    data = _encoded()
+    return (lambda: stream.write(data)), None
+
+
+def count_constructions(fn, iterations=10000):
+    """Return the number of `PB_CLASSES` objects constructed per call
+    of `fn`, or None if their constructors can't be wrapped.
+
+    """
+    count = [0]
+
+    def counting(init):
+        def __init__(self, *args, **kwargs):
+            count[0] += 1
+            init(self, *args, **kwargs)
+        return __init__
+
+    originals = [(cls, cls.__dict__.get('__init__')) for cls in PB_CLASSES]
+    wrapped = []
+    try:
+        for cls, init in originals:
+            if init is None:
+                return None
+            try:
+                cls.__init__ = counting(init)
+            except (TypeError, AttributeError):
+                return None
+            wrapped.append((cls, init))
+        for j in xrange(iterations):
+            fn()
+    finally:
+        for cls, init in wrapped:
+            cls.__init__ = init
+    return float(count[0]) / iterations
+
+
+def measure(fn, iterations=10000, repeat=3):
+    """Return a `{'ns': ..., 'gc_objects': ..., 'pb_objects': ...}` dict
+    for `fn`.
+
+    """
+    timer = timeit.default_timer
+    best = None
+    gc_enabled = gc.isenabled()
+    try:
+        for i in xrange(repeat):
+            gc.collect()
+            gc.disable()
+            start = timer()
+            for j in xrange(iterations):
+                fn()
+            elapsed = timer() - start
+            gc.enable()
+            if best is None or elapsed < best:
+                best = elapsed
+
+        # count the garbage left behind separately, timings are taken
+        # without paying for the bookkeeping
+        gc.collect()
+        gc.disable()
+        before = gc.get_count()[0]
+        for j in xrange(iterations):
+            fn()
+        left = gc.get_count()[0] - before
+    finally:
+        if gc_enabled:
+            gc.enable()
+        gc.collect()
+    return {'ns': best * 1e9 / iterations,
+            'gc_objects': float(left) / iterations,
+            'pb_objects': count_constructions(fn, iterations)}
+
+
+def run(names=None, iterations=10000, repeat=3):
+    """Run the named benchmarks (default all of them) and return the
+    results dictionary.
+
+    """
+    results = {}
+    for name, setup in _BENCHMARKS:
+        if names and name not in names:
+            continue
+        fn, cleanup = setup()
+        try:
+            # warm up any caches before measuring
+            for i in xrange(min(iterations, 100)):
+                fn()
+            results[name] = measure(fn, iterations, repeat)
+        finally:
+            if cleanup is not None:
+                cleanup()
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'iterations': iterations,
+            'results': results}
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Compare two results dictionaries, returning a list of
+    `(name, metric, baseline_value, current_value)` tuples for every
+    measurement that got worse by more than `tolerance` (a fraction).
+
+    """
+    regressions = []
+    base_results = baseline['results']
+    for name, values in sorted(current['results'].items()):
+        if name not in base_results:
+            continue
+        base_values = base_results[name]
+        if values['ns'] > base_values['ns'] * (1 + tolerance):
+            regressions.append((name, 'ns', base_values['ns'],
+                                values['ns']))
+        for metric in ('gc_objects', 'pb_objects'):
+            # missing from older baselines, or not measurable
+            if (values.get(metric) is None
+                    or base_values.get(metric) is None):
+                continue
+            # allow half an object of slack so that tiny baselines don't
+            # flag rounding noise
+            limit = base_values[metric] * (1 + tolerance) + 0.5
+            if values[metric] > limit:
+                regressions.append((name, metric, base_values[metric],
+                                    values[metric]))
+    return regressions
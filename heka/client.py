@@ -23,10 +23,19 @@ import threading
 import time
 import traceback
 import types
-import uuid
 import datetime
 
+from heka.limits import MAX_PAYLOAD_SIZE, oversized
+from heka.message import MAX_DATAGRAM_SIZE
+from heka.fields import ARRAY, VALUE_ATTRS
+from heka.fields import BYTES_TYPES
+from heka.fields import array_values, as_bytes, flatten_plan, value_type_of
+from heka.fields import copy_fields
 from heka.message_pb2 import Message, Field
+from heka.pipeline import Pipeline, RETIRE_GRACE, retire_replaced
+from heka.sender import Event
+from heka.stats import ClientStats, ErrorReporter
+from heka.util import uuid5_bytes
 
 class SEVERITY:
     """Put a namespace around RFC 3164 syslog messages"""
@@ -40,6 +49,16 @@ class SEVERITY:
     DEBUG = 7
 
 
+# Messages kept for reuse per thread. A thread only needs more than one
+# when `heka` is called again from within a filter or a stream.
+MESSAGE_POOL_SIZE = 4
+
+# `setup` arguments making up the client's `heka.pipeline.Pipeline`
+_PIPELINE_ARGS = ('stream', 'encoder', 'hmc', 'disabled_timers', 'filters',
+                  'sampler', 'tracer', 'size_policy', 'max_payload_size',
+                  'reuse_messages', 'sender')
+
+
 class _NoOpTimer(object):
     """A bogus timer object that will act as a contextdecorator but
     which doesn't actually do anything.
@@ -106,6 +125,130 @@ class _Timer(object):
         return False
 
 
+def _as_string(value):
+    if not isinstance(value, basestring):
+        raise TypeError("Expected a string field value: [%r]" % (value,))
+    return value
+
+
+def _as_binary(value):
+    # a str is taken as binary data where bytes are expected
+    if not isinstance(value, BYTES_TYPES + (str,)):
+        raise TypeError("Expected a binary field value: [%r]" % (value,))
+    return value
+
+
+def _as_integer(value):
+    # as protobuf checks the value_integer of a Message
+    value = int(value)
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError("Integer field value out of range: [%r]" %
+                         (value,))
+    return value
+
+
+_FIELD_CONVERTERS = {Field.STRING: _as_string,
+                     Field.BYTES: _as_binary,
+                     Field.INTEGER: _as_integer,
+                     Field.DOUBLE: float,
+                     }
+
+
+def _event_args(type, logger=None, severity=None, payload='', fields=None,
+                timestamp=None):
+    # `heka` arguments of a `heka_many` event
+    return type, logger, severity, payload, fields, timestamp
+
+
+class _Emitter(object):
+    """Sends messages of a fixed shape, see `HekaClient.define`."""
+    def __init__(self, client, type, specs, logger=None, severity=None):
+        self.client = client
+        self.type = type
+        self.logger = logger
+        self.severity = severity
+        self.names = tuple(name for name, python_type in specs)
+        self.specs = tuple((name, value_type_of(python_type))
+                           for name, python_type in specs)
+        self._converters = tuple(_FIELD_CONVERTERS[value_type]
+                                 for name, value_type in self.specs)
+        # (encoder, logger, serializer) of the last compilation
+        self._compiled = (None, None, None)
+
+    def _serializer(self, encoder, logger):
+        compiled_encoder, compiled_logger, serialize = self._compiled
+        if compiled_encoder is not encoder or compiled_logger != logger:
+            serialize = encoder.compile_args(self.type, logger, self.specs)
+            self._compiled = (encoder, logger, serialize)
+        return serialize
+
+    def __call__(self, *values, **kwargs):
+        """Send a message with the field `values`, in the order the
+        fields were defined in. `payload`, `severity` and `timestamp` are
+        accepted as keyword arguments, as for `HekaClient.heka`.
+
+        """
+        payload = kwargs.pop('payload', '')
+        severity = kwargs.pop('severity', None)
+        timestamp = kwargs.pop('timestamp', None)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ', '.join(sorted(kwargs)))
+        if len(values) != len(self.names):
+            raise TypeError("%s takes %d field values (%d given)" %
+                            (self.type, len(self.names), len(values)))
+        values = [convert(value)
+                  for convert, value in zip(self._converters, values)]
+
+        client = self.client
+        pipeline = client._pipeline
+        logger = self.logger if self.logger is not None else client.logger
+        if severity is None:
+            severity = (self.severity if self.severity is not None
+                        else client.severity)
+        encoder = pipeline.encoder
+        compile_args = getattr(encoder, 'compile_args', None)
+        if (compile_args is None or pipeline.filters
+                or pipeline.sender is not None
+                or pipeline.router is not None
+                or getattr(client._local, 'buffer', None) is not None
+                or isinstance(timestamp, datetime.datetime)
+                or (pipeline.size_policy is not None
+                    and oversized(payload, pipeline.max_payload_size))):
+            # anything needing a Message, or just not common enough to
+            # bother, goes the usual way
+            client.heka(self.type, logger, severity, payload,
+                        dict(zip(self.names, values)), timestamp)
+            return
+
+        tracer = pipeline.tracer
+        span = tracer.start() if tracer is not None else None
+        client.stats.emitted += 1
+        start = time.time()
+        data = self._serializer(encoder, logger)(
+            client, severity, payload, values, timestamp)
+        if span is not None:
+            span.mark('encode_args')
+        data = encoder.frame(data, span)
+        if span is not None:
+            span.mark('frame')
+        client._write(pipeline, data, start, span)
+
+
+def _pipeline_attribute(name):
+    # a client attribute living in its pipeline; setting it swaps in a
+    # changed copy of the pipeline. Nothing is closed, the replaced
+    # value may still be in use, e.g. by a stream wrapping it; only
+    # `reconfigure` retires what it replaces
+    def get(self):
+        return getattr(self._pipeline, name)
+
+    def set(self, value):
+        self._replace_pipeline(self._pipeline.replace(**{name: value}),
+                               None)
+    return property(get, set)
+
+
 class HekaClient(object):
     """Client class encapsulating heka API, and providing storage for
     default values for various heka call settings.
@@ -114,10 +257,23 @@ class HekaClient(object):
     # envelope version, only changes when the message format changes
     env_version = '0.8'
 
+    stream = _pipeline_attribute('stream')
+    encoder = _pipeline_attribute('encoder')
+    filters = _pipeline_attribute('filters')
+    _disabled_timers = _pipeline_attribute('disabled_timers')
+    sampler = _pipeline_attribute('sampler')
+    tracer = _pipeline_attribute('tracer')
+    size_policy = _pipeline_attribute('size_policy')
+    max_payload_size = _pipeline_attribute('max_payload_size')
+    reuse_messages = _pipeline_attribute('reuse_messages')
+    sender = _pipeline_attribute('sender')
+
     def __init__(self, stream, logger, severity=6,
                  disabled_timers=None, filters=None,
                  encoder='heka.encoders.ProtobufEncoder', 
-                 hmc=None):
+                 hmc=None, sampler=None, tracer=None, size_policy=None,
+                 max_payload_size=MAX_PAYLOAD_SIZE, reuse_messages=False,
+                 sender=None, retire=None):
         """Create a HekaClient
 
         :param stream:  A string denoting which transport will be
@@ -136,14 +292,42 @@ class HekaClient(object):
                                 timers that should be deactivated.
         :param filters: A sequence of filter callables.
         :param hmc : A hashmac function
+        :param sampler: Optional `heka.sampling.AdaptiveSampler` (or
+                        compatible object) used to pick the sample
+                        rate of counters, gauges and timers.
+        :param tracer: Optional `heka.tracing.Tracer` collecting per
+                       phase timings of sampled `heka` calls.
+        :param size_policy: Optional `heka.limits` size policy applied
+                            to messages with payloads longer than
+                            `max_payload_size` bytes.
+        :param max_payload_size: Payload size limit in bytes.
+        :param reuse_messages: Recycle the Message objects `heka` builds
+                               once they're sent, through a small per
+                               thread pool. Only safe if no filter, size
+                               policy or stream keeps a reference to the
+                               messages it's handed.
+        :param sender: Optional `heka.sender.BackgroundSender` (or
+                       compatible object) which filters, encodes and
+                       writes messages on its own thread.
+        :param retire: Callable taking the pipeline replaced by
+                       `reconfigure`, the new one and the grace period,
+                       which closes the replaced parts. Defaults to
+                       `heka.pipeline.retire_replaced`.
 
         """
 
 
-        self.setup(stream, encoder, hmc, logger, severity, disabled_timers, filters)
+        # before setup, which hands the stats to the stream
+        self.stats = ClientStats()
+        self.error_reporter = ErrorReporter(self.stats)
+        self.setup(stream, encoder, hmc, logger, severity, disabled_timers,
+                   filters, sampler, tracer, size_policy, max_payload_size,
+                   reuse_messages, sender, retire)
 
         self._dynamic_methods = {}
         self._timer_obs = {}
+        self._local = threading.local()
+        self._stats_reporter = None
         self._noop_timer = _NoOpTimer()
         self.hostname = socket.gethostname()
         self.pid = os.getpid()
@@ -152,7 +336,9 @@ class HekaClient(object):
         random.seed()
 
     def setup(self, stream, encoder, hmc, logger='', severity=6, disabled_timers=None,
-              filters=None):
+              filters=None, sampler=None, tracer=None, size_policy=None,
+              max_payload_size=MAX_PAYLOAD_SIZE, reuse_messages=False,
+              sender=None, retire=None):
         """Setup the HekaClient
 
         :param logger: Default `logger` value for all sent messages.
@@ -161,29 +347,111 @@ class HekaClient(object):
         :param disabled_timers: Sequence of string tokens identifying
                                 timers that should be deactivated.
         :param filters: A sequence of filter callables.
+        :param sampler: Optional adaptive sampler for counters, gauges
+                        and timers.
+        :param tracer: Optional emit path tracer.
+        :param size_policy: Optional policy for oversized payloads.
+        :param max_payload_size: Payload size limit in bytes.
+        :param reuse_messages: Recycle the Message objects `heka`
+                               builds.
+        :param sender: Optional background sender.
+        :param retire: Optional hook closing the parts of pipelines
+                       replaced by `reconfigure`.
 
         """
+        pipeline = self._build_pipeline(
+            stream, encoder, hmc, disabled_timers, filters, sampler, tracer,
+            size_policy, max_payload_size, reuse_messages, sender)
+        self.logger = logger
+        self.severity = severity
+        self._retire = retire or retire_replaced
+        self._swap(pipeline)
+
+    def reconfigure(self, grace=RETIRE_GRACE, **changes):
+        """Replace parts of the client's delivery pipeline, atomically.
+
+        A complete new `heka.pipeline.Pipeline` is built first, with
+        the parts not in `changes` taken from the current one, and swaps
+        in with a single assignment: every message is handled entirely
+        by either the old or the new pipeline. The replaced stream and
+        sender, if not reused, are drained and closed after `grace`
+        seconds by a background thread; messages still queued in the
+        old sender are delivered by the new pipeline. Streams still
+        used by the new stream, e.g. one it wraps, are kept open, and
+        streams and senders shared by a `heka.holder.HekaClientHolder`
+        are only closed once no other client uses them.
+
+        Assigning the attributes of the client, e.g. `client.stream`,
+        swaps the pipeline the same way but never closes anything.
+
+        :param grace: Seconds messages already handed to the old
+                      pipeline are given to make it to the old stream.
+                      If None the replaced stream and sender are left
+                      open.
+        :param changes: Any of the `setup` keyword arguments other than
+                        `logger` and `severity`. An encoder may be an
+                        instance, or a class or dotted name instantiated
+                        with `hmc`.
+
+        """
+        unknown = set(changes) - set(_PIPELINE_ARGS)
+        if unknown:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ', '.join(sorted(unknown)))
+        current = self._pipeline
+        kwargs = dict((name, getattr(current, name))
+                      for name in _PIPELINE_ARGS if name != 'hmc')
+        kwargs['hmc'] = None
+        if 'hmc' in changes and 'encoder' not in changes:
+            # sign with the new key
+            kwargs['encoder'] = type(current.encoder)
+        kwargs.update(changes)
+        pipeline = self._build_pipeline(**kwargs)
+        self._replace_pipeline(pipeline, grace)
+        return pipeline
+
+    def _build_pipeline(self, stream, encoder, hmc, disabled_timers=None,
+                        filters=None, sampler=None, tracer=None,
+                        size_policy=None, max_payload_size=MAX_PAYLOAD_SIZE,
+                        reuse_messages=False, sender=None):
         from heka.path import resolve_name
         if isinstance(stream, basestring):
             stream = resolve_name(stream)()
-        self.stream = stream
+        # streams which do their own buffering report on it in our stats
+        attach_stats = getattr(stream, 'attach_stats', None)
+        if attach_stats is not None:
+            attach_stats(self.stats)
 
         if isinstance(encoder, basestring):
             encoder = resolve_name(encoder)
-        self.encoder = encoder(hmc)
-
-        self.logger = logger
-        self.severity = severity
+        if isinstance(encoder, (type, types.ClassType)):
+            encoder = encoder(hmc)
 
         if disabled_timers is None:
-            self._disabled_timers = set()
+            disabled_timers = set()
         elif isinstance(disabled_timers, types.StringTypes):
-            self._disabled_timers = set([disabled_timers])
+            disabled_timers = set([disabled_timers])
         else:
-            self._disabled_timers = set(disabled_timers)
+            disabled_timers = set(disabled_timers)
         if filters is None:
             filters = list()
-        self.filters = filters
+        return Pipeline(stream, encoder, filters, disabled_timers, sampler,
+                        tracer, size_policy, max_payload_size,
+                        reuse_messages, sender)
+
+    def _replace_pipeline(self, pipeline, grace):
+        current = self._pipeline
+        self._swap(pipeline)
+        if grace is not None:
+            self._retire(current, pipeline, grace)
+
+    def _swap(self, pipeline):
+        # the sender has to know the client before it's handed anything
+        current = getattr(self, '_pipeline', None)
+        if pipeline.sender is not None and (
+                current is None or pipeline.sender is not current.sender):
+            pipeline.sender.attach(self)
+        self._pipeline = pipeline
 
     @property
     def is_active(self):
@@ -191,23 +459,280 @@ class HekaClient(object):
         # that if a stream is set, we're good to go.
         return self.stream is not None
 
-    def send_message(self, msg):
+    def send_message(self, msg, span=None, pipeline=None):
         # Apply any filters and, if required, pass message along to the
-        # sender for delivery.
-        for filter_fn in self.filters:
+        # sender for delivery, through the current pipeline by default.
+        if pipeline is None:
+            pipeline = self._pipeline
+        stats = self.stats
+        stats.emitted += 1
+        for filter_fn in pipeline.filters:
             if not filter_fn(msg):
+                stats.record_filtered(filter_fn)
+                if span is not None:
+                    span.mark('filters')
+                    span.finish()
                 return
+        if span is not None:
+            span.mark('filters')
+        if (pipeline.size_policy is not None
+                and oversized(msg.payload, pipeline.max_payload_size)):
+            stats.oversized += 1
+            parts = pipeline.size_policy(msg, pipeline.max_payload_size)
+            if pipeline.router is not None:
+                self._write_routed(pipeline, parts)
+            else:
+                for part in parts:
+                    self._encode_and_write(pipeline, part)
+            if span is not None:
+                span.finish()
+            return
+        if pipeline.router is not None:
+            self._write_routed(pipeline, [msg])
+            if span is not None:
+                span.finish()
+            return
+        self._encode_and_write(pipeline, msg, span)
+
+    def _encode_and_write(self, pipeline, msg, span=None):
+        start = time.time()
         try:
-            data = self.encoder.encode(msg)
-            self.stream.write(data)
-            self.stream.flush()
+            if span is None:
+                data = pipeline.encoder.encode(msg)
+            else:
+                data = self._traced_encode(pipeline.encoder, msg, span)
+        except StandardError, e:
+            self.error_reporter.report(e)
+            if span is not None:
+                span.finish()
+            return
+        self._write(pipeline, data, start, span)
+
+    def _write(self, pipeline, data, start, span=None):
+        # Hand a single encoded message to the stream, `start` being
+        # the time encoding began
+        stats = self.stats
+        stream = pipeline.stream
+        encoded = time.time()
+        stats.encoded += 1
+        stats.encode_time += encoded - start
+        try:
+            stream.write(data)
+            if span is not None:
+                span.mark('write')
+            stream.flush()
         except StandardError, e:
-            unicode_msg = unicode(str(msg), errors='ignore')
+            self.error_reporter.report(e)
+            if span is not None:
+                span.finish()
+            return
+        stats.send_time += time.time() - encoded
+        stats.sent += 1
+        if isinstance(data, str):
+            stats.bytes += len(data)
+        if span is not None:
+            span.mark('flush')
+            span.finish()
+
+    def _traced_encode(self, encoder, msg, span):
+        # Time serialization and framing separately when the encoder is
+        # built from the BaseEncoder pieces
+        frame = getattr(encoder, 'frame', None)
+        if (frame is None or not getattr(encoder, 'framed', False)
+                or not isinstance(msg, Message)):
+            data = encoder.encode(msg)
+            span.mark('encode')
+            return data
+        payload = encoder.msg_to_payload(msg)
+        span.mark('encode')
+        data = frame(payload, span)
+        span.mark('frame')
+        return data
+
+    def send_batch(self, msgs):
+        """Apply filters to and encode a sequence of messages, handing
+        the encoded data to the stream in as few writes as possible.
+
+        :param msgs: Sequence of Message objects.
 
-            err_msg = "Error sending message (%s): [%s]" % \
-                      (repr(e), unicode_msg.encode("utf8"))
-            sys.stderr.write(err_msg)
+        """
+        pipeline = self._pipeline
+        msgs = self._limit_sizes(pipeline, self._filter(pipeline, msgs))
+        if pipeline.router is not None:
+            self._write_routed(pipeline, msgs)
             return
+        self._write_batch(pipeline.stream, pipeline.encoder,
+                          self._encode_all(pipeline.encoder, msgs))
+
+    def _encode_all(self, encoder, msgs):
+        for msg in msgs:
+            try:
+                yield encoder.encode(msg)
+            except StandardError, e:
+                self.error_reporter.report(e)
+
+    def _encode_events(self, pipeline, events):
+        # Encode normalized `heka` arguments, directly if the encoder
+        # can and there are no filters, through Messages otherwise
+        encoder = pipeline.encoder
+        args_to_payload = getattr(encoder, 'args_to_payload', None)
+        if args_to_payload is None or pipeline.filters:
+            for data in self._encode_all(encoder, self._limit_sizes(
+                    pipeline, self._filter(pipeline, (
+                        self._build_message(*event) for event in events)))):
+                yield data
+            return
+        stats = self.stats
+        frame = encoder.frame
+        policy = pipeline.size_policy
+        for event in events:
+            if policy is not None and oversized(event[3],
+                                                pipeline.max_payload_size):
+                for data in self._encode_all(encoder, self._limit_sizes(
+                        pipeline, self._filter(
+                            pipeline, [self._build_message(*event)]))):
+                    yield data
+                continue
+            stats.emitted += 1
+            yield frame(args_to_payload(self, *event))
+
+    def _routable(self, pipeline, events):
+        # What `_write_routed` takes for normalized `heka` arguments:
+        # Messages if they have to go through filters or size policies,
+        # the arguments themselves otherwise
+        if pipeline.filters:
+            for msg in self._limit_sizes(pipeline, self._filter(
+                    pipeline,
+                    (self._build_message(*event) for event in events))):
+                yield msg
+            return
+        stats = self.stats
+        policy = pipeline.size_policy
+        for event in events:
+            if policy is not None and oversized(event[3],
+                                                pipeline.max_payload_size):
+                for msg in self._limit_sizes(pipeline, self._filter(
+                        pipeline, [self._build_message(*event)])):
+                    yield msg
+                continue
+            stats.emitted += 1
+            yield event
+
+    def _write_routed(self, pipeline, items):
+        # Encode filtered Messages or normalized `heka` arguments for
+        # each route they match, handing each route's stream one batch.
+        # Invalid arguments raise before anything is written.
+        start = time.time()
+        batches = {}
+        for item in items:
+            if isinstance(item, Message):
+                key = (item.type, item.logger, item.severity)
+            else:
+                key = item[:3]
+            for route in pipeline.router(*key):
+                try:
+                    data = route.encode(self, item, pipeline.encoder)
+                except StandardError, e:
+                    if not isinstance(item, Message):
+                        raise
+                    self.error_reporter.report(e)
+                    continue
+                batch = batches.get(route)
+                if batch is None:
+                    batch = batches[route] = []
+                batch.append(data)
+        stream = pipeline.stream
+        for route in stream.routes + [stream.default]:
+            batch = batches.get(route)
+            if batch:
+                self._write_batch(route.stream,
+                                  route.encoder or pipeline.encoder,
+                                  batch, start)
+
+    def _write_batch(self, stream, encoder, encoded_msgs, start=None):
+        # Hand an iterable of messages encoded by `encoder` to `stream`
+        # in as few writes as possible. `start` is when encoding started,
+        # if it doesn't happen while iterating.
+        stats = self.stats
+        # Only self-delimiting (i.e. framed) output can be concatenated
+        framed = getattr(encoder, 'framed', False)
+        # Writes are kept within a UDP datagram, unless the stream
+        # declares its own limit
+        max_write_size = getattr(stream, 'max_write_size', MAX_DATAGRAM_SIZE)
+        batch = []
+        chunks = []
+        size = 0
+        count = 0
+        if start is None:
+            start = time.time()
+        for data in encoded_msgs:
+            stats.encoded += 1
+            count += 1
+            if not framed:
+                if chunks:
+                    batch.append(''.join(chunks))
+                    chunks, size = [], 0
+                batch.append(data)
+                continue
+            if chunks and size + len(data) > max_write_size:
+                batch.append(''.join(chunks))
+                chunks, size = [], 0
+            chunks.append(data)
+            size += len(data)
+        if chunks:
+            batch.append(''.join(chunks))
+        encoded = time.time()
+        stats.encode_time += encoded - start
+        if not batch:
+            return
+        try:
+            for data in batch:
+                stream.write(data)
+            stream.flush()
+        except StandardError, e:
+            # the whole batch is lost, not just one message
+            self.error_reporter.report(e, count)
+            return
+        stats.send_time += time.time() - encoded
+        stats.sent += count
+        stats.bytes += sum(len(data) for data in batch
+                           if isinstance(data, str))
+
+    def _filter(self, pipeline, msgs):
+        stats = self.stats
+        filters = pipeline.filters
+        for msg in msgs:
+            stats.emitted += 1
+            for filter_fn in filters:
+                if not filter_fn(msg):
+                    stats.record_filtered(filter_fn)
+                    break
+            else:
+                yield msg
+
+    def _limit_sizes(self, pipeline, msgs):
+        policy = pipeline.size_policy
+        for msg in msgs:
+            if (policy is not None
+                    and oversized(msg.payload, pipeline.max_payload_size)):
+                self.stats.oversized += 1
+                for part in policy(msg, pipeline.max_payload_size):
+                    yield part
+            else:
+                yield msg
+
+    def start_stats_reporter(self, interval=60):
+        """Periodically send this client's `stats` as a `heka_stats`
+        message through the client itself.
+
+        :param interval: Seconds between messages.
+
+        """
+        from heka.stats import StatsReporter
+        if self._stats_reporter is not None:
+            self._stats_reporter.stop()
+        self._stats_reporter = StatsReporter(self, interval).start()
+        return self._stats_reporter
 
     def add_method(self, method, override=False):
         """Add a custom method to the HekaClient instance.
@@ -249,13 +774,178 @@ class HekaClient(object):
                           is given, then current time will be used.
 
         """
+        # the whole call goes through the same pipeline, even if it's
+        # replaced in the meantime
+        pipeline = self._pipeline
+        tracer = pipeline.tracer
+        span = tracer.start() if tracer is not None else None
         logger = logger if logger is not None else self.logger
         severity = severity if severity is not None else self.severity
         fields = fields if fields is not None else dict()
         timestamp = time.mktime(timestamp.timetuple()) \
             if isinstance(timestamp, datetime.datetime) else timestamp
+        if span is not None:
+            span.mark('normalize')
+
+        buf = getattr(self._local, 'buffer', None)
+        if buf is not None:
+            # encoded later, by when the caller may have changed fields
+            buf.append((type, logger, severity, payload, copy_fields(fields),
+                        timestamp or time.time()))
+            if span is not None:
+                span.finish()
+            return
 
-        msg = Message()
+        if pipeline.sender is not None:
+            pipeline.sender.put(Event(type, logger, severity, payload,
+                                      copy_fields(fields),
+                                      timestamp or time.time()))
+            if span is not None:
+                span.finish()
+            return
+
+        if pipeline.router is not None:
+            self._deliver_events([(type, logger, severity, payload, fields,
+                                   timestamp)], pipeline)
+            if span is not None:
+                span.finish()
+            return
+
+        # Encoders that can serialize the arguments directly don't need
+        # a Message, unless there are filters to run against one
+        encoder = pipeline.encoder
+        args_to_payload = getattr(encoder, 'args_to_payload', None)
+        if (args_to_payload is not None and not pipeline.filters
+                and (pipeline.size_policy is None
+                     or not oversized(payload, pipeline.max_payload_size))):
+            self.stats.emitted += 1
+            start = time.time()
+            data = args_to_payload(self, type, logger, severity, payload,
+                                   fields, timestamp)
+            if span is not None:
+                span.mark('encode_args')
+            data = encoder.frame(data, span)
+            if span is not None:
+                span.mark('frame')
+            self._write(pipeline, data, start, span)
+            return
+
+        msg = self._build_message(type, logger, severity, payload, fields,
+                                  timestamp, span)
+        self.send_message(msg, span, pipeline)
+        if pipeline.reuse_messages:
+            self._release_message(msg)
+
+    def heka_many(self, events, logger=None, severity=None):
+        """Send a batch of messages, each encoded the same way as by
+        `heka`, handed to the stream in as few writes as possible.
+
+        Invalid events raise before anything is sent.
+
+        :param events: Iterable of events, each either a tuple of `heka`
+                       positional arguments (starting with the type) or a
+                       dict of its keyword arguments.
+        :param logger: Logger for events that don't have their own.
+        :param severity: Severity for events that don't have their own.
+
+        """
+        logger = logger if logger is not None else self.logger
+        severity = severity if severity is not None else self.severity
+        normalized = []
+        for event in events:
+            if isinstance(event, dict):
+                event = _event_args(**event)
+            else:
+                event = _event_args(*event)
+            (event_type, event_logger, event_severity, payload, fields,
+             timestamp) = event
+            if event_logger is None:
+                event_logger = logger
+            if event_severity is None:
+                event_severity = severity
+            if fields is None:
+                fields = {}
+            if isinstance(timestamp, datetime.datetime):
+                timestamp = time.mktime(timestamp.timetuple())
+            normalized.append((event_type, event_logger, event_severity,
+                               payload, fields, timestamp))
+        self._send_events(normalized)
+
+    def incr_many(self, names, counts=None, logger=None, severity=None,
+                  fields=None, rate=1.0):
+        """Send a batch of 'increment counter' messages, as by `incr`,
+        in as few writes as possible.
+
+        :param names: Iterable of counter names, of `(name, count)` pairs
+                      or a dict mapping names to counts. A bare name
+                      counts 1.
+        :param counts: Counts matching `names`, as a parallel sequence.
+        :param logger: String token identifying the message generator.
+        :param severity: Numerical code (0-7) for msg severity, per RFC
+                         5424.
+        :param fields: Arbitrary key/value pairs for add'l metadata, the
+                       same for every counter.
+        :param rate: Sample rate, adjusted per name by the client's
+                     sampler if there is one.
+
+        """
+        if counts is not None:
+            pairs = zip(names, counts)
+        elif isinstance(names, dict):
+            pairs = names.iteritems()
+        else:
+            pairs = ((item, 1) if isinstance(item, basestring) else item
+                     for item in names)
+        logger = logger if logger is not None else self.logger
+        severity = severity if severity is not None else self.severity
+        sampler = self.sampler
+        events = []
+        for name, count in pairs:
+            name_rate = rate
+            if sampler is not None:
+                name_rate = sampler.sample_rate(name, rate)
+            if name_rate < 1 and random.random() >= name_rate:
+                continue
+            counter_fields = dict(fields) if fields else {}
+            counter_fields['name'] = name
+            counter_fields['rate'] = name_rate
+            events.append(('counter', logger, severity, str(count),
+                           counter_fields, None))
+        self._send_events(events)
+
+    def _send_events(self, events):
+        # Deliver a list of normalized `heka` arguments as one batch
+        buf = getattr(self._local, 'buffer', None)
+        if buf is not None:
+            for event in events:
+                buf.append(event[:4] + (copy_fields(event[4]),
+                                        event[5] or time.time()))
+            return
+        pipeline = self._pipeline
+        if pipeline.sender is not None:
+            for event in events:
+                pipeline.sender.put(Event(*(event[:4] +
+                                            (copy_fields(event[4]),
+                                             event[5] or time.time()))))
+            return
+        self._deliver_events(events, pipeline)
+
+    def _deliver_events(self, events, pipeline=None):
+        # encode everything first, so invalid events raise before
+        # anything is sent
+        if pipeline is None:
+            pipeline = self._pipeline
+        if pipeline.router is not None:
+            self._write_routed(pipeline, self._routable(pipeline, events))
+            return
+        start = time.time()
+        self._write_batch(pipeline.stream, pipeline.encoder,
+                          list(self._encode_events(pipeline, events)), start)
+
+    def _build_message(self, type, logger, severity, payload, fields,
+                       timestamp, span=None):
+        """Create a Message from already normalized `heka` arguments."""
+        msg = self._acquire_message() if self.reuse_messages else Message()
         msg.timestamp = int((timestamp or time.time()) * 1000000000)
         msg.type = type
         msg.logger = logger
@@ -265,11 +955,91 @@ class HekaClient(object):
         msg.pid = self.pid
         msg.hostname = self.hostname
         self._flatten_fields(msg, fields)
+        if span is not None:
+            span.mark('flatten')
+
+        msg.uuid = uuid5_bytes(msg.SerializePartialToString())
+        if span is not None:
+            span.mark('uuid')
+        return msg
+
+    def _acquire_message(self):
+        # a cleared Message from this thread's pool, or a new one
+        pool = getattr(self._local, 'messages', None)
+        if pool:
+            return pool.pop()
+        return Message()
+
+    def _release_message(self, msg):
+        pool = getattr(self._local, 'messages', None)
+        if pool is None:
+            pool = self._local.messages = []
+        if len(pool) < MESSAGE_POOL_SIZE:
+            msg.Clear()
+            pool.append(msg)
+
+    def define(self, type, fields=None, logger=None, severity=None,
+               **field_types):
+        """Return a callable sending messages of `type` which always
+        have the same fields, e.g.::
+
+            db_query = client.define('db_query', [('table', str),
+                                                  ('rows', int),
+                                                  ('ms', float)])
+            db_query('users', 10, 1.5)
+
+        The callable takes the field values positionally, and `payload`,
+        `severity` and `timestamp` keyword arguments. Values are
+        converted to the declared type (`int`, `float`, `str` or
+        `unicode`), string fields only accept strings. Fields declared
+        as `bytearray`, `memoryview` or `buffer` are BYTES fields, and
+        take any of those or a `str`.
+
+        With an encoder that supports it (`ProtobufEncoder`) the message
+        is written by a serializer compiled for the field names and
+        types, without building a fields dictionary; otherwise the call
+        is the same as `heka`.
+
+        :param type: Message type.
+        :param fields: Sequence of `(name, type)` pairs, in the order the
+                       values are passed in. Names may be dotted.
+        :param logger: Logger, the client's logger if not given.
+        :param severity: Default severity, the client's if not given.
+        :param field_types: One more field, as `name=type`, after
+                            `fields`. As keyword arguments are unordered
+                            `TypeError` is raised for more than one,
+                            which would take their values in no
+                            particular order.
 
-        msg.uuid = uuid.uuid5(uuid.NAMESPACE_OID, str(msg)).bytes
-
-        self.send_message(msg)
+        """
+        if len(field_types) > 1:
+            raise TypeError("Only one field can be given as a keyword "
+                            "argument, pass `fields` in order instead: %s"
+                            % ', '.join(sorted(field_types)))
+        specs = list(fields or ()) + field_types.items()
+        names = [name for name, python_type in specs]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate field names: %s" % names)
+        return _Emitter(self, type, specs, logger, severity)
+
+    def request_buffer(self, policy=None, max_events=None):
+        """Return a context manager that holds back all messages
+        generated by the current thread until it exits, delivering them
+        as a single batch only if `policy` decides to keep them.
+
+        :param policy: Callable accepting the closed
+                       `heka.sampling.RequestBuffer` and returning True
+                       if its messages should be delivered. Defaults to
+                       `heka.sampling.tail_policy_provider()`.
+        :param max_events: Maximum number of messages held, defaults to
+                           `heka.sampling.MAX_EVENTS`. Any more are
+                           dropped.
 
+        """
+        from heka.sampling import MAX_EVENTS, RequestBuffer
+        if max_events is None:
+            max_events = MAX_EVENTS
+        return RequestBuffer(self, policy, max_events)
 
     def timer(self, name, logger=None, severity=None, fields=None, rate=1.0):
         """Return a timer object that can be used as a context manager
@@ -284,11 +1054,18 @@ class HekaClient(object):
                      Sample rate is enforced in this method, i.e. if a
                      sample rate is used then some percentage of the
                      timers will do nothing.
+                     If the client has a `sampler` it may lower the
+                     rate, the rate actually applied is recorded in
+                     the message.
 
         """
         # check if timer(s) is(are) disabled or if we exclude for sample rate
-        if ((self._disabled_timers.intersection(set(['*', name]))) or
-            (rate < 1.0 and random.random() >= rate)):
+        pipeline = self._pipeline
+        if pipeline.disabled_timers.intersection(set(['*', name])):
+            return self._noop_timer
+        if pipeline.sampler is not None:
+            rate = pipeline.sampler.sample_rate(name, rate)
+        if rate < 1.0 and random.random() >= rate:
             return self._noop_timer
         msg_data = dict(logger=logger, severity=severity, fields=fields,
                         rate=rate)
@@ -333,6 +1110,9 @@ class HekaClient(object):
         :param fields: Arbitrary key/value pairs for add'l metadata.
 
         """
+        sampler = self.sampler
+        if sampler is not None:
+            rate = sampler.sample_rate(name, rate)
         if rate < 1 and random.random() >= rate:
             return
         payload = str(count)
@@ -353,6 +1133,9 @@ class HekaClient(object):
         :param fields: Arbitrary key/value pairs for add'l metadata.
 
         """
+        sampler = self.sampler
+        if sampler is not None:
+            rate = sampler.sample_rate(name, rate)
         if rate < 1 and random.random() >= rate:
             return
         payload = str(value)
@@ -415,32 +1198,21 @@ class HekaClient(object):
         self._oldstyle(SEVERITY.CRITICAL, msg, *args, **kwargs)
 
     def _flatten_fields(self, msg, field_map, prefix=None):
-        for k, v in field_map.items():
+        for key, vtype, name, value_type, attr, wire in \
+                flatten_plan(field_map, prefix):
+            if value_type is None:
+                self._flatten_fields(msg, field_map[key], prefix=name)
+                continue
             f = msg.fields.add()
-
-            if prefix:
-                full_name = "%s.%s" % (prefix, k)
-            else:
-                full_name = k
-            f.name = full_name
+            f.name = name
             f.representation = ""
-
-            if v is None:
-                raise ValueError("None is not allowed for field values.  [%s]" % full_name)
-            elif isinstance(v, types.IntType):
-                f.value_type = Field.INTEGER
-                f.value_integer.append(v)
-            elif isinstance(v, types.FloatType):
-                f.value_type = Field.DOUBLE
-                f.value_double.append(v)
-            elif isinstance(v, types.BooleanType):
-                f.value_type = Field.BOOL
-                f.value_bool.append(bool(v))
-            elif isinstance(v, basestring):
-                f.value_type = Field.STRING
-                f.value_string.append(v)
-            elif isinstance(v, types.DictType):
-                msg.fields.remove(f)
-                self._flatten_fields(msg, v, prefix=full_name)
+            if value_type == ARRAY:
+                value_type, values = array_values(field_map[key])
+                f.value_type = value_type
+                getattr(f, VALUE_ATTRS[value_type]).extend(values)
+                continue
+            f.value_type = value_type
+            if value_type == Field.BYTES:
+                f.value_bytes.append(as_bytes(field_map[key]))
             else:
-                raise ValueError("Unexpected value type : [%s][%s]" % (type(v), v))
+                getattr(f, attr).append(field_map[key])
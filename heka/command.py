@@ -14,15 +14,24 @@
 # ***** END LICENSE BLOCK *****
 from datetime import datetime
 from docopt import docopt
+import Queue
 import json
+import multiprocessing
+import random
 import socket
+import sys
+import threading
+import time
+import timeit
 
 from heka.config import client_from_dict_config, client_from_stream_config
 
 mb_doc = """mb: HekaBench, blast messages at a Heka router.
 
 Usage:
-  mb HOST PORT [--hekacfg=<ini_file>] [--raw]
+  mb HOST PORT [--hekacfg=<ini_file>] [--raw] [--threads=<n>]
+     [--processes=<n>] [--rate=<n>] [--duration=<seconds>]
+     [--size=<bytes>] [--fields=<n>] [--report=<seconds>]
 
 Arguments:
   HOST             Hostname or IP address of heka router to test
@@ -32,21 +41,55 @@ Options:
   --hekacfg=<ini file>        Path to heka client config file
   --raw                         Raw send of static text directly over UDP
                                 instead of using heka client
+  --threads=<n>               Number of sending threads [default: 1]
+  --processes=<n>             Number of sending processes, each one
+                              running the given number of threads
+                              [default: 1]
+  --rate=<n>                  Target total messages per second, 0 for as
+                              fast as possible [default: 0]
+  --duration=<seconds>        Stop after this many seconds, 0 to run until
+                              interrupted [default: 0]
+  --size=<bytes>              Payload size of each message [default: 6]
+  --fields=<n>                Number of fields in each message [default: 0]
+  --report=<seconds>          Seconds between live reports [default: 1]
 """
 
+# maximum number of latency samples kept per report interval and worker
+LATENCY_SAMPLES = 1000
+# maximum number of latency samples kept for the final report
+TOTAL_LATENCY_SAMPLES = 100000
 
-def mb():
-    arguments = docopt(mb_doc)
-    host = arguments.get('HOST')
-    port = int(arguments.get('PORT'))
 
-    DEFAULT_CONFIG = {'logger': 'mb',
-                      'sender': {'class': 'heka.senders.udp.UdpSender',
-                                 'args': (host, port),
-                                 },
-                      }
+class _CountingStream(object):
+    """Wraps a stream, counting the bytes written through it."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def take(self):
+        """Return the byte count and reset it."""
+        count, self.bytes = self.bytes, 0
+        return count
 
-    if arguments.get('--raw'):
+
+def _make_sender(options):
+    """Return a `(send, stream)` 2-tuple, `send` being a zero argument
+    callable that generates one message and `stream` the counting
+    stream it is delivered through.
+
+    """
+    host, port = options['host'], options['port']
+    payload = 'x' * options['size']
+    fields = dict(('field_%d' % i, i) for i in range(options['fields']))
+
+    if options['raw']:
         udpsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         utcnow = datetime.utcnow()
         if utcnow.microsecond == 0:
@@ -55,18 +98,336 @@ def mb():
             timestamp = "%sZ" % utcnow.isoformat()
         msg = {"severity": 6, "timestamp": timestamp,
                "heka_hostname": "spire",
-               "fields": {"userid": 25, "req_time": 4}, "heka_pid": 34328,
-               "logger": "syncstorage", "type": "services", "payload": "foo",
+               "fields": fields or {"userid": 25, "req_time": 4},
+               "heka_pid": 34328, "logger": "syncstorage",
+               "type": "services", "payload": payload,
                "env_version": "0.8"}
         json_msg = json.dumps(msg)
-        while True:
-            udpsock.sendto(json_msg, (host, port))
 
+        class _UdpWriter(object):
+            def write(self, data):
+                udpsock.sendto(data, (host, port))
+
+            def flush(self):
+                pass
+
+        stream = _CountingStream(_UdpWriter())
+        return (lambda: stream.write(json_msg)), stream
+
+    if options['hekacfg']:
+        with open(options['hekacfg']) as cfgfile:
+            client = client_from_stream_config(cfgfile, 'heka')
+    else:
+        client = client_from_dict_config(
+            {'logger': 'mb',
+             'stream': {'class': 'heka.streams.UdpStream',
+                        'host': host,
+                        'port': port,
+                        },
+             })
+    stream = client.stream = _CountingStream(client.stream)
+    return (lambda: client.heka('MBTEST', payload=payload,
+                                fields=fields)), stream
+
+
+def _mb_worker(options, rate, results):
+    """Send messages at `rate` per second (or as fast as possible if
+    `rate` is 0), putting a `(count, bytes, latencies)` report on the
+    `results` queue every report interval, and None when done.
+
+    """
+    send, stream = _make_sender(options)
+    timer = timeit.default_timer
+    start = timer()
+    deadline = start + options['duration'] if options['duration'] else None
+    next_report = start + options['report']
+    count = total = 0
+    latencies = []
+    try:
+        while deadline is None or timer() < deadline:
+            if rate:
+                delay = start + total / rate - timer()
+                if delay > 0:
+                    time.sleep(delay)
+            before = timer()
+            send()
+            after = timer()
+            count += 1
+            total += 1
+            _sample(latencies, count, after - before, LATENCY_SAMPLES)
+            if after >= next_report:
+                results.put((count, stream.take(), latencies))
+                count = 0
+                latencies = []
+                next_report += options['report']
+    finally:
+        results.put((count, stream.take(), latencies))
+        results.put(None)
+
+
+def _sample(samples, seen, value, limit):
+    """Reservoir sampling, `seen` counts `value` itself. Keeps the
+    percentiles honest without storing every measurement.
+
+    """
+    if len(samples) < limit:
+        samples.append(value)
+    else:
+        idx = random.randint(0, seen - 1)
+        if idx < limit:
+            samples[idx] = value
+
+
+def _percentile(values, pct):
+    """Return the `pct` percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def _format_report(label, count, nbytes, latencies, elapsed):
+    latencies = sorted(latencies)
+    elapsed = elapsed or 1e-9
+    return ("%s: %d msgs, %.1f msgs/sec, %.1f bytes/sec, latency "
+            "p50 %.1fus p90 %.1fus p99 %.1fus max %.1fus" %
+            (label, count, count / elapsed, nbytes / elapsed,
+             _percentile(latencies, 50) * 1e6,
+             _percentile(latencies, 90) * 1e6,
+             _percentile(latencies, 99) * 1e6,
+             (latencies[-1] if latencies else 0.0) * 1e6))
+
+
+def _mb_process(options, rate, results):
+    """Run `options['threads']` worker threads inside a child process."""
+    workers = [threading.Thread(target=_mb_worker,
+                                args=(options, rate, results))
+               for i in range(options['threads'])]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def mb():
+    arguments = docopt(mb_doc)
+    options = {'host': arguments.get('HOST'),
+               'port': int(arguments.get('PORT')),
+               'hekacfg': arguments.get('--hekacfg'),
+               'raw': arguments.get('--raw'),
+               'threads': int(arguments['--threads']),
+               'processes': int(arguments['--processes']),
+               'duration': float(arguments['--duration']),
+               'size': int(arguments['--size']),
+               'fields': int(arguments['--fields']),
+               'report': float(arguments['--report']),
+               }
+    run_mb(options, float(arguments['--rate']))
+
+
+def run_mb(options, rate=0.0, out=None):
+    """Generate load as described by `options` (see `mb`), printing
+    live and final reports to `out` (default stdout). Returns the
+    final `(count, bytes, latencies, elapsed)` totals.
+
+    """
+    if out is None:
+        out = sys.stdout
+    num_workers = options['threads'] * options['processes']
+    worker_rate = float(rate) / num_workers
+
+    if options['processes'] > 1:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_mb_process,
+                                           args=(options, worker_rate,
+                                                 results))
+                   for i in range(options['processes'])]
+    else:
+        results = Queue.Queue()
+        workers = [threading.Thread(target=_mb_worker,
+                                    args=(options, worker_rate, results))
+                   for i in range(options['threads'])]
+
+    start = last_report = time.time()
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    total_count = total_bytes = total_seen = 0
+    total_latencies = []
+    count = nbytes = 0
+    latencies = []
+    running = num_workers
+    try:
+        while running:
+            try:
+                report = results.get(timeout=options['report'])
+            except Queue.Empty:
+                report = False
+            if report is None:
+                running -= 1
+            elif report:
+                count += report[0]
+                nbytes += report[1]
+                latencies.extend(report[2])
+            now = time.time()
+            if now - last_report >= options['report']:
+                out.write(_format_report('live', count, nbytes, latencies,
+                                         now - last_report) + '\n')
+                out.flush()
+                total_count += count
+                total_bytes += nbytes
+                for latency in latencies:
+                    total_seen += 1
+                    _sample(total_latencies, total_seen, latency,
+                            TOTAL_LATENCY_SAMPLES)
+                count = nbytes = 0
+                latencies = []
+                last_report = now
+    except KeyboardInterrupt:
+        for worker in workers:
+            if hasattr(worker, 'terminate'):
+                worker.terminate()
+
+    total_count += count
+    total_bytes += nbytes
+    for latency in latencies:
+        total_seen += 1
+        _sample(total_latencies, total_seen, latency, TOTAL_LATENCY_SAMPLES)
+    elapsed = time.time() - start
+    out.write(_format_report('total', total_count, total_bytes,
+                             total_latencies, elapsed) + '\n')
+    return total_count, total_bytes, total_latencies, elapsed
+
+
+recv_doc = """hekarecv: Count heka messages, a stand-in for hekad.
+
+Usage:
+  hekarecv [--udp=<addr>...] [--tcp=<addr>...] [--unix=<path>...]
+           [--hekacfg=<ini_file>] [--forward=<addr>]
+           [--report=<seconds>] [--duration=<seconds>]
+
+Options:
+  --udp=<addr>                Listen for UDP on host:port
+  --tcp=<addr>                Listen for TCP on host:port
+  --unix=<path>               Listen on a Unix domain stream socket
+  --hekacfg=<ini file>        Heka client config file, the HMAC keys in
+                              its heka_hmac section are used to verify
+                              signed messages
+  --forward=<addr>            Relay every message over UDP to host:port
+                              (e.g. hekad) as a plain heka frame,
+                              expanding compressed batches
+  --report=<seconds>          Seconds between reports [default: 1]
+  --duration=<seconds>        Stop after this many seconds, 0 to run until
+                              interrupted [default: 0]
+"""
+
+
+def _parse_addr(addr):
+    host, port = addr.rsplit(':', 1)
+    return host, int(port)
+
+
+def hekarecv():
+    from heka.config import dict_from_stream_config
+    from heka.receiver import HekaReceiver, HekaRelay, format_report, serve
+    arguments = docopt(recv_doc)
+
+    hmac_keys = {}
     if arguments.get('--hekacfg'):
         with open(arguments['--hekacfg']) as cfgfile:
-            client = client_from_stream_config(cfgfile, 'heka')
+            hmc = dict_from_stream_config(cfgfile, 'heka')['hmac']
+        if hmc:
+            hmac_keys[(hmc['signer'], int(hmc['key_version']))] = hmc['key']
+
+    if arguments.get('--forward'):
+        from heka.streams import UdpStream
+        receiver = HekaRelay(UdpStream(*_parse_addr(arguments['--forward'])),
+                             hmac_keys)
     else:
-        client = client_from_dict_config(DEFAULT_CONFIG)
+        receiver = HekaReceiver(hmac_keys)
+    servers = []
+    for addr in arguments['--udp']:
+        servers.append(serve(receiver, 'udp', _parse_addr(addr)))
+    for addr in arguments['--tcp']:
+        servers.append(serve(receiver, 'tcp', _parse_addr(addr)))
+    for path in arguments['--unix']:
+        servers.append(serve(receiver, 'unix', path))
+    if not servers:
+        servers.append(serve(receiver, 'udp', ('127.0.0.1', 5565)))
+
+    report = float(arguments['--report'])
+    duration = float(arguments['--duration'])
+    deadline = time.time() + duration if duration else None
+    totals = {'messages': 0, 'bytes': 0, 'malformed': 0, 'bad_hmac': 0}
+    start = time.time()
+    try:
+        while deadline is None or time.time() < deadline:
+            time.sleep(report)
+            stats = receiver.take()
+            for key in totals:
+                totals[key] += stats[key]
+            print format_report('live', stats)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    elapsed = time.time() - start
+    print ("total: %(messages)d msgs, %(malformed)d malformed, "
+           "%(bad_hmac)d bad hmac" % totals +
+           ", %.1f msgs/sec, %.1f bytes/sec" % (totals['messages'] / elapsed,
+                                                totals['bytes'] / elapsed))
+
+
+bench_doc = """hekabench: Micro-benchmarks for the heka client hot path.
+
+Usage:
+  hekabench [--iterations=<n>] [--output=<file>] [--baseline=<file>]
+            [--tolerance=<pct>] [BENCHMARK...]
+  hekabench --list
+
+Arguments:
+  BENCHMARK                   Names of the benchmarks to run (default all)
+
+Options:
+  --iterations=<n>            Calls per measurement [default: 10000]
+  --output=<file>             Write JSON results to this file
+  --baseline=<file>           Compare against JSON results stored earlier,
+                              exits non-zero on any regression
+  --tolerance=<pct>           Allowed slowdown in percent [default: 20]
+  --list                      List the available benchmarks
+"""
+
+
+def bench():
+    from heka import bench as heka_bench
+    arguments = docopt(bench_doc)
+    if arguments.get('--list'):
+        for name in heka_bench.benchmark_names():
+            print name
+        return
+
+    results = heka_bench.run(arguments.get('BENCHMARK'),
+                             int(arguments['--iterations']))
+    for name, values in sorted(results['results'].items()):
+        pb_objects = values['pb_objects']
+        pb_objects = '-' if pb_objects is None else '%.2f' % pb_objects
+        print "%-40s %12.1f ns %8.2f gc objects %8s pb objects" % (
+            name, values['ns'], values['gc_objects'], pb_objects)
+
+    if arguments.get('--output'):
+        with open(arguments['--output'], 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
 
-    while True:
-        client.heka('MBTEST', payload='MBTEST')
+    if arguments.get('--baseline'):
+        with open(arguments['--baseline']) as basefile:
+            baseline = json.load(basefile)
+        tolerance = float(arguments['--tolerance']) / 100
+        regressions = heka_bench.compare(results, baseline, tolerance)
+        for name, metric, old, new in regressions:
+            print "REGRESSION %s %s: %.2f -> %.2f" % (name, metric, old, new)
+        if regressions:
+            sys.exit(1)
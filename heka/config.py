@@ -20,7 +20,9 @@ from textwrap import dedent
 
 from heka.client import HekaClient
 from heka.exceptions import EnvironmentNotFoundError
+from heka.limits import MAX_PAYLOAD_SIZE
 from heka.path import DottedNameResolver
+from heka.streams.routing import Route, RoutingStream
 
 _IS_INTEGER = re.compile('^-?[0-9].*')
 _IS_ENV_VAR = re.compile('\$\{(\w.*)?\}')
@@ -81,7 +83,7 @@ def nest_prefixes(config_dict, prefixes=None, separator="_"):
                       key.
     """
     if prefixes is None:
-        prefixes = ['stream']
+        prefixes = ['stream', 'sampler', 'tracer', 'sender']
     for prefix in prefixes:
         prefix_dict = {}
         for key in config_dict.keys():
@@ -97,13 +99,59 @@ def nest_prefixes(config_dict, prefixes=None, separator="_"):
     return config_dict
 
 
-def client_from_dict_config(config, client=None):
+def _size_policy(specs, stream, resolver):
+    """Instantiate the size policy for `stream` out of the
+    `size_policies` config.
+
+    """
+    default = None
+    for dotted_name, cfg in specs:
+        cfg = dict(cfg)
+        stream_name = cfg.pop('stream', None)
+        if stream_name is None:
+            if default is None:
+                default = (dotted_name, cfg)
+        elif isinstance(stream, resolver.resolve(stream_name)):
+            return resolver.resolve(dotted_name)(**cfg)
+    if default is not None:
+        return resolver.resolve(default[0])(**default[1])
+    return None
+
+
+def _create(kind, config, factory):
+    return factory()
+
+
+def _instance(kind, config, resolver, acquire, default_class=None):
+    # Instantiate the `class` of `config` with its `args` and remaining
+    # keyword arguments, through `acquire`
+    def factory():
+        kwargs = dict(config)
+        if default_class is None:
+            cls = resolver.resolve(kwargs.pop('class'))
+        else:
+            cls = resolver.resolve(kwargs.pop('class', default_class))
+        args = kwargs.pop('args', tuple())
+        return cls(*args, **kwargs)
+    return acquire(kind, config, factory)
+
+
+def client_from_dict_config(config, client=None, acquire=_create,
+                            retire=None):
     """
     Configure a heka client, fully configured w/ stream and plugins.
 
     :param config: Configuration dictionary.
     :param client: HekaClient instance to configure. If None, one will be
                    created.
+    :param acquire: Callable taking a kind of object ('stream' or
+                    'sender'), its configuration dictionary and a
+                    function creating it, returning the object for the
+                    client to use. This lets a `heka.holder` share
+                    objects between clients. By default each client
+                    gets its own.
+    :param retire: Optional `retire` hook of the client, see
+                   `HekaClient`.
 
     The configuration dict supports the following values:
 
@@ -127,14 +175,53 @@ def client_from_dict_config(config, client=None):
       method.
     stream
       Nested dictionary containing stream configuration.
+    routes
+      Sequence of 2-tuples `(name, config)` of `heka.streams.Route`s. If
+      there are any the client writes to a `heka.streams.RoutingStream`,
+      with the configured stream as its default. Each route `config`
+      holds a nested `stream` dictionary, like the client's, and the
+      `Route` keyword arguments. Routes use the client's HMAC settings.
+    size_policies
+      Sequence of 2-tuples `(policy_provider, config)`, like `filters`,
+      for messages whose payload is larger than `max_payload_size`
+      bytes. A `stream` entry in `config` names the stream class the
+      policy is for. The client uses the first policy for a class its
+      stream is an instance of, or else the first policy without a
+      `stream`.
+    max_payload_size
+      Payload size limit in bytes for the size policy, defaults to
+      `heka.limits.MAX_PAYLOAD_SIZE`.
+    stats_interval
+      If set, the client's internal stats are sent as a `heka_stats`
+      message every `stats_interval` seconds.
+    error_interval
+      Minimum number of seconds between delivery error reports written to
+      stderr, defaults to 10.
+    reuse_messages
+      If True, Message objects built by the client are recycled once
+      sent. See `HekaClient`.
+    sampler
+      Optional nested dictionary containing adaptive sampler
+      configuration. It has the same layout as the stream configuration,
+      defaulting to a `heka.sampling.AdaptiveSampler` if no `class` is
+      given.
+    tracer
+      Optional nested dictionary containing emit path tracer
+      configuration, defaulting to a `heka.tracing.Tracer` if no `class`
+      is given.
+    sender
+      Optional nested dictionary containing background sender
+      configuration, defaulting to a `heka.sender.BackgroundSender` if no
+      `class` is given.
 
     All of the configuration values are optional, but failure to include a
     stream may result in a non-functional Heka client. Any unrecognized keys
     will be ignored.
 
-    Note that any top level config values starting with `stream_` will be added
-    to the `stream` config dictionary, overwriting any values that may already
-    be set.
+    Note that any top level config values starting with `stream_` (or
+    `sampler_`, `tracer_`, `sender_`) will be added to the `stream` (or
+    `sampler`, `tracer`, `sender`) config dictionary, overwriting any
+    values that may already be set.
 
     The stream configuration supports the following values:
 
@@ -164,15 +251,63 @@ def client_from_dict_config(config, client=None):
     resolver = DottedNameResolver()
 
     # instantiate stream
-    stream_clsname = stream_config.pop('class')
-    stream_cls = resolver.resolve(stream_clsname)
-    stream_args = stream_config.pop('args', tuple())
-    stream = stream_cls(*stream_args, **stream_config)
+    stream = _instance('stream', stream_config, resolver, acquire)
+
+    # route messages to other streams, the configured one being the
+    # default
+    routes = []
+    for route_name, route_config in config.get('routes', []):
+        route_config = nest_prefixes(dict(route_config), ['stream'])
+        route_stream = _instance('stream', route_config.pop('stream', {}),
+                                 resolver, acquire)
+        route_kwargs = dict((key, value)
+                            for key, value in route_config.items()
+                            if not key.startswith('stream_'))
+        routes.append(Route(route_stream, hmc=hmc, name=route_name,
+                            **route_kwargs))
+
+    # instantiate sampler
+    sampler = None
+    sampler_config = config.get('sampler')
+    if sampler_config:
+        sampler_cls = resolver.resolve(sampler_config.pop(
+            'class', 'heka.sampling.AdaptiveSampler'))
+        sampler_args = sampler_config.pop('args', tuple())
+        sampler = sampler_cls(*sampler_args, **sampler_config)
+
+    # instantiate tracer
+    tracer = None
+    tracer_config = config.get('tracer')
+    if tracer_config:
+        tracer_cls = resolver.resolve(tracer_config.pop(
+            'class', 'heka.tracing.Tracer'))
+        tracer_args = tracer_config.pop('args', tuple())
+        tracer = tracer_cls(*tracer_args, **tracer_config)
+
+    # instantiate background sender
+    # A sender delivers through the client it's attached to, so it can
+    # only be shared by clients which only differ by their logger.
+    sender = None
+    sender_config = config.get('sender')
+    if sender_config:
+        client_config = dict((key, value) for key, value in config.items()
+                             if key != 'logger')
+        sender = acquire('sender', client_config,
+                         lambda: _instance('sender', sender_config, resolver,
+                                           _create,
+                                           'heka.sender.BackgroundSender'))
 
     # initialize filters
     filters = [resolver.resolve(dotted_name)(**cfg)
                for (dotted_name, cfg) in filter_specs]
 
+    size_policy = _size_policy(config.get('size_policies', []), stream,
+                               resolver)
+    if routes:
+        stream = RoutingStream(stream, routes)
+    max_payload_size = config.get('max_payload_size', MAX_PAYLOAD_SIZE)
+    reuse_messages = config.get('reuse_messages', False)
+
 
     if client is None:
         client = HekaClient(stream,
@@ -181,9 +316,18 @@ def client_from_dict_config(config, client=None):
                             disabled_timers,
                             filters, 
                             encoder=encoder,
-                            hmc=hmc)
+                            hmc=hmc,
+                            sampler=sampler,
+                            tracer=tracer,
+                            size_policy=size_policy,
+                            max_payload_size=max_payload_size,
+                            reuse_messages=reuse_messages,
+                            sender=sender,
+                            retire=retire)
     else:
-        client.setup(stream, encoder, hmc, logger, severity, disabled_timers, filters)
+        client.setup(stream, encoder, hmc, logger, severity, disabled_timers,
+                     filters, sampler, tracer, size_policy, max_payload_size,
+                     reuse_messages, sender, retire)
 
     # initialize plugins and attach to client
     for section_name, plugin_spec in plugins_data.items():
@@ -193,6 +337,14 @@ def client_from_dict_config(config, client=None):
         plugin_fn = resolver.resolve(plugin_spec[0])(plugin_config)
         client.add_method(plugin_fn, plugin_override)
 
+    error_interval = config.get('error_interval')
+    if error_interval:
+        client.error_reporter.interval = float(error_interval)
+
+    stats_interval = config.get('stats_interval')
+    if stats_interval:
+        client.start_stats_reporter(stats_interval)
+
     # We bind the configuration into the client itself to ease
     # debugging
     client._config = config_copy
@@ -231,6 +383,22 @@ def dict_from_stream_config(stream, section):
         filters.append((dotted_name, filter_config))
     client_dict['filters'] = filters
 
+    # extract size policy config from size policy sections
+    size_policies = []
+    policy_sections = [n for n in config.sections()
+                       if n.startswith('%s_size_policy' % section)]
+    for policy_section in policy_sections:
+        policy_config = {}
+        for opt in config.options(policy_section):
+            if opt in ('provider', 'stream'):
+                # must be dotted name strings, don't convert
+                policy_config[opt] = config.get(policy_section, opt)
+            else:
+                policy_config[opt] = _convert(config.get(policy_section,
+                                                         opt))
+        size_policies.append((policy_config.pop('provider'), policy_config))
+    client_dict['size_policies'] = size_policies
+
     # extract plugin config from plugin sections
     plugins = {}
     plugin_sections = [n for n in config.sections()
@@ -248,6 +416,22 @@ def dict_from_stream_config(stream, section):
         plugins[plugin_name] = (provider, plugin_config)
     client_dict['plugins'] = plugins
 
+    # extract routes from route sections, in file order
+    routes = []
+    route_sections = [n for n in config.sections()
+                      if n.startswith("%s_route_" % section)]
+    for route_section in route_sections:
+        route_name = route_section.replace("%s_route_" % section, '')
+        route_config = {}
+        for opt in config.options(route_section):
+            if opt in ('types', 'loggers', 'encoder'):
+                # names, don't convert
+                route_config[opt] = config.get(route_section, opt)
+            else:
+                route_config[opt] = _convert(config.get(route_section, opt))
+        routes.append((route_name, route_config))
+    client_dict['routes'] = routes
+
     # extract hmac config from hmac sections
     hmc = {}
     hmac_section = "%s_hmac" % section
@@ -0,0 +1,218 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Decoders for heka framed byte streams.
+
+A heka frame is laid out as::
+
+    RECORD_SEPARATOR, header length (1 byte), Header,
+    UNIT_SEPARATOR, Message (Header.message_length bytes)
+
+`StreamDecoder` accepts arbitrarily sized chunks of such a stream (as
+read from a socket or a file), keeps them in a single `bytearray` and
+hands out each complete frame without slicing copies of the input.
+
+Compressed batches of frames (see `heka.streams.compress`) are expanded
+transparently.
+
+"""
+from __future__ import absolute_import
+from struct import unpack_from
+import zlib
+
+from heka.message import Header, Message
+from heka.message import MAX_BATCH_SIZE, MAX_MESSAGE_SIZE
+from heka.message import BATCH_SEPARATOR, RECORD_SEPARATOR, UNIT_SEPARATOR
+
+
+class StreamDecoder(object):
+    """Incremental heka frame parser.
+
+    Each call to `feed` returns an iterator over the frames completed by
+    the new data. Bytes which can't be part of a valid frame are
+    skipped, counted in `malformed` (once per contiguous run), and
+    parsing resumes at the next record separator.
+
+    The iterator returned by `feed` must be exhausted before `feed` is
+    called again.
+
+    """
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE, lazy=False,
+                 batches=True):
+        """Create a StreamDecoder
+
+        :param max_message_size: Frames claiming a longer message are
+                                 treated as corrupt.
+        :param lazy: If True yield `(header, payload)` pairs, `payload`
+                     being a `memoryview` of the serialized Message,
+                     instead of parsing it into a Message object. The
+                     view is only guaranteed valid until the next
+                     `feed`.
+        :param batches: If False compressed batches are treated as
+                        corrupt, as they are within a batch: expanding
+                        nested ones would take the decompressed size
+                        past `MAX_BATCH_SIZE`.
+
+        """
+        self.max_message_size = max_message_size
+        self.lazy = lazy
+        self.expand_batches = batches
+        self.malformed = 0
+        self.batches = 0
+        self._buf = bytearray()
+        self._pos = 0
+        self._in_garbage = False
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet consumed."""
+        return len(self._buf) - self._pos
+
+    def feed(self, data):
+        """Add `data` to the buffer and return an iterator over the
+        frames that are now complete.
+
+        """
+        self._compact()
+        self._buf.extend(data)
+        return self._frames()
+
+    def _compact(self):
+        if not self._pos:
+            return
+        try:
+            del self._buf[:self._pos]
+        except BufferError:
+            # a lazy payload view is still alive, leave the old buffer
+            # to it and carry on with a fresh one
+            self._buf = bytearray(memoryview(self._buf)[self._pos:])
+        self._pos = 0
+
+    def _skip(self):
+        # count each contiguous run of bad bytes only once
+        if not self._in_garbage:
+            self.malformed += 1
+            self._in_garbage = True
+
+    def _frames(self):
+        buf = self._buf
+        view = memoryview(buf)
+        end = len(buf)
+        pos = self._pos
+        try:
+            while pos < end:
+                if buf[pos] == BATCH_SEPARATOR:
+                    if not self.expand_batches:
+                        self._skip()
+                        pos += 1
+                        continue
+                    if end - pos < 5:
+                        break
+                    batch_end = pos + 5 + unpack_from('!I', buf, pos + 1)[0]
+                    if batch_end - pos > MAX_BATCH_SIZE:
+                        self._skip()
+                        pos += 1
+                        continue
+                    if batch_end > end:
+                        break
+                    frames = self._expand(view[pos + 5:batch_end])
+                    if frames is None:
+                        # skipped whole, so that frames in a rejected
+                        # (e.g. nested) batch aren't picked up
+                        self._skip()
+                        pos = batch_end
+                        continue
+                    self._in_garbage = False
+                    pos = batch_end
+                    self._pos = pos
+                    for frame in frames:
+                        yield frame
+                    continue
+                if buf[pos] != RECORD_SEPARATOR:
+                    self._skip()
+                    pos = _find_separator(buf, pos)
+                    if pos == -1:
+                        pos = end
+                        break
+                    continue
+                if end - pos < 2:
+                    break
+                header_end = pos + 2 + buf[pos + 1]
+                if header_end >= end:
+                    break
+                header = Header()
+                try:
+                    if buf[header_end] != UNIT_SEPARATOR:
+                        raise ValueError('missing unit separator')
+                    header.ParseFromString(view[pos + 2:header_end].tobytes())
+                    if header.message_length > self.max_message_size:
+                        raise ValueError('message too long')
+                except Exception:
+                    self._skip()
+                    pos += 1
+                    continue
+                msg_end = header_end + 1 + header.message_length
+                if msg_end > end:
+                    break
+                payload = view[header_end + 1:msg_end]
+                if not self.lazy:
+                    msg = Message()
+                    try:
+                        msg.ParseFromString(payload.tobytes())
+                    except Exception:
+                        self._skip()
+                        pos += 1
+                        continue
+                    payload = msg
+                self._in_garbage = False
+                pos = msg_end
+                self._pos = pos
+                yield header, payload
+        finally:
+            self._pos = pos
+            del view
+
+    def _expand(self, data):
+        # Decompress a batch into a list of frames, or None if corrupt.
+        # The decompressed size is bounded to keep bombs out.
+        decompressor = zlib.decompressobj()
+        try:
+            raw = decompressor.decompress(data.tobytes(), MAX_BATCH_SIZE)
+        except zlib.error:
+            return None
+        if decompressor.unconsumed_tail:
+            return None
+        inner = StreamDecoder(self.max_message_size, self.lazy,
+                              batches=False)
+        frames = list(inner.feed(raw))
+        if inner.malformed or inner.pending:
+            return None
+        self.batches += 1
+        return frames
+
+
+def _find_separator(buf, pos):
+    # the next byte that may start a frame or a batch
+    found = [idx for idx in (buf.find(chr(RECORD_SEPARATOR), pos),
+                             buf.find(chr(BATCH_SEPARATOR), pos))
+             if idx != -1]
+    return min(found) if found else -1
+
+
+def decode_frames(data, max_message_size=MAX_MESSAGE_SIZE, lazy=False):
+    """Decode all complete frames in `data` (e.g. a single datagram),
+    returning a list of `(header, message)` pairs.
+
+    """
+    decoder = StreamDecoder(max_message_size, lazy)
+    return list(decoder.feed(data))
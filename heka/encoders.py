@@ -17,15 +17,27 @@ from __future__ import absolute_import
 from hashlib import sha1, md5
 
 from heka.logging import LOGLEVEL_MAP
+from heka.util import json, uuid5_bytes
 from heka.message import Message, Header, Field
 from heka.message import UNIT_SEPARATOR, RECORD_SEPARATOR
 from heka.message import MAX_HEADER_SIZE
 from heka.message import InvalidMessage
 from heka.message import first_value
+from heka.fields import ARRAY, BYTES_TYPES
+from heka.fields import array_values, field_header, flatten_plan, is_array
+from heka.fields import as_bytes, utf8
+from heka.wire import WIRETYPE_VARINT, WIRETYPE_LENGTH_DELIMITED
+from heka.wire import length_delimited, signed_varint, tag, varint
 
 from struct import pack
+import array
+import base64
 import hmac
 import logging
+import sys
+import time
+import types
+import uuid
 
 
 HmacHashFunc = Header.HmacHashFunction
@@ -51,6 +63,41 @@ PB_FIELDMAP = {0: 'value_string',
                4: 'value_bool'}
 
 
+_MESSAGE_LENGTH_TAG = tag(1, WIRETYPE_VARINT)
+_HMAC_TAG = tag(6, WIRETYPE_LENGTH_DELIMITED)
+_RECORD_SEPARATOR = chr(RECORD_SEPARATOR)
+_UNIT_SEPARATOR = chr(UNIT_SEPARATOR)
+
+
+class HmacSigner(object):
+    """Precomputed signing state for one HMAC configuration.
+
+    Keying an HMAC hashes the padded key into the inner and outer digest
+    states. That only has to happen once per key, each message is then
+    signed starting from a `copy()` of the keyed prototype. The header
+    fields that are the same for every message (signer, key version and
+    hash function) are serialized up front as well.
+
+    """
+    def __init__(self, hmc):
+        self.hmc = hmc
+        hash_name = hmc['hash_function']
+        self._prototype = hmac.new(hmc['key'],
+                                   digestmod=HASHNAME_TO_FUNC[hash_name])
+        h = Header()
+        h.hmac_hash_function = HmacHashFunc.Value(hash_name)
+        h.hmac_signer = hmc['signer']
+        h.hmac_key_version = int(hmc['key_version'])
+        # the hmac field itself goes last, only its value varies
+        self.header_fields = (h.SerializePartialToString() + _HMAC_TAG +
+                              varint(self._prototype.digest_size))
+
+    def sign(self, payload):
+        mac = self._prototype.copy()
+        mac.update(payload)
+        return mac.digest()
+
+
 class NullEncoder(object):
     def __init__(self, hmc):
         pass
@@ -60,39 +107,88 @@ class NullEncoder(object):
 
 
 class BaseEncoder(object):
+    # encoded messages carry heka framing and can be concatenated
+    framed = True
+
+    _hmc = None
+    _signer = None
+
+    @property
+    def hmc(self):
+        """The HMAC configuration messages are signed with."""
+        return self._hmc
+
+    @hmc.setter
+    def hmc(self, hmc):
+        self.rotate_key(hmc)
+
+    def rotate_key(self, hmc):
+        """Start signing messages with a new HMAC configuration, or
+        stop signing if `hmc` is empty.
+
+        The new signer is swapped in with a single assignment, so each
+        message encoded concurrently is signed entirely with either the
+        old or the new key.
+
+        """
+        self._signer = HmacSigner(hmc) if hmc else None
+        self._hmc = hmc
+
     def compute_hmac(self, header, hmc, payload):
+        """Set the HMAC fields of `header` for `payload`, signed as
+        configured by `hmc`.
+
+        """
+        signer = self._signer
+        if signer is None or signer.hmc is not hmc:
+            signer = HmacSigner(hmc)
         header.hmac_signer = hmc['signer']
-        header.hmac_key_version = hmc['key_version']
+        header.hmac_key_version = int(hmc['key_version'])
         header.hmac_hash_function = HmacHashFunc.Value(hmc['hash_function'])
-        hash_func = HASHNAME_TO_FUNC[hmc['hash_function']]
-        header.hmac = hmac.new(hmc['key'], payload, hash_func).digest()
+        header.hmac = signer.sign(payload)
 
     def encode(self, msg):
         if not isinstance(msg, Message):
             raise RuntimeError('You must encode only Message objects')
 
-        payload = self.msg_to_payload(msg)
+        return self.frame(self.msg_to_payload(msg))
 
-        h = Header()
-        h.message_length = len(payload)
+    def encode_args(self, client, type, logger, severity, payload, fields,
+                    timestamp):
+        """Encode a message from already normalized `HekaClient.heka`
+        arguments, without building a Message. Only for encoders which
+        implement `args_to_payload`.
 
-        if self.hmc:
-            self.compute_hmac(h, self.hmc, payload)
+        """
+        return self.frame(self.args_to_payload(client, type, logger,
+                                               severity, payload, fields,
+                                               timestamp))
+
+    def frame(self, payload, span=None):
+        """Prefix a serialized message with its (signed) header.
+
+        :param span: `heka.tracing.Span` of a traced call, the signature
+                     is timed as its 'hmac' phase.
 
-        header_data = h.SerializeToString()
-        header_size = len(header_data)
+        """
+        # The header is built directly in wire format, it is laid out
+        # exactly as Header.SerializeToString() would
+        signer = self._signer
+        if signer is None:
+            header = _MESSAGE_LENGTH_TAG + varint(len(payload))
+        else:
+            signature = signer.sign(payload)
+            if span is not None:
+                span.mark('hmac')
+            header = ''.join((_MESSAGE_LENGTH_TAG, varint(len(payload)),
+                              signer.header_fields, signature))
+        header_size = len(header)
 
         if header_size > MAX_HEADER_SIZE:
             raise InvalidMessage("Header is too long")
 
-        pack_fmt = "!bb%dsb%ds" % (header_size, len(payload))
-        byte_data = pack(pack_fmt,
-                         RECORD_SEPARATOR,
-                         header_size,
-                         header_data,
-                         UNIT_SEPARATOR,
-                         payload)
-        return byte_data
+        return ''.join((_RECORD_SEPARATOR, chr(header_size), header,
+                        _UNIT_SEPARATOR, payload))
 
 
 class StdlibPayloadEncoder(BaseEncoder):
@@ -100,6 +196,8 @@ class StdlibPayloadEncoder(BaseEncoder):
     If an incoming message does not have a 'loglevel' set,
     we just use a default of logging.INFO
     """
+    framed = False
+
     def __init__(self, hmc=None):
         self.hmc = hmc
 
@@ -134,15 +232,362 @@ class StdlibPayloadEncoder(BaseEncoder):
         return self.msg_to_payload(msg)
 
 
+_UUID_PREFIX = tag(1, WIRETYPE_LENGTH_DELIMITED) + varint(16)
+_TIMESTAMP_TAG = tag(2, WIRETYPE_VARINT)
+_SEVERITY_TAG = tag(5, WIRETYPE_VARINT)
+_FIELD_TAG = tag(10, WIRETYPE_LENGTH_DELIMITED)
+# Field value headers: value_string, value_bytes, and the packed
+# value_integer and value_double
+_STRING_VALUE_TAG = tag(4, WIRETYPE_LENGTH_DELIMITED)
+_BYTES_VALUE_TAG = tag(5, WIRETYPE_LENGTH_DELIMITED)
+_INTEGER_VALUE_TAG = tag(6, WIRETYPE_LENGTH_DELIMITED)
+_DOUBLE_VALUE_TAG = tag(7, WIRETYPE_LENGTH_DELIMITED)
+_DOUBLE_VALUE = _DOUBLE_VALUE_TAG + varint(8)
+
+
+def _string_value(value):
+    value = utf8(value)
+    return ''.join((_STRING_VALUE_TAG, varint(len(value)), value))
+
+
+def _integer_value(value):
+    value = signed_varint(value)
+    return ''.join((_INTEGER_VALUE_TAG, varint(len(value)), value))
+
+
+def _double_value(value):
+    return _DOUBLE_VALUE + pack('<d', value)
+
+
+def _bytes_value(value):
+    value = as_bytes(value)
+    return ''.join((_BYTES_VALUE_TAG, varint(len(value)), value))
+
+
+_WIRE_VALUE_ENCODERS = {Field.STRING: _string_value,
+                        Field.BYTES: _bytes_value,
+                        Field.INTEGER: _integer_value,
+                        Field.DOUBLE: _double_value,
+                        }
+
+
+def _append_field(parts, wire, value_type, value):
+    # Append the serialized Field, `wire` being its header
+    if value_type == Field.BYTES:
+        # the data goes in as is, not copied into a value string first
+        data = as_bytes(value)
+        value = _BYTES_VALUE_TAG + varint(len(data))
+        parts.append(_FIELD_TAG)
+        parts.append(varint(len(wire) + len(value) + len(data)))
+        parts.append(wire)
+        parts.append(value)
+        parts.append(data)
+        return
+    value = _WIRE_VALUE_ENCODERS[value_type](value)
+    parts.append(_FIELD_TAG)
+    parts.append(varint(len(wire) + len(value)))
+    parts.append(wire)
+    parts.append(value)
+
+
+def _string_values(values):
+    return ''.join(map(_string_value, values))
+
+
+def _integer_values(values):
+    # packed
+    if not len(values):
+        return ''
+    data = ''.join(map(signed_varint, values))
+    return ''.join((_INTEGER_VALUE_TAG, varint(len(data)), data))
+
+
+def _double_values(values):
+    # packed, `values` is an array('d')
+    if not len(values):
+        return ''
+    if sys.byteorder != 'little':
+        values = array.array('d', values)
+        values.byteswap()
+    data = values.tostring()
+    return ''.join((_DOUBLE_VALUE_TAG, varint(len(data)), data))
+
+
+_WIRE_ARRAY_ENCODERS = {Field.STRING: _string_values,
+                        Field.BYTES: lambda values: ''.join(map(_bytes_value,
+                                                                values)),
+                        Field.INTEGER: _integer_values,
+                        Field.DOUBLE: _double_values,
+                        }
+
+
 class ProtobufEncoder(BaseEncoder):
 
     def __init__(self, hmc=None):
         self.hmc = hmc
+        self._envelope = (None, None)
 
     def msg_to_payload(self, msg):
         return msg.SerializeToString()
 
+    def _envelope_wire(self, env_version, pid, hostname):
+        # the client wide fields, which hardly ever change
+        key, envelope = self._envelope
+        if key != (env_version, pid, hostname):
+            envelope = ''.join((length_delimited(7, utf8(env_version)),
+                                tag(8, WIRETYPE_VARINT), signed_varint(pid),
+                                length_delimited(9, utf8(hostname))))
+            self._envelope = ((env_version, pid, hostname), envelope)
+        return envelope
+
+    def _fields_wire(self, parts, fields, prefix=None):
+        for key, vtype, name, value_type, attr, wire in flatten_plan(fields,
+                                                                     prefix):
+            if value_type is None:
+                self._fields_wire(parts, fields[key], name)
+                continue
+            elif value_type == ARRAY:
+                value_type, values = array_values(fields[key])
+                wire = field_header(name, value_type)
+                value = _WIRE_ARRAY_ENCODERS[value_type](values)
+                parts.append(_FIELD_TAG)
+                parts.append(varint(len(wire) + len(value)))
+                parts.append(wire)
+                parts.append(value)
+            else:
+                _append_field(parts, wire, value_type, fields[key])
+        return parts
+
+    def _message_wire(self, client, type_wire, logger_wire, severity,
+                      payload, timestamp, fields_parts):
+        body = ''.join([_TIMESTAMP_TAG,
+                        signed_varint(int((timestamp or time.time()) *
+                                          1000000000)),
+                        type_wire, logger_wire,
+                        _SEVERITY_TAG, signed_varint(severity),
+                        length_delimited(6, utf8(payload)),
+                        self._envelope_wire(client.env_version, client.pid,
+                                            client.hostname)] +
+                       fields_parts)
+        return _UUID_PREFIX + uuid5_bytes(body) + body
+
+    def args_to_payload(self, client, type, logger, severity, payload,
+                        fields, timestamp):
+        """Serialize a message from already normalized `HekaClient.heka`
+        arguments, the same as the client's Message would be, except for
+        the uuid which is derived from the rest of the serialized
+        message.
+
+        """
+        return self._message_wire(client, length_delimited(3, utf8(type)),
+                                  length_delimited(4, utf8(logger)),
+                                  severity, payload, timestamp,
+                                  self._fields_wire([], fields))
+
+    def compile_args(self, type, logger, specs):
+        """Return a serializer for messages of `type` from `logger` with
+        a fixed set of fields, given as `(name, value_type)` pairs.
+
+        The serializer is called as `serialize(client, severity, payload,
+        values, timestamp)`, `values` being the field values in `specs`
+        order, each already of the Python type matching its value type.
+        It returns the same bytes `args_to_payload` would.
+
+        """
+        type_wire = length_delimited(3, utf8(type))
+        logger_wire = length_delimited(4, utf8(logger))
+        fields = [(field_header(name, value_type), value_type)
+                  for name, value_type in specs]
+        message_wire = self._message_wire
+
+        def serialize(client, severity, payload, values, timestamp):
+            parts = []
+            for (wire, value_type), value in zip(fields, values):
+                _append_field(parts, wire, value_type, value)
+            return message_wire(client, type_wire, logger_wire, severity,
+                                payload, timestamp, parts)
+        return serialize
+
     def decode(self, bytes):
         msg = Message()
         msg.ParseFromString(bytes)
         return msg
+
+
+_quote = json.encoder.encode_basestring_ascii
+
+
+def _json_float(value):
+    # same spelling as json.dumps
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == -float('inf'):
+        return '-Infinity'
+    return repr(value)
+
+
+def _json_bool(value):
+    return 'true' if value else 'false'
+
+
+def _json_bytes(value):
+    return '"%s"' % base64.b64encode(as_bytes(value))
+
+
+# Field.value_type -> (repeated value attribute, value encoder)
+_JSON_VALUE_ENCODERS = {Field.STRING: ('value_string', _quote),
+                        Field.BYTES: ('value_bytes', _json_bytes),
+                        Field.INTEGER: ('value_integer', str),
+                        Field.DOUBLE: ('value_double', _json_float),
+                        Field.BOOL: ('value_bool', _json_bool),
+                        }
+
+def _json_array(value):
+    # as msg_to_payload writes repeated values
+    value_type, values = array_values(value)
+    if value_type == Field.INTEGER:
+        # may hold bools
+        value_encoder = '%d'.__mod__
+    else:
+        value_encoder = _JSON_VALUE_ENCODERS[value_type][1]
+    if len(values) == 1:
+        return value_encoder(values[0])
+    return '[%s]' % ','.join(map(value_encoder, values))
+
+
+# emit argument type -> value encoder, types as accepted by
+# HekaClient._flatten_fields. bools are subclasses of int and are sent
+# as integers there, so they are here too.
+_JSON_ARG_ENCODERS = {int: str,
+                      bool: lambda value: '1' if value else '0',
+                      float: _json_float,
+                      str: _quote,
+                      unicode: _quote,
+                      }
+_JSON_ARG_ENCODERS.update((bytes_type, _json_bytes)
+                          for bytes_type in BYTES_TYPES)
+
+
+class JsonEncoder(BaseEncoder):
+    """Encodes messages as JSON objects, with the usual heka framing
+    and optional HMAC signature::
+
+        {"uuid": "<hyphenated uuid>", "timestamp": <ns>, "type": ...,
+         "logger": ..., "severity": ..., "payload": ...,
+         "env_version": ..., "pid": ..., "hostname": ...,
+         "fields": {"<dotted name>": <value or list of values>}}
+
+    Nothing in the header says the message is JSON, consumers have to
+    know what to expect from a stream.
+
+    A HekaClient without filters hands the `heka` arguments straight to
+    `args_to_payload`, which writes the JSON without building a protobuf
+    Message first.
+
+    """
+    # distinct field names whose encoded JSON key is cached
+    max_cached_names = 1000
+
+    def __init__(self, hmc=None):
+        self.hmc = hmc
+        self._names = {}
+        self._envelope = (None, None)
+
+    def _envelope_json(self, env_version, pid, hostname):
+        # the client wide values, which hardly ever change
+        key, envelope = self._envelope
+        if key != (env_version, pid, hostname):
+            envelope = ''.join((',"env_version":', _quote(env_version),
+                                ',"pid":', str(pid),
+                                ',"hostname":', _quote(hostname),
+                                ',"fields":{'))
+            self._envelope = ((env_version, pid, hostname), envelope)
+        return envelope
+
+    def _name_json(self, name):
+        encoded = self._names.get(name)
+        if encoded is None:
+            if len(self._names) >= self.max_cached_names:
+                self._names.clear()
+            encoded = self._names[name] = _quote(name) + ':'
+        return encoded
+
+    def _fields_json(self, parts, field_map, prefix=None):
+        for k, v in field_map.items():
+            full_name = '%s.%s' % (prefix, k) if prefix else k
+            value_encoder = _JSON_ARG_ENCODERS.get(type(v))
+            if value_encoder is None:
+                if v is None:
+                    raise ValueError("None is not allowed for field "
+                                     "values.  [%s]" % full_name)
+                elif isinstance(v, types.DictType):
+                    self._fields_json(parts, v, prefix=full_name)
+                    continue
+                elif isinstance(v, types.IntType):
+                    value_encoder = str
+                elif isinstance(v, types.FloatType):
+                    value_encoder = _json_float
+                elif isinstance(v, basestring):
+                    value_encoder = _quote
+                elif isinstance(v, BYTES_TYPES):
+                    value_encoder = _json_bytes
+                elif is_array(v):
+                    value_encoder = _json_array
+                else:
+                    raise ValueError("Unexpected value type : [%s][%s]" %
+                                     (type(v), v))
+            if parts:
+                parts.append(',')
+            parts.append(self._name_json(full_name))
+            parts.append(value_encoder(v))
+        return parts
+
+    def _body(self, timestamp, type, logger, severity, payload, envelope,
+              fields_parts):
+        return ''.join(['"timestamp":', str(timestamp),
+                        ',"type":', _quote(type),
+                        ',"logger":', _quote(logger),
+                        ',"severity":', '%d' % severity,
+                        ',"payload":', _quote(payload),
+                        envelope] + fields_parts + ['}}'])
+
+    def args_to_payload(self, client, type, logger, severity, payload,
+                        fields, timestamp):
+        """Serialize a message from already normalized `HekaClient.heka`
+        arguments. The uuid is derived from the rest of the JSON, the
+        same way the client derives it from the rest of a Message.
+
+        """
+        fields_parts = self._fields_json([], fields)
+        body = self._body(int((timestamp or time.time()) * 1000000000),
+                          type, logger, severity, payload,
+                          self._envelope_json(client.env_version,
+                                              client.pid, client.hostname),
+                          fields_parts)
+        msg_uuid = uuid.uuid5(uuid.NAMESPACE_OID, body)
+        return '{"uuid":"%s",%s' % (msg_uuid, body)
+
+    def msg_to_payload(self, msg):
+        fields_parts = []
+        for f in msg.fields:
+            attr, value_encoder = _JSON_VALUE_ENCODERS[f.value_type]
+            values = getattr(f, attr)
+            if fields_parts:
+                fields_parts.append(',')
+            fields_parts.append(self._name_json(f.name))
+            if len(values) == 1:
+                fields_parts.append(value_encoder(values[0]))
+            else:
+                fields_parts.append('[%s]' % ','.join(value_encoder(v)
+                                                      for v in values))
+        body = self._body(msg.timestamp, msg.type, msg.logger, msg.severity,
+                          msg.payload,
+                          self._envelope_json(msg.env_version, msg.pid,
+                                              msg.hostname),
+                          fields_parts)
+        return '{"uuid":"%s",%s' % (uuid.UUID(bytes=msg.uuid), body)
+
+    def decode(self, bytes):
+        return json.loads(bytes)
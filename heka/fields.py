@@ -0,0 +1,262 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Flatten plans for `heka` fields dictionaries.
+
+Nested fields dictionaries are flattened into message fields with
+dotted names. Call sites tend to pass the same shape of dictionary every
+time, so the result of walking one (the dotted names, the value types
+and the field headers in wire format) is kept as a plan keyed by the
+dictionary's keys. Encoding a dictionary of a known shape then only has
+to check the value types and write the values.
+
+A plan is a list of `(key, type, name, value_type, attr, wire)` tuples:
+
+key
+  Key in the dictionary.
+type
+  Exact Python type of the value the plan was built for.
+name
+  Dotted field name.
+value_type
+  `Field.ValueType`, None for a nested dictionary, which has a plan of
+  its own with `name` as the prefix, or `ARRAY` for a sequence, whose
+  value type depends on its elements (see `array_values`).
+attr
+  The Field attribute holding the value, e.g. `value_integer`.
+wire
+  The serialized Field up to its value (name, value type and empty
+  representation).
+
+"""
+from __future__ import absolute_import
+import __builtin__
+import array
+import types
+
+from heka.message import Field
+from heka.wire import WIRETYPE_VARINT
+from heka.wire import length_delimited, tag, varint
+
+# distinct field shapes kept, the cache is emptied when it grows beyond
+MAX_PLANS = 1000
+
+VALUE_ATTRS = {Field.STRING: 'value_string',
+               Field.BYTES: 'value_bytes',
+               Field.INTEGER: 'value_integer',
+               Field.DOUBLE: 'value_double',
+               Field.BOOL: 'value_bool',
+               }
+
+# plan value type of sequences
+ARRAY = -1
+
+_INTEGER_TYPES = frozenset([int, bool])
+_DOUBLE_TYPES = frozenset([int, bool, float])
+_STRING_TYPES = frozenset([str, unicode])
+
+
+class _NoMemoryView(object):
+    """Stands in for `memoryview` on Python 2.6, which doesn't have it."""
+
+
+MEMORYVIEW = getattr(__builtin__, 'memoryview', _NoMemoryView)
+# Binary data for BYTES fields. Python 2 `str` can't be told apart from
+# text, it stays a STRING
+BYTES_TYPES = (bytearray, MEMORYVIEW, buffer)
+_ARRAY_TYPES = (list, tuple, array.array)
+
+_plans = {}
+
+
+def utf8(value):
+    """Return `value` as UTF-8 bytes, checking that byte strings are
+    valid UTF-8 the way protobuf string fields do.
+
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    value.decode('utf-8')
+    return value
+
+
+def as_bytes(value):
+    """Return the bytes of a BYTES field value (see `BYTES_TYPES`), or
+    of a `str`.
+
+    """
+    if isinstance(value, MEMORYVIEW):
+        return value.tobytes()
+    return str(value)
+
+
+def value_type_of(python_type):
+    """Return the `Field.ValueType` values of `python_type` are sent as.
+    Raises ValueError for types that can't be sent.
+
+    """
+    if issubclass(python_type, types.IntType):
+        return Field.INTEGER
+    elif issubclass(python_type, types.FloatType):
+        return Field.DOUBLE
+    elif issubclass(python_type, basestring):
+        return Field.STRING
+    elif issubclass(python_type, BYTES_TYPES):
+        return Field.BYTES
+    raise ValueError("Unexpected value type : [%s]" % python_type)
+
+
+def is_array(value):
+    """Return True if `value` is sent as a repeated field: a list, a
+    tuple, an `array.array` or a one dimensional numpy array.
+
+    """
+    return (isinstance(value, _ARRAY_TYPES)
+            or (hasattr(value, 'dtype') and getattr(value, 'ndim', 0) == 1))
+
+
+def array_values(value):
+    """Return the `Field.ValueType` of the sequence `value` and its
+    values in a form the encoders take. Doubles come back as an
+    `array.array('d')`, so they can be written without touching each
+    element. Raises ValueError if the elements aren't all numbers or
+    all strings.
+
+    Integers (or bools) make an INTEGER field, numbers with at least one
+    float a DOUBLE field, strings a STRING field and binary data (see
+    `BYTES_TYPES`) a BYTES field. An empty sequence is an INTEGER field
+    without values.
+
+    """
+    if isinstance(value, array.array):
+        if value.typecode == 'd':
+            return Field.DOUBLE, value
+        elif value.typecode == 'f':
+            return Field.DOUBLE, array.array('d', value)
+        elif value.typecode in 'bBhHiIlL':
+            return Field.INTEGER, value
+    elif hasattr(value, 'dtype'):
+        # numpy, without importing it
+        if value.dtype.kind == 'f':
+            return Field.DOUBLE, array.array('d',
+                                             value.astype('d').tostring())
+        elif value.dtype.kind in 'biu':
+            return Field.INTEGER, value.tolist()
+    else:
+        value_types = set(map(type, value))
+        if value_types <= _INTEGER_TYPES:
+            return Field.INTEGER, value
+        elif value_types <= _DOUBLE_TYPES:
+            return Field.DOUBLE, array.array('d', value)
+        elif value_types <= _STRING_TYPES:
+            return Field.STRING, value
+        elif all(isinstance(v, BYTES_TYPES) for v in value):
+            return Field.BYTES, map(as_bytes, value)
+    raise ValueError("Unexpected array value : [%s][%r]" %
+                     (type(value), value))
+
+
+def field_header(name, value_type):
+    """Return the serialized Field up to its value."""
+    return (length_delimited(1, utf8(name)) +
+            tag(2, WIRETYPE_VARINT) + varint(value_type) +
+            length_delimited(3, ''))
+
+
+def build_plan(fields, prefix=None):
+    """Walk `fields`, returning its plan. Raises ValueError for values
+    that can't be sent.
+
+    """
+    plan = []
+    for k, v in fields.items():
+        if prefix:
+            name = "%s.%s" % (prefix, k)
+        else:
+            name = k
+        if not isinstance(name, basestring):
+            raise TypeError("Field names must be strings: [%r]" % (name,))
+
+        if v is None:
+            raise ValueError("None is not allowed for field values.  [%s]"
+                             % name)
+        elif isinstance(v, types.IntType):
+            value_type = Field.INTEGER
+        elif isinstance(v, types.FloatType):
+            value_type = Field.DOUBLE
+        elif isinstance(v, basestring):
+            value_type = Field.STRING
+        elif isinstance(v, BYTES_TYPES):
+            value_type = Field.BYTES
+        elif isinstance(v, types.DictType):
+            plan.append((k, type(v), name, None, None, None))
+            continue
+        elif is_array(v):
+            plan.append((k, type(v), name, ARRAY, None, None))
+            continue
+        else:
+            raise ValueError("Unexpected value type : [%s][%s]" %
+                             (type(v), v))
+        plan.append((k, type(v), name, value_type, VALUE_ATTRS[value_type],
+                     field_header(name, value_type)))
+    return plan
+
+
+def flatten_plan(fields, prefix=None):
+    """Return the plan for `fields`, from the cache if its keys and value
+    types have been seen before.
+
+    """
+    cache_key = (prefix, tuple(fields))
+    plan = _plans.get(cache_key)
+    if plan is not None:
+        for entry in plan:
+            if type(fields[entry[0]]) is not entry[1]:
+                # same keys, different types: walk it again
+                plan = None
+                break
+    if plan is None:
+        plan = build_plan(fields, prefix)
+        if len(_plans) >= MAX_PLANS:
+            _plans.clear()
+        _plans[cache_key] = plan
+    return plan
+
+
+def copy_fields(fields):
+    """Return a copy of the `heka` fields dictionary `fields`, for
+    messages encoded after the caller may have changed it. Nested
+    dictionaries, sequences and mutable values (binary data, arrays)
+    are copied as well.
+
+    """
+    copied = {}
+    for k, v in fields.iteritems():
+        copied[k] = _copy_value(v)
+    return copied
+
+
+def _copy_value(value):
+    if isinstance(value, dict):
+        return copy_fields(value)
+    if isinstance(value, (list, tuple)):
+        return [_copy_value(v) for v in value]
+    if isinstance(value, BYTES_TYPES):
+        # a view may be of mutable data, the copy is still BYTES
+        return bytearray(value)
+    if isinstance(value, array.array):
+        return array.array(value.typecode, value)
+    if hasattr(value, 'dtype'):
+        # numpy
+        return value.copy()
+    return value
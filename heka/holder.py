@@ -8,10 +8,14 @@
 #   Victor Ng (vng@mozilla.com)
 #
 # ***** END LICENSE BLOCK *****
+import functools
 import threading
 
 from heka.client import HekaClient
 from heka.config import client_from_dict_config
+from heka.pipeline import RETIRE_GRACE, close_later, components
+from heka.streams.routing import RoutingStream
+from heka.util import json
 
 
 class HekaClientHolder(object):
@@ -20,11 +24,25 @@ class HekaClientHolder(object):
 
     Also holds any required process-wide config data.
 
+    Clients configured through the holder share streams with the same
+    configuration, and background senders if their whole configuration
+    is the same but for the logger. A shared object is closed once the
+    last client using it is deleted or configured not to, in the latter
+    case after `retire_grace` seconds so that messages already on their
+    way can still make it.
+
     """
+    retire_grace = RETIRE_GRACE
+
     def __init__(self):
         self._clients = dict()
         self._default_clientname = None
         self.lock = threading.Lock()  # write lock for adding clients
+        # (kind, config json) -> [object, names of the clients using it]
+        self._shared = dict()
+        # client name -> keys of the shared objects it uses
+        self._client_shares = dict()
+        self._shared_lock = threading.Lock()
 
     def get_client(self, name):
         """Return the specified HekaClient, creating it if it doesn't
@@ -59,6 +77,95 @@ class HekaClientHolder(object):
 
         return client
 
+    def configure_client(self, name, config_dict):
+        """Configure the specified HekaClient, creating it if it doesn't
+        exist, with streams and senders shared with the other clients.
+
+        :param name: String token identifying the client, also used as
+                     the client's `logger` value. `ValueError` will be
+                     raised if the config has a different `logger`.
+        :param config_dict: Configuration dictionary, see
+                            `heka.config.client_from_dict_config`.
+
+        """
+        logger = config_dict.get('logger')
+        if logger and logger != name:
+            raise ValueError('Config `logger` value must either match `name` '
+                             'argument or be left blank.')
+        if not logger:
+            config_dict['logger'] = name
+        client = self.get_client(name)
+        with self._shared_lock:
+            keys = []
+
+            def acquire(kind, config, factory):
+                key = (kind, json.dumps(config, sort_keys=True))
+                shared = self._shared.get(key)
+                if shared is None:
+                    shared = self._shared[key] = [factory(), set()]
+                shared[1].add(name)
+                keys.append(key)
+                return shared[0]
+
+            old_keys = self._client_shares.get(name, ())
+            # parts replaced by `reconfigure` are released the same way
+            retire = functools.partial(self._retire, name)
+            try:
+                client = client_from_dict_config(config_dict, client=client,
+                                                 acquire=acquire,
+                                                 retire=retire)
+            except:
+                self._release(name, client,
+                              [key for key in keys if key not in old_keys])
+                raise
+            self._client_shares[name] = keys
+            self._release(name, client,
+                          [key for key in old_keys if key not in keys],
+                          self.retire_grace)
+        return client
+
+    def _retire(self, name, old, new, grace):
+        # Retire the pipeline `old` of client `name`, replaced by `new`:
+        # shared objects it no longer uses are released, others closed
+        with self._shared_lock:
+            in_use = set(id(obj) for obj in components(new))
+            shared = dict((id(obj), key)
+                          for key, (obj, names) in self._shared.iteritems())
+            keys = self._client_shares.get(name, [])
+            released = []
+            unshared = []
+            for obj in _parts(old):
+                if id(obj) in in_use:
+                    continue
+                key = shared.get(id(obj))
+                if key is None:
+                    if not isinstance(obj, RoutingStream):
+                        # its route streams are parts of their own
+                        unshared.append(obj)
+                elif key in keys:
+                    released.append(key)
+            if released:
+                self._client_shares[name] = [key for key in keys
+                                             if key not in released]
+                self._release(name, self._clients.get(name), released,
+                              grace)
+            close_later(unshared, grace)
+
+    def _release(self, name, client, keys, grace=0):
+        # senders first, they may still write to the streams
+        unused = []
+        for key in sorted(set(keys), key=lambda key: key[0] != 'sender'):
+            shared = self._shared[key]
+            obj, names = shared
+            names.discard(name)
+            if not names:
+                del self._shared[key]
+                unused.append(obj)
+            elif key[0] == 'sender' and obj.client is client:
+                # deliver through one of the remaining clients
+                obj.attach(self._clients[iter(names).next()])
+        close_later(unused, grace)
+
     def set_client(self, name, client):
         """Provides a way to add a pre-existing HekaClient to the ones
         stored in the holder.
@@ -91,12 +198,24 @@ class HekaClientHolder(object):
         :param name: Name of the client object to delete.
 
         """
-        if name in self._clients:
-            del self._clients[name]
+        with self._shared_lock:
+            client = self._clients.get(name)
+            if name in self._clients:
+                del self._clients[name]
+            self._release(name, client, self._client_shares.pop(name, ()))
         if self._default_clientname == name:
             self._default_clientname = None
 
 
+def _parts(pipeline):
+    # the sender and streams of `pipeline`, senders first
+    parts = [pipeline.sender, pipeline.stream]
+    if isinstance(pipeline.stream, RoutingStream):
+        parts.extend(route.stream for route in
+                     pipeline.stream.routes + [pipeline.stream.default])
+    return [obj for obj in parts if obj is not None]
+
+
 CLIENT_HOLDER = HekaClientHolder()
 
 
@@ -117,11 +236,5 @@ def get_client(name, config_dict=None):
     client = CLIENT_HOLDER.get_client(name)
 
     if config_dict:
-        logger = config_dict.get('logger')
-        if logger and logger != name:
-            raise ValueError('Config `logger` value must either match `name` '
-                             'argument or be left blank.')
-        if not logger:
-            config_dict['logger'] = name
-        client = client_from_dict_config(config_dict, client=client)
+        client = CLIENT_HOLDER.configure_client(name, config_dict)
     return client
@@ -0,0 +1,145 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Size policies for messages with oversized payloads.
+
+hekad won't accept a message longer than `MAX_MESSAGE_SIZE`, and over UDP
+a larger message couldn't be sent as a single datagram anyway. Before
+encoding, a HekaClient with a `size_policy` hands every message whose
+payload is longer than `max_payload_size` UTF-8 bytes to the policy,
+which returns the messages to send in its place.
+
+A size policy is a callable accepting the Message and the payload size
+limit and returning a sequence of Messages, each with a payload within
+the limit. Policies are configured the same way as filters, through
+provider functions.
+
+"""
+from __future__ import absolute_import
+import uuid
+import zlib
+
+from heka.message import Field
+from heka.message import MAX_MESSAGE_SIZE
+
+# leave room for the envelope and the fields
+MAX_PAYLOAD_SIZE = MAX_MESSAGE_SIZE - 4096
+
+
+def oversized(payload, limit):
+    """Return True if `payload` is more than `limit` bytes as UTF-8."""
+    if len(payload) * 4 <= limit:
+        # can't be, even if all characters took 4 bytes
+        return False
+    if isinstance(payload, unicode):
+        return len(payload.encode('utf-8')) > limit
+    return len(payload) > limit
+
+
+def _utf8(payload):
+    if isinstance(payload, unicode):
+        return payload.encode('utf-8')
+    return payload
+
+
+def _split_point(data, limit):
+    # Largest cut not beyond `limit` that doesn't split a multibyte
+    # UTF-8 sequence
+    end = limit
+    while end > 0 and end < len(data) and (ord(data[end]) & 0xc0) == 0x80:
+        end -= 1
+    return end
+
+
+def _add_field(msg, name, value_type, value, representation=''):
+    f = msg.fields.add()
+    f.name = name
+    f.representation = representation
+    f.value_type = value_type
+    if value_type == Field.INTEGER:
+        f.value_integer.append(value)
+    elif value_type == Field.BYTES:
+        f.value_bytes.append(value)
+    else:
+        f.value_string.append(value)
+
+
+def truncate_policy_provider(marker='truncated'):
+    """Truncate the payload to the limit. The original payload size in
+    bytes is recorded in the `marker` integer field.
+
+    """
+    def truncate_policy(msg, limit):
+        data = _utf8(msg.payload)
+        msg.payload = data[:_split_point(data, limit)].decode('utf-8')
+        _add_field(msg, marker, Field.INTEGER, len(data))
+        return [msg]
+    return truncate_policy
+
+
+def compress_policy_provider(level=6, name='payload', marker='truncated'):
+    """Move the payload, zlib compressed, into the `name` bytes field,
+    with `zlib` as its representation, leaving the payload itself empty.
+    If even the compressed payload is too big it is truncated, as by
+    `truncate_policy_provider(marker)`, instead.
+
+    """
+    truncate_policy = truncate_policy_provider(marker)
+
+    def compress_policy(msg, limit):
+        compressed = zlib.compress(_utf8(msg.payload), int(level))
+        if len(compressed) > limit:
+            return truncate_policy(msg, limit)
+        msg.payload = ''
+        _add_field(msg, name, Field.BYTES, compressed, 'zlib')
+        return [msg]
+    return compress_policy
+
+
+def chunk_policy_provider(prefix='chunk'):
+    """Split the payload across as many messages as needed. Each chunk
+    is a copy of the original message with part of the payload and the
+    fields:
+
+    <prefix>.uuid
+      The hex uuid of the original message, shared by all chunks.
+    <prefix>.index
+      Position of the chunk, starting at 0.
+    <prefix>.count
+      Total number of chunks.
+
+    Each chunk gets its own uuid, derived from the original one.
+
+    """
+    def chunk_policy(msg, limit):
+        data = _utf8(msg.payload)
+        pieces = []
+        while data:
+            end = _split_point(data, limit) or limit
+            pieces.append(data[:end])
+            data = data[end:]
+        original_uuid = msg.uuid
+        chunks = []
+        for index, piece in enumerate(pieces):
+            chunk = type(msg)()
+            chunk.CopyFrom(msg)
+            chunk.payload = piece.decode('utf-8')
+            chunk.uuid = uuid.uuid5(uuid.NAMESPACE_OID,
+                                    '%s:%d' % (original_uuid, index)).bytes
+            _add_field(chunk, prefix + '.uuid', Field.STRING,
+                       original_uuid.encode('hex'))
+            _add_field(chunk, prefix + '.index', Field.INTEGER, index)
+            _add_field(chunk, prefix + '.count', Field.INTEGER, len(pieces))
+            chunks.append(chunk)
+        return chunks
+    return chunk_policy
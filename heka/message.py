@@ -22,6 +22,11 @@ MAX_HEADER_SIZE = 255
 MAX_MESSAGE_SIZE = 64 * 1024
 RECORD_SEPARATOR = 0x1e
 UNIT_SEPARATOR = 0x1f
+# starts a zlib compressed batch of frames, see heka.streams.compress
+BATCH_SEPARATOR = 0x1d
+MAX_BATCH_SIZE = 1024 * 1024
+# largest UDP payload over IPv4
+MAX_DATAGRAM_SIZE = 65507
 UUID_SIZE = 16
 
 
@@ -0,0 +1,154 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""The delivery configuration of a HekaClient, swapped as a whole.
+
+Everything that decides what happens to a message once `heka` has been
+called lives in a `Pipeline`: the stream, encoder, filters, disabled
+timers, sampler, tracer, size policy and background sender. A client
+holds a single reference to its current pipeline and each message is
+handled by the pipeline it started with, so replacing it, e.g. with
+`HekaClient.reconfigure`, never exposes half of a new configuration.
+
+Pipelines aren't changed once built, other than through the legacy
+mutable `disabled_timers` set and `filters` list.
+
+"""
+from __future__ import absolute_import
+import threading
+import time
+
+from heka.limits import MAX_PAYLOAD_SIZE
+from heka.streams.routing import RoutingStream
+
+# seconds given to messages already handed to a replaced pipeline
+# before its stream and sender are closed
+RETIRE_GRACE = 1.0
+
+
+class Pipeline(object):
+    """Stream, encoder and plugins delivering a client's messages."""
+    __slots__ = ('stream', 'encoder', 'filters', 'disabled_timers',
+                 'sampler', 'tracer', 'size_policy', 'max_payload_size',
+                 'reuse_messages', 'sender', 'router')
+
+    def __init__(self, stream=None, encoder=None, filters=(),
+                 disabled_timers=(), sampler=None, tracer=None,
+                 size_policy=None, max_payload_size=MAX_PAYLOAD_SIZE,
+                 reuse_messages=False, sender=None):
+        """Create a Pipeline, see `HekaClient` for the arguments."""
+        self.stream = stream
+        self.encoder = encoder
+        self.filters = filters
+        self.disabled_timers = disabled_timers
+        self.sampler = sampler
+        self.tracer = tracer
+        self.size_policy = size_policy
+        self.max_payload_size = max_payload_size
+        self.reuse_messages = reuse_messages
+        self.sender = sender
+        # a `heka.streams.RoutingStream` picks the streams, and
+        # encoders, of each message
+        self.router = (stream.routes_for
+                       if isinstance(stream, RoutingStream) else None)
+
+    def replace(self, **changes):
+        """Return a copy of the pipeline with some attributes changed."""
+        kwargs = dict((name, getattr(self, name))
+                      for name in self.__slots__ if name != 'router')
+        kwargs.update(changes)
+        return Pipeline(**kwargs)
+
+
+def components(pipeline, depth=3):
+    """Return the sender and stream of `pipeline` and the objects its
+    stream holds on to, up to `depth` attributes or containers away:
+    e.g. the stream a wrapper writes to, or the streams of the routes of
+    a `RoutingStream`.
+
+    """
+    found = [obj for obj in (pipeline.sender, pipeline.stream)
+             if obj is not None]
+    seen = set(id(obj) for obj in found)
+    level = [pipeline.stream]
+    for i in range(depth):
+        next_level = []
+        for obj in level:
+            if isinstance(obj, (list, tuple, set, frozenset)):
+                values = obj
+            elif isinstance(obj, dict):
+                values = obj.values()
+            else:
+                values = getattr(obj, '__dict__', {}).values()
+            for value in values:
+                if (value is None or id(value) in seen
+                        or isinstance(value, (basestring, int, long, float))):
+                    continue
+                seen.add(id(value))
+                found.append(value)
+                next_level.append(value)
+        level = next_level
+    return found
+
+
+def retire(pipeline, keep=(), grace=RETIRE_GRACE):
+    """Close the sender and stream of a replaced `pipeline`, except those
+    in `keep`, as by `close_later`.
+
+    """
+    return close_later([obj for obj in (pipeline.sender, pipeline.stream)
+                        if obj is not None
+                        and not any(obj is kept for kept in keep)], grace)
+
+
+def retire_replaced(old, new, grace=RETIRE_GRACE):
+    """Retire pipeline `old`, replaced by `new`, keeping the parts of it
+    `new` still uses. The default `retire` hook of a `HekaClient`.
+
+    """
+    return retire(old, keep=components(new), grace=grace)
+
+
+def close_later(objects, grace=RETIRE_GRACE):
+    """Drain and close each of `objects` supporting it, in order, once
+    `grace` seconds have passed, from a daemon thread. Senders should
+    come before the streams they write to. If `grace` is 0 they are
+    closed right away instead.
+
+    """
+    objects = [obj for obj in objects
+               if hasattr(obj, 'drain') or hasattr(obj, 'close')]
+    if not objects:
+        return None
+    if grace <= 0:
+        _close(objects, 0)
+        return None
+    thread = threading.Thread(target=_close, args=(objects, grace))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _close(objects, grace):
+    if grace > 0:
+        time.sleep(grace)
+    for obj in objects:
+        for method in ('drain', 'close'):
+            fn = getattr(obj, method, None)
+            if fn is None:
+                continue
+            try:
+                fn()
+            except StandardError:
+                # nobody to report to, the old pipeline is going away
+                pass
@@ -0,0 +1,279 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""A stand-in for hekad, for testing and benchmarking.
+
+The `HekaReceiver` accepts heka framed messages over UDP, TCP and Unix
+domain sockets, verifies HMAC signatures and counts messages, bytes and
+malformed frames. It also tracks end to end latency by comparing each
+message's timestamp against the time it was received, which is only
+meaningful when sender and receiver share a clock (e.g. on a laptop).
+
+This is *not* a replacement for hekad, received messages are counted
+and then thrown away. A `HekaRelay` passes them on to another stream
+instead, as plain heka frames, which makes it a bridge from clients
+sending compressed batches (`heka.streams.ZlibBatchStream`) to hekad.
+
+"""
+from __future__ import absolute_import
+import SocketServer
+import hmac
+import os
+import random
+import threading
+import time
+
+from heka.decoders import StreamDecoder
+from heka.encoders import HASHNAME_TO_FUNC
+from heka.message import Header, Message
+from heka.message import RECORD_SEPARATOR, UNIT_SEPARATOR
+
+# maximum number of latency samples kept between reports
+LATENCY_SAMPLES = 10000
+
+
+class ReceiverStats(object):
+    """Counters for a `HekaReceiver`, reset by `HekaReceiver.take`."""
+    def __init__(self):
+        self.start = time.time()
+        self.messages = 0
+        self.bytes = 0
+        self.malformed = 0
+        self.bad_hmac = 0
+        self.latencies = []
+
+    def as_dict(self):
+        elapsed = (time.time() - self.start) or 1e-9
+        latencies = sorted(self.latencies)
+
+        def percentile(pct):
+            if not latencies:
+                return 0.0
+            return latencies[int(round(pct / 100.0 * (len(latencies) - 1)))]
+
+        return {'elapsed': elapsed,
+                'messages': self.messages,
+                'bytes': self.bytes,
+                'malformed': self.malformed,
+                'bad_hmac': self.bad_hmac,
+                'msgs_per_sec': self.messages / elapsed,
+                'bytes_per_sec': self.bytes / elapsed,
+                'latency_p50': percentile(50),
+                'latency_p90': percentile(90),
+                'latency_p99': percentile(99),
+                }
+
+
+class HekaReceiver(object):
+    """Parses and counts heka framed messages."""
+    def __init__(self, hmac_keys=None):
+        """Create a HekaReceiver
+
+        :param hmac_keys: Optional dict mapping `(signer, key_version)`
+                          to the key used to verify the HMAC of messages
+                          with that signer. Signed messages from unknown
+                          signers are counted as `bad_hmac`.
+
+        """
+        self.hmac_keys = hmac_keys or {}
+        self.stats = ReceiverStats()
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Return the current stats as a dict and start counting
+        afresh.
+
+        """
+        with self._lock:
+            stats, self.stats = self.stats, ReceiverStats()
+            self._seen = 0
+        return stats.as_dict()
+
+    def decoder(self):
+        """Return a decoder suitable for passing to `feed`."""
+        return StreamDecoder(lazy=True)
+
+    def feed(self, data, decoder=None):
+        """Verify and count all of the frames in `data`.
+
+        :param decoder: `StreamDecoder` holding the state of a stream
+                        transport, as returned by `decoder()`. If None
+                        `data` must contain whole frames (e.g. a single
+                        datagram).
+
+        """
+        datagram = decoder is None
+        if datagram:
+            decoder = self.decoder()
+        malformed = decoder.malformed
+        with self._lock:
+            self.stats.bytes += len(data)
+        for header, payload in decoder.feed(data):
+            self.handle(header, payload)
+        if datagram and decoder.pending:
+            # a frame cut short, nothing more is coming to complete it
+            decoder.malformed += 1
+        if decoder.malformed != malformed:
+            with self._lock:
+                self.stats.malformed += decoder.malformed - malformed
+
+    def handle(self, header, payload):
+        """Verify and count a single message."""
+        received = time.time()
+        if header.HasField('hmac') and not self.verify(header, payload):
+            with self._lock:
+                self.stats.bad_hmac += 1
+            return
+        msg = Message()
+        try:
+            msg.ParseFromString(payload.tobytes())
+        except Exception:
+            with self._lock:
+                self.stats.malformed += 1
+            return
+        latency = received - msg.timestamp / 1e9
+        with self._lock:
+            stats = self.stats
+            stats.messages += 1
+            self._seen += 1
+            if len(stats.latencies) < LATENCY_SAMPLES:
+                stats.latencies.append(latency)
+            else:
+                idx = random.randint(0, self._seen - 1)
+                if idx < LATENCY_SAMPLES:
+                    stats.latencies[idx] = latency
+
+    def verify(self, header, payload):
+        key = self.hmac_keys.get((header.hmac_signer,
+                                  header.hmac_key_version))
+        if key is None:
+            return False
+        hash_name = Header.HmacHashFunction.Name(header.hmac_hash_function)
+        digest = hmac.new(key, payload, HASHNAME_TO_FUNC[hash_name]).digest()
+        return digest == header.hmac
+
+
+class HekaRelay(HekaReceiver):
+    """Writes every message it receives to `stream` as a plain heka
+    frame. Messages aren't parsed, only counted.
+
+    """
+    def __init__(self, stream, hmac_keys=None):
+        """Create a HekaRelay
+
+        :param stream: Stream the frames are written to, e.g. a
+                       `heka.streams.UdpStream` pointing at hekad.
+        :param hmac_keys: Optional dict of HMAC keys, as for
+                          `HekaReceiver`. If given, messages failing
+                          verification are dropped, otherwise signed
+                          messages are passed on unchecked.
+
+        """
+        HekaReceiver.__init__(self, hmac_keys)
+        self.stream = stream
+        self._write_lock = threading.Lock()
+
+    def feed(self, data, decoder=None):
+        HekaReceiver.feed(self, data, decoder)
+        with self._write_lock:
+            self.stream.flush()
+
+    def handle(self, header, payload):
+        if (self.hmac_keys and header.HasField('hmac')
+                and not self.verify(header, payload)):
+            with self._lock:
+                self.stats.bad_hmac += 1
+            return
+        header_data = header.SerializeToString()
+        frame = ''.join((chr(RECORD_SEPARATOR), chr(len(header_data)),
+                         header_data, chr(UNIT_SEPARATOR),
+                         payload.tobytes()))
+        with self._write_lock:
+            self.stream.write(frame)
+        with self._lock:
+            self.stats.messages += 1
+
+
+class _DatagramHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.server.receiver.feed(self.request[0])
+
+
+class _StreamHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        receiver = self.server.receiver
+        decoder = receiver.decoder()
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                break
+            receiver.feed(chunk, decoder)
+
+
+class _UDPServer(SocketServer.UDPServer):
+    # the default of 8192 truncates larger datagrams
+    max_packet_size = 65535
+
+
+class _UnixDatagramServer(SocketServer.UnixDatagramServer):
+    max_packet_size = 65535
+
+
+class _ThreadingUnixStreamServer(SocketServer.ThreadingMixIn,
+                                 SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+SERVERS = {'udp': (_UDPServer, _DatagramHandler),
+           'tcp': (_ThreadingTCPServer, _StreamHandler),
+           'unix': (_ThreadingUnixStreamServer, _StreamHandler),
+           'unixgram': (_UnixDatagramServer, _DatagramHandler),
+           }
+
+
+def serve(receiver, transport, address):
+    """Start a server for `receiver` in a background thread and return
+    it. Call `shutdown()` and `server_close()` on the result to stop.
+
+    :param transport: One of 'udp', 'tcp', 'unix' or 'unixgram'.
+    :param address: `(host, port)` tuple for the inet transports (port 0
+                    picks a free port, see `server.server_address`) or a
+                    filesystem path for the unix ones.
+
+    """
+    server_cls, handler_cls = SERVERS[transport]
+    if transport.startswith('unix') and os.path.exists(address):
+        os.unlink(address)
+    server = server_cls(address, handler_cls)
+    server.receiver = receiver
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def format_report(label, stats):
+    return ("%(label)s: %(messages)d msgs, %(msgs_per_sec).1f msgs/sec, "
+            "%(bytes_per_sec).1f bytes/sec, %(malformed)d malformed, "
+            "%(bad_hmac)d bad hmac, latency p50 %(p50).1fus "
+            "p90 %(p90).1fus p99 %(p99).1fus" %
+            dict(stats, label=label,
+                 p50=stats['latency_p50'] * 1e6,
+                 p90=stats['latency_p90'] * 1e6,
+                 p99=stats['latency_p99'] * 1e6))
@@ -0,0 +1,276 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Sampling helpers for the HekaClient.
+
+A `RequestBuffer` holds back every message generated while it is
+active (i.e. for the duration of a single request) and only hands them
+to the client for delivery once the request has finished and a policy
+function has decided that the request is worth keeping. Messages for
+dropped requests are never encoded.
+
+Policy functions are created by providers, in the same way as the
+functions in `heka.filters`. Each policy accepts the closed
+`RequestBuffer` and returns True if the buffered messages *should* be
+delivered, False if they should be thrown away.
+
+An `AdaptiveSampler` can be given to the client to pick sample rates
+for counters, gauges and timers on the fly, based on the observed call
+rate of each name.
+
+"""
+from __future__ import absolute_import
+import math
+import random
+import sys
+import time
+
+from heka.client import SEVERITY
+
+# messages a RequestBuffer holds, later ones are dropped
+MAX_EVENTS = 1000
+# names an AdaptiveSampler tracks before pruning the ones under budget
+MAX_NAMES = 10000
+
+
+class BufferFull(Exception):
+    """A request buffer had no room for a message."""
+
+
+def tail_policy_provider(severity=SEVERITY.ERROR, slow=1.0, rate=0.01):
+    """Keep a request if it generated a message at least as severe as
+    `severity`, took `slow` seconds or longer, or was explicitly
+    flagged. Otherwise keep only a random `rate` fraction of requests.
+
+    """
+    def tail_policy(buf):
+        if buf.flagged:
+            return True
+        if buf.severity is not None and buf.severity <= severity:
+            return True
+        if slow is not None and buf.elapsed >= slow:
+            return True
+        return random.random() < rate
+
+    return tail_policy
+
+
+class RequestBuffer(object):
+    """Context manager that buffers every message generated by the
+    current thread until it exits, then delivers them as a single batch
+    if `policy` decides the request should be kept.
+
+    Buffered messages are stored as raw argument tuples, so a dropped
+    request costs no message construction or encoding at all.
+
+    """
+    def __init__(self, client, policy=None, max_events=MAX_EVENTS):
+        """Create a RequestBuffer
+
+        :param client: HekaClient that will deliver kept messages.
+        :param policy: Callable accepting the buffer and returning a
+                       boolean keep / drop decision. Defaults to
+                       `tail_policy_provider()`.
+        :param max_events: Maximum number of messages held. Any more are
+                           dropped, and counted in the client's stats,
+                           though their severity still counts towards
+                           keeping the request.
+
+        """
+        if policy is None:
+            policy = tail_policy_provider()
+        self.client = client
+        self.policy = policy
+        self.max_events = max_events
+        self.events = []
+        self.severity = None
+        self.flagged = False
+        self.start = None
+        self.end = None
+        self._previous = None
+
+    @property
+    def elapsed(self):
+        """Seconds elapsed since the buffer was opened."""
+        if self.start is None:
+            return 0.0
+        end = self.end if self.end is not None else time.time()
+        return end - self.start
+
+    def append(self, event):
+        """Buffer a `(type, logger, severity, payload, fields,
+        timestamp)` tuple.
+
+        """
+        if len(self.events) < self.max_events:
+            self.events.append(event)
+        else:
+            self.client.stats.record_error(BufferFull())
+        severity = event[2]
+        if self.severity is None or severity < self.severity:
+            self.severity = severity
+
+    def flag(self):
+        """Force this request to be kept regardless of the policy."""
+        self.flagged = True
+
+    def __enter__(self):
+        local = self.client._local
+        self._previous = getattr(local, 'buffer', None)
+        local.buffer = self
+        self.start = time.time()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.end = time.time()
+        self.client._local.buffer = self._previous
+        self._previous = None
+        if typ is not None:
+            self.flag()
+        events, self.events = self.events, []
+        if events and self.policy(self):
+            self.client._deliver_events(events)
+        return False
+
+
+class RequestBufferMiddleware(object):
+    """WSGI middleware that wraps each request in a `RequestBuffer`.
+
+    The active buffer is stored in the WSGI environment as
+    `heka.request_buffer` so that applications can `flag()` a request.
+    Requests that raise or respond with a 5xx status are always kept.
+
+    """
+    def __init__(self, app, client, policy=None, max_events=MAX_EVENTS):
+        self.app = app
+        self.client = client
+        self.policy = policy
+        self.max_events = max_events
+
+    def __call__(self, environ, start_response):
+        buf = RequestBuffer(self.client, self.policy, self.max_events)
+        environ['heka.request_buffer'] = buf
+
+        def buffered_start_response(status, headers, exc_info=None):
+            if status[:1] == '5':
+                buf.flag()
+            if exc_info is not None:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        buf.__enter__()
+        try:
+            result = self.app(environ, buffered_start_response)
+        except:
+            exc_info = sys.exc_info()
+            buf.__exit__(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return _ClosingIterator(result, buf)
+
+
+class _ClosingIterator(object):
+    """Iterate over a WSGI response body, closing the request buffer
+    once the server is done with it.
+
+    """
+    def __init__(self, result, buf):
+        self.result = result
+        self.buf = buf
+        self._iter = iter(result)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iter.next()
+        except StopIteration:
+            raise
+        except:
+            self.buf.flag()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.buf.__exit__(None, None, None)
+
+
+class AdaptiveSampler(object):
+    """Adjusts the sample rate for each metric or timer name so that the
+    number of messages generated for that name stays under a messages
+    per second budget.
+
+    The call rate for each name is tracked as an exponentially weighted
+    moving average, so the sample rate follows changes in traffic
+    within a few multiples of `halflife`.
+
+    """
+    def __init__(self, budget=100, halflife=10, max_names=MAX_NAMES):
+        """Create an AdaptiveSampler
+
+        :param budget: Maximum number of messages per second that should
+                       be generated for any single name.
+        :param halflife: Number of seconds after which an observed call
+                         counts for half as much in the rate estimate.
+        :param max_names: Number of names tracked. Beyond it, names
+                          within budget are forgotten (they aren't being
+                          sampled down), and if that isn't enough, all
+                          of them.
+
+        """
+        self.budget = float(budget)
+        self.tau = float(halflife) / math.log(2)
+        self.max_names = max_names
+        # name -> [decayed call count, time of last update]
+        self._names = {}
+
+    def observed_rate(self, name):
+        """Return the estimated calls per second for `name`."""
+        state = self._names.get(name)
+        if state is None:
+            return 0.0
+        count, last = state
+        return count * math.exp((last - time.time()) / self.tau) / self.tau
+
+    def sample_rate(self, name, rate=1.0):
+        """Record a call for `name` and return the sample rate that
+        should be applied to it, never higher than `rate`.
+
+        """
+        now = time.time()
+        state = self._names.get(name)
+        if state is None:
+            if len(self._names) >= self.max_names:
+                self._prune(now)
+            self._names[name] = [1.0, now]
+            return rate
+        count = state[0] * math.exp((state[1] - now) / self.tau) + 1.0
+        state[0] = count
+        state[1] = now
+        observed = count / self.tau
+        if observed * rate <= self.budget:
+            return rate
+        return self.budget / observed
+
+    def _prune(self, now):
+        # items() is a copy, other threads may be updating the dict
+        limit = self.budget * self.tau
+        names = dict((name, state) for name, state in self._names.items()
+                     if state[0] * math.exp((state[1] - now) / self.tau)
+                     > limit)
+        if len(names) >= self.max_names:
+            names = {}
+        self._names = names
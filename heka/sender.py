@@ -0,0 +1,327 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Background delivery of messages.
+
+A HekaClient with a `sender` doesn't encode anything on the calling
+thread. `heka` wraps its normalized arguments in an `Event`, a small
+record of a few references, and queues it. The sender's thread runs
+filters and size policies, encodes the events in batches and hands each
+batch to the stream in as few writes as possible.
+
+As the fields dictionary is only read when the event is encoded, the
+client queues a copy of it, leaving the caller free to reuse its own.
+
+Events are queued in two lanes. Those at least as severe as the
+sender's `priority_severity` go in the priority lane, which is always
+drained first and never drops events, so an ALERT doesn't wait behind,
+or get dropped with, a backlog of counters and timers.
+
+`ProcessSender` goes further for CPU bound applications, where the GIL
+makes the sender thread compete with the application: events are
+pickled to a worker process which does all of the encoding, signing and
+writing on another core.
+
+"""
+from __future__ import absolute_import
+import itertools
+import os
+import threading
+
+from heka.util import Queue
+
+
+class Event(object):
+    """The normalized arguments of one `HekaClient.heka` call."""
+    __slots__ = ('type', 'logger', 'severity', 'payload', 'fields',
+                 'timestamp')
+
+    def __init__(self, type, logger, severity, payload, fields, timestamp):
+        self.type = type
+        self.logger = logger
+        self.severity = severity
+        self.payload = payload
+        self.fields = fields
+        self.timestamp = timestamp
+
+    def args(self):
+        """Return the event as a tuple of `heka` arguments."""
+        return (self.type, self.logger, self.severity, self.payload,
+                self.fields, self.timestamp)
+
+
+class QueueFull(Exception):
+    """The sender's queue had no room for an event."""
+
+
+# lanes, in the order they are drained
+PRIORITY = 0
+NORMAL = 1
+_STOP = 2
+
+
+def severity_level(severity):
+    """Return the numeric severity for a `heka.client.SEVERITY` name or
+    number, or None for None or an empty string.
+
+    """
+    if severity is None or severity == '':
+        return None
+    if isinstance(severity, basestring) and not severity.isdigit():
+        from heka.client import SEVERITY
+        return getattr(SEVERITY, severity.upper())
+    return int(severity)
+
+
+class BackgroundSender(object):
+    """Queues events and delivers them from a daemon thread.
+
+    When the normal lane is full new events are dropped, and counted in
+    the client stats as send errors, rather than blocking the caller.
+    Priority events are queued regardless.
+
+    """
+    def __init__(self, max_queue_size=10000, max_batch_size=100,
+                 priority_severity='ERROR'):
+        """Create a BackgroundSender
+
+        :param max_queue_size: Maximum number of normal lane events
+                               waiting to be sent.
+        :param max_batch_size: Maximum number of events encoded and
+                               written together.
+        :param priority_severity: `heka.client.SEVERITY` name or number
+                                  of the least severe events sent in the
+                                  priority lane. If None there is only
+                                  the normal lane.
+
+        """
+        self.max_queue_size = int(max_queue_size)
+        self.max_batch_size = int(max_batch_size)
+        self.priority_severity = severity_level(priority_severity)
+        self.client = None
+        # (lane, sequence, event) items
+        self._queue = Queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._normal = 0
+        self._thread = None
+
+    def attach(self, client):
+        """Deliver through `client`, starting the sender thread."""
+        self.client = client
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _lane(self, severity):
+        if (self.priority_severity is not None and
+                severity <= self.priority_severity):
+            return PRIORITY
+        return NORMAL
+
+    def put(self, event):
+        """Queue an `Event` for delivery."""
+        lane = self._lane(event.severity)
+        if lane == NORMAL:
+            with self._lock:
+                if self._normal >= self.max_queue_size:
+                    self.client.stats.record_error(QueueFull())
+                    return
+                self._normal += 1
+        self._queue.put((lane, next(self._sequence), event))
+        self._report_depth()
+
+    def flush(self):
+        """Block until every queued event has been handled."""
+        self._queue.join()
+
+    def close(self):
+        """Deliver whatever is queued and stop the sender thread."""
+        if self._thread is None:
+            return
+        self._queue.put((_STOP, next(self._sequence), None))
+        self._thread.join()
+        self._thread = None
+
+    def _next_batch(self):
+        # events of the next batch, priority ones first, ending with
+        # None if the sender is stopping
+        items = [self._queue.get()]
+        while len(items) < self.max_batch_size and items[-1][0] != _STOP:
+            try:
+                items.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        normal = sum(1 for item in items if item[0] == NORMAL)
+        if normal:
+            with self._lock:
+                self._normal -= normal
+        return [item[2] for item in items]
+
+    def _events(self, batch):
+        # `heka` argument tuples of a batch off the queue
+        return [event.args() for event in batch if event is not None]
+
+    def _deliver(self, events):
+        client = self.client
+        try:
+            client._deliver_events(events)
+        except StandardError:
+            # Events are all encoded before anything is written, so
+            # nothing was sent. Go one by one to only lose the bad ones.
+            for event in events:
+                try:
+                    client._deliver_events([event])
+                except StandardError, e:
+                    client.error_reporter.report(e)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            events = self._events(batch)
+            try:
+                if events:
+                    self._deliver(events)
+            finally:
+                for event in batch:
+                    self._queue.task_done()
+            self._report_depth()
+            if batch[-1] is None:
+                return
+
+    def _report_depth(self):
+        self.client.stats.set_queue_depth(self._queue.qsize())
+
+
+class ProcessSender(BackgroundSender):
+    """Delivers events from a worker process, forked from the client's
+    process the first time it sends something (and again in any process
+    forked from that one, e.g. by a preforking server).
+
+    The worker delivers through its copy of the client, with the same
+    stream, encoder, HMAC key, filters and size policy. Consequently
+    the client's stream has to survive being forked (UDP and file
+    streams do), the delivery counters of `client.stats` are only kept
+    in the worker, and field values have to be picklable.
+
+    Each process sending events has a worker of its own, and only
+    flushes and closes that one.
+
+    The events share a single pipe to the worker. Priority events are
+    only put first within each batch the worker reads, but when the
+    queue is full they wait for room rather than being dropped.
+
+    """
+    def __init__(self, max_queue_size=10000, max_batch_size=100,
+                 priority_severity='ERROR'):
+        """Create a ProcessSender
+
+        :param max_queue_size: Maximum number of events waiting to be
+                               sent.
+        :param max_batch_size: Maximum number of events encoded and
+                               written together.
+        :param priority_severity: Least severe priority event, as for
+                                  `BackgroundSender`.
+
+        """
+        self.max_queue_size = int(max_queue_size)
+        self.max_batch_size = int(max_batch_size)
+        self.priority_severity = severity_level(priority_severity)
+        self.client = None
+        self._queue = None
+        self._process = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def attach(self, client):
+        """Deliver through `client`. The worker is only started once
+        the client is fully set up and sends its first message.
+
+        """
+        self.client = client
+
+    def _start(self):
+        import multiprocessing
+        self._queue = multiprocessing.JoinableQueue(self.max_queue_size)
+        self._process = multiprocessing.Process(target=self._work)
+        self._process.daemon = True
+        self._process.start()
+        self._pid = os.getpid()
+
+    def put(self, event):
+        """Queue an `Event` for delivery, as a tuple."""
+        if self._pid != os.getpid():
+            with self._start_lock:
+                # only one worker, however many threads send first
+                if self._pid != os.getpid():
+                    self._start()
+        args = event.args()
+        try:
+            self._queue.put_nowait(args)
+        except Queue.Full:
+            if self._lane(event.severity) == NORMAL:
+                self.client.stats.record_error(QueueFull())
+                return
+            self._queue.put(args)
+
+    def flush(self):
+        """Block until the worker of this process has handled every
+        queued event. Does nothing in a process which hasn't sent
+        anything, e.g. one forked from the process which did.
+
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        """Deliver whatever is queued and stop the worker of this
+        process. Like `flush`, does nothing in a process which hasn't
+        started a worker of its own; the parent's worker is for the
+        parent to close.
+
+        """
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._process.join()
+        self._pid = self._process = self._queue = None
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        # stable, and keeps the stop sentinel last
+        batch.sort(key=lambda args: _STOP if args is None
+                   else self._lane(args[2]))
+        return batch
+
+    def _events(self, batch):
+        return [event for event in batch if event is not None]
+
+    def _report_depth(self):
+        # multiprocessing queues can't tell their size on some
+        # platforms, e.g. Mac OS X
+        try:
+            depth = self._queue.qsize()
+        except NotImplementedError:
+            return
+        self.client.stats.set_queue_depth(depth)
+
+    def _work(self):
+        # in the worker, the client delivers directly
+        self.client.sender = None
+        self._run()
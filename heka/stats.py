@@ -0,0 +1,220 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Self-instrumentation for the HekaClient.
+
+Every client keeps a `ClientStats` instance as `client.stats`. The
+counters are plain attributes that are bumped in line on the emit path,
+without any locking, so under heavy contention from many threads a few
+increments may be lost; they are meant for visibility, not accounting.
+
+"""
+from __future__ import absolute_import
+import sys
+import threading
+import time
+
+
+class ClientStats(object):
+    """Counters describing what a HekaClient has done with its
+    messages.
+
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # messages handed to the client for delivery
+        self.emitted = 0
+        # filter name -> messages rejected by that filter
+        self.filtered = {}
+        self.encoded = 0
+        self.sent = 0
+        self.dropped = 0
+        # messages handed to the size policy
+        self.oversized = 0
+        self.bytes = 0
+        # exception class name -> number of failed sends
+        self.send_errors = {}
+        self.queue_depth = 0
+        self.queue_high_water = 0
+        # cumulative seconds spent encoding and writing to the stream
+        self.encode_time = 0.0
+        self.send_time = 0.0
+        # compressed batches, see heka.streams.ZlibBatchStream
+        self.batches = 0
+        self.batch_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+
+    def record_filtered(self, filter_fn):
+        name = getattr(filter_fn, '__name__', None) or repr(filter_fn)
+        self.filtered[name] = self.filtered.get(name, 0) + 1
+
+    def record_error(self, exc):
+        self.dropped += 1
+        name = exc.__class__.__name__
+        self.send_errors[name] = self.send_errors.get(name, 0) + 1
+
+    def record_batch(self, raw_size, compressed_size, elapsed):
+        """Record a batch of `raw_size` bytes compressed to
+        `compressed_size` bytes in `elapsed` seconds.
+
+        """
+        self.batches += 1
+        self.batch_bytes += raw_size
+        self.compressed_bytes += compressed_size
+        self.compress_time += elapsed
+
+    def set_queue_depth(self, depth):
+        """Record the current depth of a delivery queue."""
+        self.queue_depth = depth
+        if depth > self.queue_high_water:
+            self.queue_high_water = depth
+
+    def snapshot(self):
+        """Return a copy of the current counters as a dictionary."""
+        return {'emitted': self.emitted,
+                'filtered': dict(self.filtered),
+                'encoded': self.encoded,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'oversized': self.oversized,
+                'bytes': self.bytes,
+                'send_errors': dict(self.send_errors),
+                'queue_depth': self.queue_depth,
+                'queue_high_water': self.queue_high_water,
+                'encode_time': self.encode_time,
+                'send_time': self.send_time,
+                'batches': self.batches,
+                'batch_bytes': self.batch_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'compression_ratio': (float(self.batch_bytes) /
+                                      self.compressed_bytes
+                                      if self.compressed_bytes else 0.0),
+                'compress_time': self.compress_time,
+                'compress_time_per_batch': (self.compress_time /
+                                            self.batches
+                                            if self.batches else 0.0),
+                }
+
+
+class StatsReporter(object):
+    """Background thread that periodically sends a client's stats
+    through the client itself, as a `heka_stats` message.
+
+    """
+    msg_type = 'heka_stats'
+
+    def __init__(self, client, interval=60):
+        self.client = client
+        self.interval = float(interval)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                return
+            self.report()
+
+    def report(self):
+        fields = self.client.stats.snapshot()
+        # empty nested dicts would vanish when flattened
+        for key in ('filtered', 'send_errors'):
+            if not fields[key]:
+                del fields[key]
+        self.client.heka(self.msg_type, fields=fields)
+
+
+class ErrorReporter(object):
+    """Accounts for failed deliveries and reports them on stderr, at
+    most once every `interval` seconds.
+
+    The first failure is reported straight away, any further failures
+    are only counted and summarized in the next report, which a timer
+    writes at the end of the interval even if the failures have stopped
+    by then. Per failure the cost is a couple of counter increments, no
+    matter how many messages are failing.
+
+    """
+    def __init__(self, stats, interval=10):
+        """Create an ErrorReporter
+
+        :param stats: `ClientStats` in which the drops are recorded.
+        :param interval: Minimum number of seconds between reports.
+
+        """
+        self.stats = stats
+        self.interval = float(interval)
+        self._pending = {}
+        self._last_error = None
+        self._last_report = None
+        self._next_report = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def report(self, exc, count=1):
+        """Record that `count` messages were dropped because of `exc`."""
+        stats = self.stats
+        stats.record_error(exc)
+        if count > 1:
+            stats.dropped += count - 1
+        name = exc.__class__.__name__
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + count
+            self._last_error = exc
+            delay = self._next_report - time.time()
+            if delay > 0 and self._timer is None:
+                # summarized once the interval is over, whether or not
+                # another failure comes along to do it
+                self._timer = threading.Timer(delay, self._flush_due)
+                self._timer.daemon = True
+                self._timer.start()
+        if delay <= 0:
+            self.flush()
+
+    def _flush_due(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Write a summary of the failures since the last report."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            now = time.time()
+            self._next_report = now + self.interval
+        if not pending:
+            return
+        if self._last_report is None:
+            msg = ("Error sending message (%r), further errors will be "
+                   "summarized every %ds\n" % (self._last_error,
+                                                self.interval))
+        else:
+            counts = ', '.join('%s: %d' % item
+                               for item in sorted(pending.items()))
+            msg = ("Error sending messages, %d dropped in the last %ds "
+                   "(%s), last error: %r\n" % (sum(pending.values()),
+                                               now - self._last_report,
+                                               counts, self._last_error))
+        self._last_report = now
+        sys.stderr.write(msg)
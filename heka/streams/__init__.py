@@ -14,9 +14,12 @@
 # ***** END LICENSE BLOCK *****
 
 
+from heka.streams.compress import ZlibBatchStream  # NOQA
 from heka.streams.dev import DebugCaptureStream  # NOQA
 from heka.streams.dev import FileStream  # NOQA
 from heka.streams.dev import StdOutStream  # NOQA
 from heka.streams.logging import StdLibLoggingStream # NOQA
+from heka.streams.routing import Route  # NOQA
+from heka.streams.routing import RoutingStream  # NOQA
 from heka.streams.tcp import TcpStream  # NOQA
 from heka.streams.udp import UdpStream  # NOQA
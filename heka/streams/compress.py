@@ -0,0 +1,151 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Compressed batches of heka frames, for thin links.
+
+A batch is laid out as::
+
+    BATCH_SEPARATOR, compressed length (4 bytes, big endian),
+    zlib compressed concatenation of plain heka frames
+
+hekad doesn't understand batches, they have to be expanded on the far
+side of the link, e.g. by a `heka.receiver.HekaRelay` (`hekarecv
+--forward`) in front of hekad.
+
+"""
+from __future__ import absolute_import
+from struct import pack
+import threading
+import time
+import zlib
+
+from heka.message import BATCH_SEPARATOR, MAX_BATCH_SIZE
+
+
+class ZlibBatchStream(object):
+    """Collects heka frames and hands them to another stream as zlib
+    compressed batches.
+
+    A batch is sent once it holds `max_batch_size` bytes of frames, or
+    once its first frame is `max_latency` seconds old. The client calls
+    `flush` after every message, that only sends batches which are due;
+    `drain` sends whatever is pending.
+
+    Errors writing to the inner stream are raised to whichever write or
+    flush sent the batch. The whole batch is lost in that case.
+
+    """
+    def __init__(self, inner, level=6, max_batch_size=32768, max_latency=1.0,
+                 **inner_kwargs):
+        """Create a ZlibBatchStream
+
+        :param inner: Stream the batches are written to, or a dotted
+                      name of a stream class which is instantiated with
+                      `inner_kwargs`.
+        :param level: zlib compression level, 1 (fastest) to 9 (best).
+        :param max_batch_size: Uncompressed batch size in bytes. The
+                               default keeps the compressed batches of
+                               any realistic traffic within a UDP
+                               datagram. `ValueError` is raised if it's
+                               over `heka.message.MAX_BATCH_SIZE`, the
+                               largest batch decoders expand.
+        :param max_latency: Maximum number of seconds a frame is held
+                            back. If 0 batches are only sent when full
+                            or drained.
+
+        """
+        if isinstance(inner, basestring):
+            from heka.path import resolve_name
+            inner = resolve_name(inner)(**inner_kwargs)
+        max_batch_size = int(max_batch_size)
+        if max_batch_size > MAX_BATCH_SIZE:
+            raise ValueError("max_batch_size %d is over the %d bytes "
+                             "decoders accept" %
+                             (max_batch_size, MAX_BATCH_SIZE))
+        self.inner = inner
+        self.level = int(level)
+        self.max_batch_size = max_batch_size
+        self.max_latency = float(max_latency)
+        self.stats = None
+        self._pending = []
+        self._size = 0
+        self._started = 0
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        if self.max_latency > 0:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def attach_stats(self, stats):
+        """Report batch sizes and compression time in a
+        `heka.stats.ClientStats`.
+
+        """
+        self.stats = stats
+
+    def write(self, data):
+        with self._lock:
+            if self._pending and self._size + len(data) > self.max_batch_size:
+                self._send()
+            if not self._pending:
+                self._started = time.time()
+            self._pending.append(data)
+            self._size += len(data)
+            if self._size >= self.max_batch_size:
+                self._send()
+
+    def _due(self):
+        return (self._pending and self.max_latency > 0 and
+                time.time() - self._started >= self.max_latency)
+
+    def flush(self):
+        if self._due():
+            with self._lock:
+                if self._due():
+                    self._send()
+
+    def drain(self):
+        """Send the pending batch, if any, regardless of its age."""
+        with self._lock:
+            self._send()
+
+    def close(self):
+        """Drain and stop the latency thread."""
+        self._closed.set()
+        self.drain()
+
+    def _send(self):
+        if not self._pending:
+            return
+        raw = ''.join(self._pending)
+        self._pending = []
+        self._size = 0
+        start = time.time()
+        compressed = zlib.compress(raw, self.level)
+        elapsed = time.time() - start
+        if self.stats is not None:
+            self.stats.record_batch(len(raw), len(compressed), elapsed)
+        self.inner.write(pack('!BI', BATCH_SEPARATOR, len(compressed)) +
+                         compressed)
+        self.inner.flush()
+
+    def _run(self):
+        while not self._closed.isSet():
+            self._closed.wait(self.max_latency / 2)
+            try:
+                self.flush()
+            except StandardError, e:
+                # nobody to raise to, just account for it
+                if self.stats is not None:
+                    self.stats.record_error(e)
@@ -39,6 +39,9 @@ class FileStream(object):
     def flush(self):
         self.filestream.flush()
 
+    def close(self):
+        self.filestream.close()
+
 
 class DebugCaptureStream(object):
     """
@@ -0,0 +1,179 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Sending messages to different streams depending on what they are.
+
+A `RoutingStream` holds a default stream and a number of `Route`s, each
+with its own stream and encoder. A HekaClient writing to a
+RoutingStream encodes every message with the encoder of each route the
+message matches, by type, logger and severity, and writes it to that
+route's stream. Messages no route matches go to the default stream,
+encoded by the client's own encoder.
+
+Filters and size policies run once per message, before routing.
+
+"""
+from __future__ import absolute_import
+
+from heka.message import Message
+
+# route lookups cached before starting over, should only be reached
+# with an unbounded number of distinct types or loggers
+MAX_ROUTE_CACHE = 10000
+
+
+class Route(object):
+    """Messages matching all of the given criteria, written to `stream`
+    with `encoder`.
+
+    """
+    def __init__(self, stream, encoder=None, hmc=None, types=None,
+                 loggers=None, max_severity=None, tee=False, name=None):
+        """Create a Route
+
+        :param stream: Stream instance, or dotted name of a stream class
+                       instantiated without arguments.
+        :param encoder: Encoder class or dotted name, instantiated with
+                        `hmc`. If None the client's encoder is used.
+        :param hmc: HMAC configuration of the encoder.
+        :param types: Message types the route is for, any if None. A
+                      string is split on whitespace.
+        :param loggers: Loggers the route is for, any if None, like
+                        `types`.
+        :param max_severity: Least severe `heka.client.SEVERITY` name or
+                             number the route is for, any if None.
+        :param tee: If True the route takes a copy of its messages;
+                    they still go to the default stream unless another
+                    route matches them.
+        :param name: Name of the route, for reference only.
+
+        """
+        from heka.path import resolve_name
+        from heka.sender import severity_level
+        if isinstance(stream, basestring):
+            stream = resolve_name(stream)()
+        self.stream = stream
+        if isinstance(encoder, basestring):
+            encoder = resolve_name(encoder)
+        self.encoder = encoder(hmc) if encoder is not None else None
+        if isinstance(types, basestring):
+            types = types.split()
+        if isinstance(loggers, basestring):
+            loggers = loggers.split()
+        self.types = frozenset(types) if types is not None else None
+        self.loggers = frozenset(loggers) if loggers is not None else None
+        self.max_severity = severity_level(max_severity)
+        self.tee = tee
+        self.name = name
+
+    def matches(self, logger, severity):
+        """Return True if the route is for messages from `logger` with
+        `severity`, types having already been matched.
+
+        """
+        return ((self.loggers is None or logger in self.loggers) and
+                (self.max_severity is None or
+                 severity <= self.max_severity))
+
+    def encode(self, client, item, encoder):
+        """Return the framed encoding of `item`, a Message or normalized
+        `heka` arguments, by the route's encoder or else `encoder`.
+
+        """
+        encoder = self.encoder or encoder
+        if isinstance(item, Message):
+            return encoder.encode(item)
+        args_to_payload = getattr(encoder, 'args_to_payload', None)
+        if args_to_payload is None:
+            return encoder.encode(client._build_message(*item))
+        return encoder.frame(args_to_payload(client, *item))
+
+
+class RoutingStream(object):
+    """Routes messages from a client to the streams of `routes`, and to
+    `default` if none of them is for a message.
+
+    Which routes a message goes to only depends on its type, logger and
+    severity, and is looked up in a dictionary keyed on those once
+    worked out. Routes are only ever scanned for combinations not seen
+    before, and then only those listed for the message type.
+
+    """
+    def __init__(self, default, routes=()):
+        """Create a RoutingStream
+
+        :param default: Stream messages no route is for are written to,
+                        or dotted name of a stream class.
+        :param routes: Sequence of `Route`s, in the order messages are
+                       written to their streams.
+
+        """
+        self.default = Route(default)
+        self.routes = list(routes)
+        # routes for a type, checked by logger and severity
+        self._by_type = {}
+        self._any_type = []
+        for route in self.routes:
+            if route.types is None:
+                self._any_type.append(route)
+                for routes in self._by_type.itervalues():
+                    routes.append(route)
+                continue
+            for type in route.types:
+                routes = self._by_type.get(type)
+                if routes is None:
+                    routes = self._by_type[type] = list(self._any_type)
+                routes.append(route)
+        self._cache = {}
+
+    def routes_for(self, type, logger, severity):
+        """Return the routes a message is written to."""
+        key = (type, logger, severity)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        matched = [route for route in self._by_type.get(type, self._any_type)
+                   if route.matches(logger, severity)]
+        if all(route.tee for route in matched):
+            matched.append(self.default)
+        routes = tuple(matched)
+        if len(self._cache) >= MAX_ROUTE_CACHE:
+            self._cache.clear()
+        self._cache[key] = routes
+        return routes
+
+    def attach_stats(self, stats):
+        for route in self.routes + [self.default]:
+            attach_stats = getattr(route.stream, 'attach_stats', None)
+            if attach_stats is not None:
+                attach_stats(stats)
+
+    def write(self, data):
+        """Write data encoded by the client's encoder to the default
+        stream.
+
+        """
+        self.default.stream.write(data)
+
+    def flush(self):
+        for route in self.routes + [self.default]:
+            route.stream.flush()
+
+    def close(self):
+        """Drain and close the streams of all routes supporting it."""
+        for route in self.routes + [self.default]:
+            for method in ('drain', 'close'):
+                fn = getattr(route.stream, method, None)
+                if fn is not None:
+                    fn()
@@ -78,3 +78,9 @@ class TcpStream(object):
 
     def flush(self):
         pass
+
+    def close(self):
+        """Close the connections."""
+        with self._lock:
+            for sock in self.sockets:
+                sock.close()
@@ -18,9 +18,14 @@ from __future__ import absolute_import
 from types import StringTypes
 import socket
 
+from heka.message import MAX_DATAGRAM_SIZE
+
 
 class UdpStream(object):
     """Sends heka messages out via a UDP socket."""
+    # largest write the client batches messages into
+    max_write_size = MAX_DATAGRAM_SIZE
+
     def __init__(self, host, port):
         """Create UdpStream object.
 
@@ -56,3 +61,7 @@ class UdpStream(object):
 
     def flush(self):
         pass
+
+    def close(self):
+        """Close the socket."""
+        self.socket.close()
@@ -0,0 +1,74 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka import bench
+from nose.tools import eq_, ok_
+import json
+
+
+def test_run_all():
+    results = bench.run(iterations=5, repeat=1)
+    eq_(sorted(results['results']), sorted(bench.benchmark_names()))
+    for values in results['results'].values():
+        ok_(values['ns'] > 0)
+    # results must be serializable
+    json.dumps(results)
+
+
+def test_run_selected():
+    results = bench.run(['client.incr'], iterations=5, repeat=1)
+    eq_(results['results'].keys(), ['client.incr'])
+
+
+def test_compare():
+    baseline = {'results': {'a': {'ns': 100.0, 'gc_objects': 1.0},
+                            'b': {'ns': 100.0, 'gc_objects': 0.0},
+                            'gone': {'ns': 1.0, 'gc_objects': 0.0}}}
+    current = {'results': {'a': {'ns': 110.0, 'gc_objects': 1.0},
+                           'b': {'ns': 200.0, 'gc_objects': 3.0},
+                           'new': {'ns': 1.0, 'gc_objects': 0.0}}}
+    eq_(bench.compare(current, baseline),
+        [('b', 'ns', 100.0, 200.0), ('b', 'gc_objects', 0.0, 3.0)])
+    eq_(bench.compare(current, baseline, tolerance=1.5),
+        [('b', 'gc_objects', 0.0, 3.0)])
+
+
+def test_compare_pb_objects():
+    baseline = {'results': {'a': {'ns': 1.0, 'gc_objects': 0.0,
+                                  'pb_objects': 1.0},
+                            'old': {'ns': 1.0, 'gc_objects': 0.0}}}
+    current = {'results': {'a': {'ns': 1.0, 'gc_objects': 0.0,
+                                 'pb_objects': 5.0},
+                           'old': {'ns': 1.0, 'gc_objects': 0.0,
+                                   'pb_objects': 5.0}}}
+    eq_(bench.compare(current, baseline), [('a', 'pb_objects', 1.0, 5.0)])
+
+
+def test_reuse_constructs_fewer_messages():
+    benchmarks = dict(bench._BENCHMARKS)
+    init = bench.Message.__dict__['__init__']
+    counts = {}
+    for name in ('client.heka.message', 'client.heka.message.reused',
+                 'client.heka'):
+        fn, cleanup = benchmarks[name]()
+        fn()
+        counts[name] = bench.count_constructions(fn, 10)
+    if counts['client.heka'] is None:
+        # C++ protobuf, nothing to count
+        return
+    # a Message and a Field per key, the reused Message isn't rebuilt
+    eq_(counts['client.heka.message'], len(bench.FLAT_FIELDS) + 1)
+    eq_(counts['client.heka.message.reused'], len(bench.FLAT_FIELDS))
+    eq_(counts['client.heka'], 0)
+    # constructors are restored
+    ok_(bench.Message.__dict__['__init__'] is init)
@@ -17,26 +17,28 @@ from __future__ import absolute_import
 from heka.client import HekaClient, SEVERITY
 from heka.encoders import StdlibPayloadEncoder, ProtobufEncoder
 from heka.encoders import UNIT_SEPARATOR, RECORD_SEPARATOR
-from heka.holder import get_client
+from heka.holder import HekaClientHolder
 from heka.holder import get_client
 from heka.logging import SEVERITY_MAP
 from heka.message import Message, Header, Field
 from heka.message import first_value
 from heka.message import first_value
-from heka.streams import DebugCaptureStream
+from heka.streams import DebugCaptureStream, FileStream
 from heka.streams import StdLibLoggingStream
 from heka.tests.helpers import decode_message
 from heka.tests.helpers import decode_message, dict_to_msg
 from mock import Mock
 from mock import patch
 from nose.tools import eq_, ok_
-from nose.tools import raises
+from nose.tools import assert_raises, raises
 import StringIO
 import datetime
 import logging
 import os
+import shutil
 import socket
 import sys
+import tempfile
 import threading
 import time
 
@@ -463,6 +465,201 @@ class TestUnicode(object):
         err = sys.stderr.read()
         ok_('Error sending' in err)
 
+class TestReuseMessages(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.seen = []
+        self.client = HekaClient(self.stream, self.logger,
+                                 filters=[self._filter],
+                                 reuse_messages=True)
+
+    def _filter(self, msg):
+        self.seen.append((id(msg), msg.payload))
+        return True
+
+    def test_reused(self):
+        self.client.heka('test', payload='one', fields={'a': 1})
+        self.client.heka('test', payload='two')
+        eq_(self.seen[0][0], self.seen[1][0])
+        first, second = [decode_message(data)[1]
+                         for data in self.stream.msgs]
+        eq_((first.payload, len(first.fields)), ('one', 1))
+        eq_((second.payload, len(second.fields)), ('two', 0))
+        ok_(first.uuid != second.uuid)
+
+    def test_not_reused_by_default(self):
+        self.client.reuse_messages = False
+        self.client.heka('test')
+        eq_(getattr(self.client._local, 'messages', None), None)
+
+    def test_config(self):
+        from heka.config import client_from_dict_config
+        client = client_from_dict_config({
+            'stream': {'class': 'heka.streams.DebugCaptureStream'},
+            'reuse_messages': True})
+        ok_(client.reuse_messages)
+
+
+class TestDefine(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+        self.db_query = self.client.define('db_query', [('table', str),
+                                                        ('rows', int),
+                                                        ('ms', float)])
+
+    def _sent(self):
+        return [decode_message(data)[1] for data in self.stream.msgs]
+
+    def test_emit(self):
+        self.db_query('users', 10, 1.5, payload='select', timestamp=1234.5)
+        self.client.heka('db_query', payload='select', timestamp=1234.5,
+                         fields={'table': 'users', 'rows': 10, 'ms': 1.5})
+        defined, expected = self._sent()
+        eq_(defined.logger, self.logger)
+        eq_(defined.severity, self.client.severity)
+        eq_(first_value(defined, 'rows'), 10)
+        # same message as through heka, the fields in definition order
+        defined.uuid = expected.uuid
+        eq_(sorted(defined.fields, key=lambda f: f.name),
+            sorted(expected.fields, key=lambda f: f.name))
+        eq_([f.name for f in defined.fields], ['table', 'rows', 'ms'])
+        del defined.fields[:]
+        del expected.fields[:]
+        eq_(defined, expected)
+
+    def test_conversion(self):
+        self.db_query(u'caf\xe9', '3', 2, severity=3)
+        [msg] = self._sent()
+        eq_(first_value(msg, 'table'), u'caf\xe9')
+        eq_(first_value(msg, 'rows'), 3)
+        eq_(first_value(msg, 'ms'), 2.0)
+        eq_(msg.severity, 3)
+
+    def test_keyword_field(self):
+        emit = self.client.define('kw', [('b', int)], logger='other',
+                                  severity=2, a=str)
+        emit(1, 'x')
+        [msg] = self._sent()
+        eq_([f.name for f in msg.fields], ['b', 'a'])
+        eq_((msg.logger, msg.severity), ('other', 2))
+
+    @raises(TypeError)
+    def test_keyword_fields_unordered(self):
+        self.client.define('kw', table=str, rows=int, ms=float)
+
+    def test_integer_range(self):
+        self.db_query('users', 2 ** 63 - 1, 1.5)
+        eq_(first_value(self._sent()[0], 'rows'), 2 ** 63 - 1)
+        for rows in (2 ** 63, -2 ** 63 - 1):
+            assert_raises(ValueError, self.db_query, 'users', rows, 1.5)
+            assert_raises(ValueError, self.client.heka, 'db_query',
+                          fields={'table': 'users', 'rows': rows})
+        eq_(len(self.stream.msgs), 1)
+
+    def test_filters_use_heka(self):
+        self.client.filters = [lambda msg: first_value(msg, 'rows') > 5]
+        self.db_query('users', 10, 1.5)
+        self.db_query('users', 1, 1.5)
+        eq_(len(self.stream.msgs), 1)
+
+    def test_recompiled_for_new_encoder(self):
+        self.db_query('users', 10, 1.5)
+        self.client.encoder = ProtobufEncoder()
+        self.db_query('users', 10, 1.5)
+        eq_(len(self._sent()), 2)
+        ok_(self.db_query._compiled[0] is self.client.encoder)
+
+    @raises(TypeError)
+    def test_wrong_arity(self):
+        self.db_query('users', 10)
+
+    @raises(TypeError)
+    def test_string_required(self):
+        self.db_query(5, 10, 1.5)
+
+    @raises(ValueError)
+    def test_unsupported_type(self):
+        self.client.define('bad', [('a', list)])
+
+
+class TestBulk(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+
+    def _sent(self):
+        from heka.decoders import decode_frames
+        return [msg for data in self.stream.msgs
+                for header, msg in decode_frames(data)]
+
+    def test_heka_many(self):
+        self.client.heka_many([('a', None, 3, 'one', {'x': 1}),
+                               {'type': 'b', 'payload': 'two',
+                                'fields': {'y': 'z'}, 'timestamp': 1234}],
+                              logger='bulk')
+        # a single write
+        eq_(len(self.stream.msgs), 1)
+        first, second = self._sent()
+        eq_((first.type, first.logger, first.severity, first.payload),
+            ('a', 'bulk', 3, 'one'))
+        eq_(first_value(first, 'x'), 1)
+        eq_((second.type, second.severity, second.timestamp),
+            ('b', self.client.severity, 1234 * 1000000000))
+        eq_(self.client.stats.sent, 2)
+
+    def test_filters(self):
+        self.client.filters = [lambda msg: msg.type != 'skip']
+        self.client.heka_many([('keep',), ('skip',), ('keep',)])
+        eq_([msg.type for msg in self._sent()], ['keep', 'keep'])
+        eq_(self.client.stats.filtered, {'<lambda>': 1})
+
+    def test_invalid_event_sends_nothing(self):
+        try:
+            self.client.heka_many([('a',), ('b', None, None, '',
+                                            {'bad': None})])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+        eq_(len(self.stream.msgs), 0)
+
+    def test_request_buffer(self):
+        with self.client.request_buffer(lambda buf: True):
+            self.client.heka_many([('a',), ('b',)])
+            eq_(len(self.stream.msgs), 0)
+        eq_([msg.type for msg in self._sent()], ['a', 'b'])
+
+    def test_incr_many_columns(self):
+        self.client.incr_many(['foo', 'bar'], [2, 5])
+        eq_(len(self.stream.msgs), 1)
+        msgs = self._sent()
+        eq_([(first_value(msg, 'name'), msg.payload) for msg in msgs],
+            [('foo', '2'), ('bar', '5')])
+        eq_(set(msg.type for msg in msgs), set(['counter']))
+
+    def test_incr_many_items(self):
+        fields = {'shard': 'a'}
+        self.client.incr_many(['foo', ('bar', 3)], fields=fields)
+        self.client.incr_many({'baz': 4})
+        eq_([(first_value(msg, 'name'), msg.payload,
+              first_value(msg, 'shard')) for msg in self._sent()],
+            [('foo', '1', 'a'), ('bar', '3', 'a'), ('baz', '4', None)])
+        eq_(fields, {'shard': 'a'})
+
+    def test_incr_many_sampled(self):
+        with patch('heka.client.random') as mock_random:
+            mock_random.random.return_value = 0.5
+            self.client.incr_many(['foo', 'bar'], rate=0.1)
+        eq_(len(self.stream.msgs), 0)
+
+
 class TestClientHolder(object):
     def test_get_client(self):
         heka = get_client('new_client')
@@ -477,3 +674,85 @@ class TestClientHolder(object):
         heka = get_client('amo.dev', cfg)
         assert heka != None
 
+
+class TestSharedResources(object):
+    def setUp(self):
+        self.holder = HekaClientHolder()
+        self.holder.retire_grace = 0
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in list(self.holder._clients):
+            self.holder.delete_client(name)
+        shutil.rmtree(self.tmpdir)
+
+    def _config(self, filename='out', **extra):
+        cfg = {'stream': {'class': 'heka.streams.FileStream',
+                          'filepath': os.path.join(self.tmpdir, filename)}}
+        cfg.update(extra)
+        return cfg
+
+    def test_stream_shared(self):
+        first = self.holder.configure_client('first', self._config())
+        second = self.holder.configure_client('second', self._config())
+        other = self.holder.configure_client('other', self._config('other'))
+        ok_(first.stream is second.stream)
+        ok_(other.stream is not first.stream)
+        eq_(second.logger, 'second')
+        self.holder.delete_client('first')
+        ok_(not second.stream.filestream.closed)
+        self.holder.delete_client('second')
+        ok_(second.stream.filestream.closed)
+        ok_(not other.stream.filestream.closed)
+
+    def test_reconfigure_releases(self):
+        client = self.holder.configure_client('client', self._config())
+        stream = client.stream
+        self.holder.configure_client('client', self._config())
+        ok_(client.stream is stream)
+        self.holder.configure_client('client', self._config('other'))
+        ok_(stream.filestream.closed)
+        ok_(not client.stream.filestream.closed)
+
+    def test_client_reconfigure_keeps_shared(self):
+        first = self.holder.configure_client('first', self._config())
+        second = self.holder.configure_client('second', self._config())
+        stream = first.stream
+        first.reconfigure(stream=DebugCaptureStream(), grace=0)
+        ok_(not stream.filestream.closed)
+        second.heka('test')
+        eq_(second.stats.send_errors, {})
+        # the last user of the stream replacing it closes it
+        second.reconfigure(stream=DebugCaptureStream(), grace=0)
+        ok_(stream.filestream.closed)
+        eq_(self.holder._shared, {})
+
+    def test_client_reconfigure_unshared(self):
+        client = self.holder.configure_client('client', self._config())
+        own = FileStream(os.path.join(self.tmpdir, 'own'))
+        client.reconfigure(stream=own, grace=0)
+        client.reconfigure(stream=DebugCaptureStream(), grace=0)
+        ok_(own.filestream.closed)
+
+    def test_sender_shared(self):
+        first = self.holder.configure_client(
+            'first', self._config(sender={'max_queue_size': 10}))
+        second = self.holder.configure_client(
+            'second', self._config(sender={'max_queue_size': 10}))
+        sender = first.sender
+        ok_(second.sender is sender)
+        # a different client config gets its own
+        third = self.holder.configure_client(
+            'third', self._config(sender={'max_queue_size': 10}, severity=4))
+        ok_(third.sender is not sender)
+        eq_(third.stream, first.stream)
+        self.holder.delete_client(
+            'first' if sender.client is first else 'second')
+        ok_(sender.client in (first, second))
+        ok_(sender._thread is not None)
+        first.heka('test')
+        sender.flush()
+        self.holder.delete_client('first')
+        self.holder.delete_client('second')
+        eq_(sender._thread, None)
+
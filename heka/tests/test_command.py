@@ -0,0 +1,63 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.command import _percentile, run_mb
+from nose.tools import eq_, ok_
+import StringIO
+import socket
+
+
+class TestMb(object):
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.options = {'host': '127.0.0.1',
+                        'port': self.sock.getsockname()[1],
+                        'hekacfg': None,
+                        'raw': False,
+                        'threads': 2,
+                        'processes': 1,
+                        'duration': 0.3,
+                        'size': 10,
+                        'fields': 2,
+                        'report': 0.1,
+                        }
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_rate_limited(self):
+        out = StringIO.StringIO()
+        count, nbytes, latencies, elapsed = run_mb(self.options, 100, out)
+        # 100 msgs/sec for 0.3 seconds
+        ok_(15 <= count <= 45, count)
+        ok_(nbytes > count * 10)
+        eq_(len(latencies), count)
+        ok_('live:' in out.getvalue())
+        ok_('total: %d msgs' % count in out.getvalue())
+
+    def test_raw(self):
+        self.options['raw'] = True
+        self.options['threads'] = 1
+        out = StringIO.StringIO()
+        count, nbytes, latencies, elapsed = run_mb(self.options, 50, out)
+        ok_(count > 0)
+        data = self.sock.recv(65536)
+        ok_('"payload": "xxxxxxxxxx"' in data)
+
+
+def test_percentile():
+    values = range(101)
+    eq_(_percentile(values, 50), 50)
+    eq_(_percentile(values, 99), 99)
+    eq_(_percentile([], 99), 0.0)
@@ -223,3 +223,15 @@ def test_configure_with_hmac():
                     'key': 'some_key_value',
                     'signer': 'some_signer_name'}
     eq_(client.encoder.hmc, expected_hmc)
+
+
+def test_sampler_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+    sampler_budget = 50
+    sampler_halflife = 30
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    eq_(client.sampler.__class__.__name__, 'AdaptiveSampler')
+    eq_(client.sampler.budget, 50)
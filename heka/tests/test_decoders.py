@@ -0,0 +1,117 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.decoders import StreamDecoder, decode_frames
+from heka.message import BATCH_SEPARATOR, Message
+from heka.streams import DebugCaptureStream
+from nose.tools import eq_, ok_
+from struct import pack
+import zlib
+
+
+def _frames(count):
+    stream = DebugCaptureStream()
+    client = HekaClient(stream, 'tests')
+    # same bytes every run: a stray separator byte in a uuid would make
+    # the resync tests hold on to a partial frame
+    client.hostname = 'localhost'
+    client.pid = 1
+    for i in range(count):
+        client.heka('test', payload='payload %d' % i, timestamp=1000 + i)
+    return list(stream.msgs)
+
+
+class TestStreamDecoder(object):
+    def setUp(self):
+        self.frames = _frames(3)
+        self.data = ''.join(self.frames)
+
+    def test_whole_buffer(self):
+        decoded = decode_frames(self.data)
+        eq_([msg.payload for header, msg in decoded],
+            ['payload 0', 'payload 1', 'payload 2'])
+        eq_(decoded[0][0].message_length, decoded[0][1].ByteSize())
+
+    def test_byte_at_a_time(self):
+        decoder = StreamDecoder()
+        payloads = []
+        for char in self.data:
+            for header, msg in decoder.feed(char):
+                payloads.append(msg.payload)
+        eq_(payloads, ['payload 0', 'payload 1', 'payload 2'])
+        eq_(decoder.pending, 0)
+        eq_(decoder.malformed, 0)
+
+    def test_resync(self):
+        decoder = StreamDecoder()
+        corrupt = self.frames[1][:10]
+        data = 'junk' + self.frames[0] + corrupt + self.frames[2]
+        decoded = list(decoder.feed(data))
+        eq_([msg.payload for header, msg in decoded],
+            ['payload 0', 'payload 2'])
+        eq_(decoder.malformed, 2)
+
+    def test_max_message_size(self):
+        decoder = StreamDecoder(max_message_size=10)
+        eq_(list(decoder.feed(self.data)), [])
+        eq_(decoder.malformed, 1)
+        # nothing worth keeping is left behind
+        list(decoder.feed(''))
+        ok_(decoder.pending < 10)
+
+    def test_lazy(self):
+        decoder = StreamDecoder(lazy=True)
+        decoded = list(decoder.feed(self.data))
+        eq_(len(decoded), 3)
+        header, payload = decoded[0]
+        ok_(isinstance(payload, memoryview))
+        msg = Message()
+        msg.ParseFromString(payload.tobytes())
+        eq_(msg.payload, 'payload 0')
+        # views still alive, feeding more must not break them
+        decoded2 = list(decoder.feed(self.frames[0]))
+        eq_(len(decoded2), 1)
+        eq_(payload.tobytes(), self.frames[0][-len(payload):])
+
+    def _batch(self, data):
+        compressed = zlib.compress(data)
+        return pack('!BI', BATCH_SEPARATOR, len(compressed)) + compressed
+
+    def test_batch(self):
+        data = self.frames[0] + self._batch(self.frames[1] + self.frames[2])
+        decoder = StreamDecoder()
+        payloads = []
+        for i in range(0, len(data), 5):
+            for header, msg in decoder.feed(data[i:i + 5]):
+                payloads.append(msg.payload)
+        eq_(payloads, ['payload 0', 'payload 1', 'payload 2'])
+        eq_(decoder.batches, 1)
+        eq_(decoder.malformed, 0)
+
+    def test_corrupt_batch(self):
+        batch = self._batch(self.data)
+        corrupt = batch[:10] + 'x' * (len(batch) - 10)
+        decoder = StreamDecoder()
+        decoded = list(decoder.feed(corrupt + self.frames[0]))
+        eq_([msg.payload for header, msg in decoded], ['payload 0'])
+        eq_(decoder.malformed, 1)
+        eq_(decoder.batches, 0)
+
+    def test_nested_batch(self):
+        nested = self._batch(self.frames[0] + self._batch(self.data))
+        decoder = StreamDecoder()
+        decoded = list(decoder.feed(nested + self.frames[1]))
+        eq_([msg.payload for header, msg in decoded], ['payload 1'])
+        eq_(decoder.malformed, 1)
+        eq_(decoder.batches, 0)
@@ -17,12 +17,16 @@ from __future__ import absolute_import
 
 from datetime import datetime
 from hashlib import sha1, md5
+from heka.client import HekaClient
+from heka.decoders import decode_frames
 from heka.encoders import ProtobufEncoder
 from heka.encoders import UNIT_SEPARATOR, RECORD_SEPARATOR
 from heka.message import first_value, Header, Message
 from heka.tests.helpers import decode_message
+from heka.streams import DebugCaptureStream
 from heka.tests.helpers import dict_to_msg
-from nose.tools import eq_
+from mock import patch
+from nose.tools import eq_, ok_, raises
 import base64
 import hmac
 import json
@@ -102,3 +106,145 @@ class TestProtobufEncoder(object):
         payload = enc.msg_to_payload(SAMPLE_MSG)
         e1 = hmac.new(hmac_signer['key'], payload, md5).digest()
         eq_(header.hmac, e1)
+
+
+class TestHmacSigner(object):
+    hmc = {'signer': 'vic',
+           'key_version': 1,
+           'hash_function': 'SHA1',
+           'key': 'some_key'}
+
+    def _reference(self, payload, hmc=None):
+        # the frame as built by the generated Header class
+        h = Header()
+        h.message_length = len(payload)
+        if hmc:
+            h.hmac_signer = hmc['signer']
+            h.hmac_key_version = hmc['key_version']
+            h.hmac_hash_function = Header.HmacHashFunction.Value(
+                hmc['hash_function'])
+            h.hmac = hmac.new(hmc['key'], payload,
+                              {'SHA1': sha1, 'MD5': md5}[hmc['hash_function']]
+                              ).digest()
+        header = h.SerializeToString()
+        return (chr(RECORD_SEPARATOR) + chr(len(header)) + header +
+                chr(UNIT_SEPARATOR) + payload)
+
+    def test_same_bytes_as_header(self):
+        md5_hmc = dict(self.hmc, hash_function='MD5', key_version=300)
+        for hmc in (None, self.hmc, md5_hmc):
+            enc = ProtobufEncoder(hmc)
+            payload = enc.msg_to_payload(SAMPLE_MSG)
+            eq_(enc.encode(SAMPLE_MSG), self._reference(payload, hmc))
+        # multi byte message length
+        big = Message(uuid='0123456789012345', timestamp=1,
+                      payload='x' * 1000)
+        enc = ProtobufEncoder(self.hmc)
+        eq_(enc.encode(big),
+            self._reference(enc.msg_to_payload(big), self.hmc))
+
+    def test_key_not_rederived(self):
+        enc = ProtobufEncoder(self.hmc)
+        with patch('heka.encoders.hmac') as mock_hmac:
+            enc.encode(SAMPLE_MSG)
+            enc.encode(SAMPLE_MSG)
+        ok_(not mock_hmac.new.called)
+
+    def test_rotate_key(self):
+        enc = ProtobufEncoder(self.hmc)
+        new_hmc = dict(self.hmc, key_version=2, key='new_key')
+        enc.rotate_key(new_hmc)
+        eq_(enc.hmc, new_hmc)
+        header, message = decode_message(enc.encode(SAMPLE_MSG))
+        eq_(header.hmac_key_version, 2)
+        payload = enc.msg_to_payload(SAMPLE_MSG)
+        eq_(header.hmac, hmac.new('new_key', payload, sha1).digest())
+
+        enc.rotate_key(None)
+        header, message = decode_message(enc.encode(SAMPLE_MSG))
+        ok_(not header.HasField('hmac'))
+
+    def test_compute_hmac(self):
+        enc = ProtobufEncoder(self.hmc)
+        payload = enc.msg_to_payload(SAMPLE_MSG)
+        md5_hmc = dict(self.hmc, hash_function='MD5')
+        for hmc in (self.hmc, md5_hmc):
+            header = Header(message_length=len(payload))
+            enc.compute_hmac(header, hmc, payload)
+            eq_(chr(RECORD_SEPARATOR) + chr(header.ByteSize()) +
+                header.SerializeToString() + chr(UNIT_SEPARATOR) + payload,
+                self._reference(payload, hmc))
+
+    def test_string_key_version(self):
+        # as read from an ini file
+        enc = ProtobufEncoder(dict(self.hmc, key_version='3'))
+        header, message = decode_message(enc.encode(SAMPLE_MSG))
+        eq_(header.hmac_key_version, 3)
+
+
+class TestJsonEncoder(object):
+    hmc = {'signer': 'vic',
+           'key_version': 1,
+           'hash_function': 'SHA1',
+           'key': 'some_key'}
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, 'tests',
+                                 encoder='heka.encoders.JsonEncoder')
+
+    def _decode(self, data):
+        [(header, payload)] = decode_frames(data, lazy=True)
+        return header, json.loads(payload.tobytes())
+
+    def test_encode_args(self):
+        fields = {'foo': 'bar', 'count': 3, 'ratio': 0.5, 'flag': True,
+                  'nested': {'path': u'/caf\xe9'}}
+        with patch.object(HekaClient, 'send_message') as mock_send:
+            self.client.heka('sometype', payload='some data',
+                             fields=fields, timestamp=1000.5)
+        ok_(not mock_send.called)
+        header, decoded = self._decode(self.stream.msgs[0])
+        eq_(header.message_length,
+            len(self.stream.msgs[0]) - len(header.SerializeToString()) - 3)
+        uuid.UUID(decoded.pop('uuid'))
+        eq_(decoded, {'timestamp': 1000500000000,
+                      'type': 'sometype',
+                      'logger': 'tests',
+                      'severity': 6,
+                      'payload': 'some data',
+                      'env_version': self.client.env_version,
+                      'pid': self.client.pid,
+                      'hostname': self.client.hostname,
+                      'fields': {'foo': 'bar', 'count': 3, 'ratio': 0.5,
+                                 'flag': 1, 'nested.path': u'/caf\xe9'}})
+
+    def test_same_as_message(self):
+        fields = {'foo': 'bar', 'count': 3, 'nested': {'ratio': 0.25}}
+        self.client.heka('sometype', payload='x', fields=fields,
+                         timestamp=5)
+        header, from_args = self._decode(self.stream.msgs[0])
+        msg = self.client._build_message('sometype', 'tests', 6, 'x',
+                                         fields, 5)
+        header, from_msg = self._decode(self.client.encoder.encode(msg))
+        eq_(from_msg.pop('uuid'), str(uuid.UUID(bytes=msg.uuid)))
+        from_args.pop('uuid')
+        eq_(from_args, from_msg)
+
+    def test_filters_use_message(self):
+        self.client.filters = [lambda msg: True]
+        with patch.object(HekaClient, 'send_message') as mock_send:
+            self.client.incr('foo')
+        eq_(mock_send.call_count, 1)
+
+    def test_hmac(self):
+        self.client.encoder.rotate_key(self.hmc)
+        self.client.incr('foo')
+        header, payload = decode_frames(self.stream.msgs[0], lazy=True)[0]
+        eq_(header.hmac_signer, 'vic')
+        eq_(header.hmac, hmac.new('some_key', payload.tobytes(),
+                                  sha1).digest())
+
+    @raises(ValueError)
+    def test_none_field(self):
+        self.client.heka('sometype', fields={'foo': None})
@@ -0,0 +1,185 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka import fields
+from heka.client import HekaClient
+from heka.decoders import decode_frames
+from heka.encoders import ProtobufEncoder
+from heka.fields import array_values, flatten_plan
+from heka.message import Field, Message
+from heka.streams import DebugCaptureStream
+from heka.tests.helpers import decode_message
+from heka.util import json
+from nose.tools import eq_, ok_, raises
+import array
+import subprocess
+import sys
+
+
+FIELDS = {'int': -5, 'float': 1.5, 'str': 'bar', 'unicode': u'\xe9',
+          'bool': True, 'nested': {'a': 1, 'b': {'c': 'deep'}}}
+
+ARRAYS = {'ints': [1, -2, 300, True], 'floats': (0.5, 2, -1e300),
+          'strings': ['a', u'\xe9'], 'empty': [],
+          'doubles': array.array('d', [1.5, 2.5]),
+          'singles': array.array('f', [0.5]),
+          'longs': array.array('l', [2 ** 40, -1])}
+
+
+class TestFlattenPlan(object):
+    def setUp(self):
+        fields._plans.clear()
+
+    def test_plan(self):
+        plan = flatten_plan({'a': 1, 'b': {'c': 'x'}})
+        eq_(sorted(entry[2:4] for entry in plan),
+            [('a', Field.INTEGER), ('b', None)])
+        [(key, vtype, name, value_type, attr, wire)] = \
+            flatten_plan({'c': 'x'}, 'b')
+        eq_((name, value_type, attr), ('b.c', Field.STRING, 'value_string'))
+        f = Field()
+        f.MergeFromString(wire)
+        eq_(f.name, 'b.c')
+
+    def test_cached(self):
+        plan = flatten_plan({'a': 1})
+        ok_(flatten_plan({'a': 2}) is plan)
+
+    def test_type_change(self):
+        plan = flatten_plan({'a': 1})
+        replanned = flatten_plan({'a': 'x'})
+        ok_(replanned is not plan)
+        eq_(replanned[0][3], Field.STRING)
+
+    def test_bounded(self):
+        for i in range(fields.MAX_PLANS + 1):
+            flatten_plan({'key%d' % i: 1})
+        ok_(len(fields._plans) <= fields.MAX_PLANS)
+
+    @raises(ValueError)
+    def test_none(self):
+        flatten_plan({'a': None})
+
+    @raises(ValueError)
+    def test_unexpected_type(self):
+        flatten_plan({'a': set([1])})
+
+
+class TestArgsToPayload(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+
+    def _message_path(self, **kwargs):
+        # the same arguments through a Message
+        return self.client._build_message('test', self.logger, 6,
+                                          kwargs.get('payload', ''),
+                                          kwargs.get('fields', {}),
+                                          1234.5)
+
+    def test_same_as_message(self):
+        self.client.heka('test', payload=u'caf\xe9', fields=FIELDS,
+                         timestamp=1234.5)
+        msg = decode_message(self.stream.msgs[0])[1]
+        expected = self._message_path(payload=u'caf\xe9', fields=FIELDS)
+        eq_(len(msg.uuid), 16)
+        msg.uuid = expected.uuid
+        eq_(msg.SerializeToString(), expected.SerializeToString())
+
+    def test_negative_severity(self):
+        payload = ProtobufEncoder().args_to_payload(self.client, 'test', '',
+                                                    -1, '', {}, None)
+        msg = Message()
+        msg.ParseFromString(payload)
+        eq_(msg.severity, -1)
+
+    def test_filters_use_message(self):
+        self.client.filters = [lambda msg: msg.type == 'test']
+        self.client.heka('test', fields=FIELDS)
+        self.client.heka('other', fields=FIELDS)
+        eq_(len(self.stream.msgs), 1)
+
+    def test_arrays_same_as_message(self):
+        self.client.heka('test', fields=ARRAYS, timestamp=1234.5)
+        msg = decode_message(self.stream.msgs[0])[1]
+        expected = self._message_path(fields=ARRAYS)
+        msg.uuid = expected.uuid
+        eq_(msg.SerializeToString(), expected.SerializeToString())
+        values = dict((f.name, f) for f in msg.fields)
+        eq_(list(values['ints'].value_integer), [1, -2, 300, 1])
+        eq_(list(values['floats'].value_double), [0.5, 2.0, -1e300])
+        eq_(list(values['longs'].value_integer), [2 ** 40, -1])
+        eq_(values['empty'].value_type, Field.INTEGER)
+
+    def test_arrays_json(self):
+        client = HekaClient(self.stream, self.logger,
+                            encoder='heka.encoders.JsonEncoder')
+        client.heka('test', fields=ARRAYS)
+        client.filters = [lambda msg: True]
+        client.heka('test', fields=ARRAYS)
+        decoded = [json.loads(payload.tobytes())
+                   for data in self.stream.msgs
+                   for header, payload in decode_frames(data, lazy=True)]
+        eq_(decoded[0]['fields'], decoded[1]['fields'])
+        eq_(decoded[0]['fields']['ints'], [1, -2, 300, 1])
+        eq_(decoded[0]['fields']['singles'], 0.5)
+
+    def test_bytes(self):
+        blobs = {'raw': bytearray('\x00\xff'), 'view': memoryview('\x01'),
+                 'buf': buffer('abc'), 'many': [bytearray('a'), buffer('b')]}
+        self.client.heka('test', fields=blobs, timestamp=1234.5)
+        msg = decode_message(self.stream.msgs[0])[1]
+        expected = self._message_path(fields=blobs)
+        msg.uuid = expected.uuid
+        eq_(msg.SerializeToString(), expected.SerializeToString())
+        values = dict((f.name, f) for f in msg.fields)
+        eq_(values['raw'].value_type, Field.BYTES)
+        eq_(list(values['raw'].value_bytes), ['\x00\xff'])
+        eq_(list(values['many'].value_bytes), ['a', 'b'])
+
+    def test_bytes_json(self):
+        client = HekaClient(self.stream, self.logger,
+                            encoder='heka.encoders.JsonEncoder')
+        client.heka('test', fields={'view': memoryview('\xff')})
+        [(header, payload)] = decode_frames(self.stream.msgs[0], lazy=True)
+        eq_(json.loads(payload.tobytes())['fields'], {'view': '/w=='})
+
+    def test_define_bytes(self):
+        emit = self.client.define('test', [('digest', bytearray)])
+        emit('\xff\x00')
+        [f] = decode_message(self.stream.msgs[0])[1].fields
+        eq_((f.value_type, list(f.value_bytes)), (Field.BYTES, ['\xff\x00']))
+
+    @raises(ValueError)
+    def test_mixed_array(self):
+        array_values([1, 'a'])
+
+    @raises(ValueError)
+    def test_char_array(self):
+        array_values(array.array('c', 'abc'))
+
+    @raises(ValueError)
+    def test_invalid_utf8(self):
+        self.client.heka('test', fields={'a': '\xff'})
+
+
+def test_without_memoryview():
+    # as on Python 2.6
+    code = ("import __builtin__; del __builtin__.memoryview; "
+            "import heka.client, heka.encoders; "
+            "from heka.streams import DebugCaptureStream; "
+            "client = heka.client.HekaClient(DebugCaptureStream(), 'tests'); "
+            "client.heka('test', fields={'data': bytearray('x')})")
+    eq_(subprocess.call([sys.executable, '-c', code]), 0)
@@ -0,0 +1,144 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.config import client_from_text_config
+from heka.decoders import decode_frames
+from heka.limits import chunk_policy_provider
+from heka.limits import compress_policy_provider
+from heka.limits import truncate_policy_provider
+from heka.message import Field
+from heka.message import first_value
+from heka.streams import DebugCaptureStream
+from heka.util import json
+from nose.tools import eq_, ok_
+import os
+import zlib
+
+
+class TestSizePolicies(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger,
+                                 max_payload_size=100)
+
+    def _sent(self):
+        return [msg for data in self.stream.msgs
+                for header, msg in decode_frames(data)]
+
+    def test_small_untouched(self):
+        self.client.size_policy = truncate_policy_provider()
+        self.client.heka('test', payload='x' * 100)
+        [msg] = self._sent()
+        eq_(msg.payload, 'x' * 100)
+        eq_(len(msg.fields), 0)
+        eq_(self.client.stats.oversized, 0)
+
+    def test_no_policy(self):
+        self.client.heka('test', payload='x' * 500)
+        [msg] = self._sent()
+        eq_(len(msg.payload), 500)
+
+    def test_truncate(self):
+        self.client.size_policy = truncate_policy_provider()
+        self.client.heka('test', payload='x' * 500)
+        [msg] = self._sent()
+        eq_(msg.payload, 'x' * 100)
+        eq_(first_value(msg, 'truncated'), 500)
+        eq_(self.client.stats.oversized, 1)
+
+    def test_truncate_utf8(self):
+        self.client.size_policy = truncate_policy_provider()
+        self.client.max_payload_size = 101
+        self.client.heka('test', payload=u'\xe9' * 100)
+        [msg] = self._sent()
+        eq_(msg.payload, u'\xe9' * 50)
+
+    def test_compress(self):
+        self.client.size_policy = compress_policy_provider()
+        self.client.heka('test', payload='x' * 500)
+        [msg] = self._sent()
+        eq_(msg.payload, '')
+        [f] = msg.fields
+        eq_(f.name, 'payload')
+        eq_(f.value_type, Field.BYTES)
+        eq_(f.representation, 'zlib')
+        eq_(zlib.decompress(f.value_bytes[0]), 'x' * 500)
+
+    def test_compress_too_big(self):
+        self.client.size_policy = compress_policy_provider()
+        payload = os.urandom(1000).encode('hex')
+        self.client.heka('test', payload=payload)
+        [msg] = self._sent()
+        eq_(msg.payload, payload[:100])
+        eq_(first_value(msg, 'truncated'), 2000)
+
+    def test_chunk(self):
+        self.client.size_policy = chunk_policy_provider()
+        payload = ''.join(chr(ord('a') + i % 26) for i in range(250))
+        self.client.heka('test', payload=payload, fields={'foo': 'bar'})
+        msgs = self._sent()
+        eq_(len(msgs), 3)
+        eq_(''.join(msg.payload for msg in msgs), payload)
+        eq_([first_value(msg, 'chunk.index') for msg in msgs], [0, 1, 2])
+        eq_(set(first_value(msg, 'chunk.count') for msg in msgs), set([3]))
+        eq_(len(set(first_value(msg, 'chunk.uuid') for msg in msgs)), 1)
+        eq_(len(set(msg.uuid for msg in msgs)), 3)
+        eq_(set(first_value(msg, 'foo') for msg in msgs), set(['bar']))
+
+    def test_batch(self):
+        self.client.size_policy = chunk_policy_provider()
+        with self.client.request_buffer(lambda buf: True):
+            self.client.heka('test', payload='x' * 250)
+            self.client.heka('test', payload='small')
+        eq_(len(self._sent()), 4)
+
+    def test_json_args(self):
+        client = HekaClient(self.stream, self.logger,
+                            encoder='heka.encoders.JsonEncoder',
+                            size_policy=truncate_policy_provider(),
+                            max_payload_size=100)
+        client.heka('test', payload='x' * 500)
+        [(header, payload)] = decode_frames(self.stream.msgs[0], lazy=True)
+        decoded = json.loads(payload.tobytes())
+        eq_(decoded['payload'], 'x' * 100)
+        eq_(decoded['fields'], {'truncated': 500})
+
+
+def test_config_per_stream():
+    cfg_txt = """
+    [heka]
+    stream_class = %s
+    stream_host = 127.0.0.1
+    stream_port = 5565
+    max_payload_size = 1000
+
+    [heka_size_policy]
+    provider = heka.limits.truncate_policy_provider
+    marker = cut
+
+    [heka_size_policy_udp]
+    provider = heka.limits.chunk_policy_provider
+    stream = heka.streams.UdpStream
+    """
+    client = client_from_text_config(cfg_txt % 'heka.streams.UdpStream',
+                                     'heka')
+    eq_(client.size_policy.__name__, 'chunk_policy')
+    eq_(client.max_payload_size, 1000)
+
+    client = client_from_text_config(cfg_txt % 'heka.streams.TcpStream',
+                                     'heka')
+    eq_(client.size_policy.__name__, 'truncate_policy')
+    ok_(client.stream is not None)
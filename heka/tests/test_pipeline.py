@@ -0,0 +1,209 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.decoders import decode_frames
+from heka.encoders import JsonEncoder, ProtobufEncoder
+from heka.filters import type_blacklist_provider
+from heka.pipeline import Pipeline, RETIRE_GRACE, retire
+from heka.sender import BackgroundSender
+from heka.streams import DebugCaptureStream
+from heka.util import json
+from nose.tools import eq_, ok_, raises
+import threading
+import time
+
+
+class ClosingStream(DebugCaptureStream):
+    def __init__(self):
+        super(ClosingStream, self).__init__()
+        self.closed = False
+
+    def write(self, msg):
+        if self.closed:
+            raise IOError('closed')
+        super(ClosingStream, self).write(msg)
+
+    def close(self):
+        self.closed = True
+
+
+class WrappingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, msg):
+        self.stream.write(msg)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream = None
+
+
+class TestReconfigure(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = ClosingStream()
+        self.client = HekaClient(self.stream, self.logger)
+
+    def test_stream_swapped(self):
+        new_stream = ClosingStream()
+        old = self.client._pipeline
+        pipeline = self.client.reconfigure(stream=new_stream, grace=0)
+        ok_(self.client._pipeline is pipeline)
+        ok_(old.stream is self.stream)
+        ok_(self.stream.closed)
+        self.client.incr('foo')
+        eq_(len(new_stream.msgs), 1)
+        eq_(len(self.stream.msgs), 0)
+
+    def test_kept_parts(self):
+        encoder = self.client.encoder
+        self.client.reconfigure(
+            filters=[type_blacklist_provider(['counter'])], grace=0)
+        ok_(not self.stream.closed)
+        ok_(self.client.encoder is encoder)
+        self.client.incr('foo')
+        self.client.heka('test')
+        eq_(len(self.stream.msgs), 1)
+
+    def test_encoder(self):
+        self.client.reconfigure(encoder='heka.encoders.JsonEncoder')
+        ok_(isinstance(self.client.encoder, JsonEncoder))
+        ok_(not self.stream.closed)
+
+    def test_hmac(self):
+        hmc = {'signer': 'tests', 'key_version': 2, 'hash_function': 'SHA1',
+               'key': 'secret'}
+        self.client.reconfigure(hmc=hmc)
+        ok_(isinstance(self.client.encoder, ProtobufEncoder))
+        self.client.heka('test')
+        [(header, msg)] = decode_frames(self.stream.msgs[0])
+        eq_(header.hmac_key_version, 2)
+
+    @raises(TypeError)
+    def test_unknown_argument(self):
+        self.client.reconfigure(logger='other')
+
+    def test_sender(self):
+        sender = BackgroundSender()
+        self.client.reconfigure(sender=sender)
+        ok_(sender.client is self.client)
+        self.client.heka('test')
+        sender.flush()
+        eq_(len(self.stream.msgs), 1)
+        self.client.reconfigure(sender=None, grace=0)
+        # closed
+        eq_(sender._thread, None)
+
+    def test_attribute_swaps(self):
+        old = self.client._pipeline
+        self.client.filters = [lambda msg: True]
+        ok_(self.client._pipeline is not old)
+        eq_(old.filters, [])
+        eq_(len(self.client._pipeline.filters), 1)
+
+    def test_sender_attribute(self):
+        sender = BackgroundSender()
+        self.client.sender = sender
+        ok_(sender.client is self.client)
+        self.client.incr('a')
+        sender.flush()
+        eq_(len(self.stream.msgs), 1)
+        self.client.sender = None
+        # not closed by a plain assignment
+        ok_(sender._thread.isAlive())
+        sender.close()
+
+    def test_retire_hook(self):
+        retired = []
+        client = HekaClient(self.stream, self.logger,
+                            retire=lambda *args: retired.append(args))
+        old = client._pipeline
+        new = client.reconfigure(stream=ClosingStream(), grace=0)
+        eq_(retired, [(old, new, 0)])
+        # the hook decides what is closed
+        ok_(not self.stream.closed)
+        client.reconfigure(stream=self.stream, grace=None)
+        eq_(len(retired), 1)
+
+    def test_wrapped_stream_kept(self):
+        self.client.reconfigure(stream=WrappingStream(self.stream), grace=0)
+        ok_(not self.stream.closed)
+        self.client.incr('foo')
+        eq_(len(self.stream.msgs), 1)
+
+    def test_assigned_wrapper(self):
+        self.client.stream = WrappingStream(self.client.stream)
+        time.sleep(RETIRE_GRACE + 0.1)
+        self.client.incr('foo')
+        ok_(not self.stream.closed)
+        eq_(self.client.stats.send_errors, {})
+        eq_(len(self.stream.msgs), 1)
+
+    def test_under_load(self):
+        # every message is encoded and written by a single pipeline
+        streams = {ProtobufEncoder: [self.stream], JsonEncoder: []}
+        stop = threading.Event()
+
+        def emit():
+            while not stop.isSet():
+                self.client.heka('test', payload='x')
+        threads = [threading.Thread(target=emit) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(20):
+                for encoder in (JsonEncoder, ProtobufEncoder):
+                    stream = ClosingStream()
+                    streams[encoder].append(stream)
+                    self.client.reconfigure(stream=stream, encoder=encoder,
+                                            grace=0.5)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        eq_(self.client.stats.send_errors, {})
+        # all but the current stream are retired
+        time.sleep(0.6)
+        eq_([stream for stream in streams[ProtobufEncoder]
+             if not stream.closed], [self.client.stream])
+        ok_(all(stream.closed for stream in streams[JsonEncoder]))
+        for stream in streams[ProtobufEncoder]:
+            for data in stream.msgs:
+                decode_frames(data)
+        for stream in streams[JsonEncoder]:
+            for data in stream.msgs:
+                [(header, payload)] = decode_frames(data, lazy=True)
+                eq_(json.loads(payload.tobytes())['payload'], 'x')
+
+
+def test_replace():
+    stream = DebugCaptureStream()
+    pipeline = Pipeline(stream, ProtobufEncoder(None))
+    other = pipeline.replace(filters=[None])
+    ok_(other.stream is stream)
+    eq_(pipeline.filters, ())
+    eq_(other.filters, [None])
+    eq_(other.router, None)
+
+
+def test_retire_keeps():
+    stream = ClosingStream()
+    eq_(retire(Pipeline(stream), keep=[stream], grace=0), None)
+    ok_(not stream.closed)
+    retire(Pipeline(stream), grace=0.01).join()
+    ok_(stream.closed)
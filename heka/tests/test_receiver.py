@@ -0,0 +1,166 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.receiver import HekaReceiver, HekaRelay, serve
+from heka.streams import DebugCaptureStream, TcpStream, UdpStream
+from heka.streams import ZlibBatchStream
+from nose.tools import eq_, ok_
+import time
+
+HMAC_CONFIG = {'signer': 'vic', 'key_version': 1, 'hash_function': 'SHA1',
+               'key': 'some_key'}
+
+
+def _frames(count, hmc=None):
+    stream = DebugCaptureStream()
+    client = HekaClient(stream, 'tests', hmc=hmc)
+    for i in range(count):
+        client.incr('foo')
+    return list(stream.msgs)
+
+
+def _wait_for(receiver, count, timeout=2):
+    deadline = time.time() + timeout
+    while receiver.stats.messages < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TestHekaReceiver(object):
+    def setUp(self):
+        self.receiver = HekaReceiver({('vic', 1): 'some_key'})
+
+    def test_concatenated(self):
+        data = ''.join(_frames(3))
+        self.receiver.feed(data)
+        stats = self.receiver.take()
+        eq_(stats['messages'], 3)
+        eq_(stats['bytes'], len(data))
+        eq_(stats['malformed'], 0)
+        ok_(stats['latency_p50'] >= 0)
+
+    def test_split_chunks(self):
+        data = ''.join(_frames(3))
+        decoder = self.receiver.decoder()
+        for i in range(0, len(data), 7):
+            self.receiver.feed(data[i:i + 7], decoder)
+        eq_(decoder.pending, 0)
+        eq_(self.receiver.take()['messages'], 3)
+
+    def test_resync_after_garbage(self):
+        frames = _frames(2)
+        self.receiver.feed('garbage' + frames[0] + 'more' + frames[1])
+        stats = self.receiver.take()
+        eq_(stats['messages'], 2)
+        eq_(stats['malformed'], 2)
+
+    def test_truncated_datagram(self):
+        frame = _frames(1)[0]
+        self.receiver.feed(frame[:-3])
+        stats = self.receiver.take()
+        eq_(stats['messages'], 0)
+        eq_(stats['malformed'], 1)
+
+    def test_hmac(self):
+        frames = _frames(1, HMAC_CONFIG)
+        self.receiver.feed(frames[0])
+        eq_(self.receiver.take()['messages'], 1)
+
+        bad_key = dict(HMAC_CONFIG, key='wrong')
+        self.receiver.feed(_frames(1, bad_key)[0])
+        stats = self.receiver.take()
+        eq_(stats['messages'], 0)
+        eq_(stats['bad_hmac'], 1)
+
+
+class TestHekaRelay(object):
+    def test_expand_batches(self):
+        frames = _frames(3, HMAC_CONFIG)
+        batches = DebugCaptureStream()
+        stream = ZlibBatchStream(batches, max_latency=0)
+        for frame in frames:
+            stream.write(frame)
+        stream.drain()
+
+        out = DebugCaptureStream()
+        relay = HekaRelay(out)
+        relay.feed(batches.msgs[0])
+        eq_(list(out.msgs), frames)
+        eq_(relay.take()['messages'], 3)
+
+    def test_verify(self):
+        out = DebugCaptureStream()
+        relay = HekaRelay(out, {('vic', 1): 'wrong'})
+        relay.feed(_frames(1, HMAC_CONFIG)[0])
+        eq_(len(out.msgs), 0)
+        eq_(relay.take()['bad_hmac'], 1)
+
+
+class TestServers(object):
+    def setUp(self):
+        self.receiver = HekaReceiver()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _serve(self, transport):
+        server = serve(self.receiver, transport, ('127.0.0.1', 0))
+        self.servers.append(server)
+        return server.server_address[1]
+
+    def test_udp(self):
+        port = self._serve('udp')
+        client = HekaClient(UdpStream('127.0.0.1', port), 'tests')
+        for i in range(5):
+            client.incr('foo')
+        _wait_for(self.receiver, 5)
+        eq_(self.receiver.take()['messages'], 5)
+
+    def test_udp_large_datagram(self):
+        port = self._serve('udp')
+        client = HekaClient(UdpStream('127.0.0.1', port), 'tests')
+        client.heka('test', payload='x' * 50000)
+        _wait_for(self.receiver, 1)
+        stats = self.receiver.take()
+        eq_(stats['messages'], 1)
+        eq_(stats['malformed'], 0)
+
+    def test_udp_batch_near_limit(self):
+        port = self._serve('udp')
+        # messages of 1kB, which 64 at a time would exceed a datagram
+        capture = DebugCaptureStream()
+        sizer = HekaClient(capture, 'tests')
+        size = 1024
+        while not capture.msgs or len(capture.msgs[-1]) > 1024:
+            size -= 1
+            payload = 'x' * size
+            sizer.heka('test', payload=payload)
+        eq_(len(capture.msgs[-1]), 1024)
+        client = HekaClient(UdpStream('127.0.0.1', port), 'tests')
+        client.heka_many([('test', None, None, payload)] * 128)
+        _wait_for(self.receiver, 128)
+        eq_(client.stats.send_errors, {})
+        eq_(self.receiver.take()['messages'], 128)
+
+    def test_tcp(self):
+        port = self._serve('tcp')
+        stream = TcpStream('127.0.0.1', port)
+        client = HekaClient(stream, 'tests')
+        for i in range(5):
+            client.incr('foo')
+        _wait_for(self.receiver, 5)
+        stream.sockets[0].close()
+        eq_(self.receiver.take()['messages'], 5)
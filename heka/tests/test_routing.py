@@ -0,0 +1,152 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient, SEVERITY
+from heka.config import client_from_text_config
+from heka.decoders import decode_frames
+from heka.filters import type_blacklist_provider
+from heka.limits import chunk_policy_provider
+from heka.message import first_value
+from heka.sender import BackgroundSender
+from heka.streams import DebugCaptureStream, Route, RoutingStream
+from heka.util import json
+from nose.tools import eq_, ok_
+
+
+def _types(stream):
+    return [msg.type for data in stream.msgs
+            for header, msg in decode_frames(data)]
+
+
+class TestRoutingStream(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.default = DebugCaptureStream()
+        self.metrics = DebugCaptureStream()
+        self.logs = DebugCaptureStream()
+        self.spool = DebugCaptureStream()
+        self.stream = RoutingStream(self.default, [
+            Route(self.metrics, types='timer counter'),
+            Route(self.logs, encoder='heka.encoders.JsonEncoder',
+                  types=['oldstyle']),
+            Route(self.spool, max_severity='critical', tee=True),
+        ])
+        self.client = HekaClient(self.stream, self.logger)
+
+    def test_routed_by_type(self):
+        self.client.incr('foo')
+        self.client.timer_send('bar', 10)
+        self.client.heka('other', payload='x')
+        eq_(_types(self.metrics), ['counter', 'timer'])
+        eq_(_types(self.default), ['other'])
+        eq_(len(self.logs.msgs), 0)
+        eq_(len(self.spool.msgs), 0)
+
+    def test_route_encoder(self):
+        self.client.info('hello')
+        [(header, payload)] = decode_frames(self.logs.msgs[0], lazy=True)
+        eq_(json.loads(payload.tobytes())['payload'], 'hello')
+
+    def test_tee(self):
+        self.client.critical('oops')
+        self.client.heka('other', severity=SEVERITY.ALERT)
+        eq_(_types(self.spool), ['oldstyle', 'other'])
+        eq_(len(self.logs.msgs), 1)
+        # the spool doesn't take messages away from the default stream
+        eq_(_types(self.default), ['other'])
+
+    def test_logger(self):
+        stream = RoutingStream(self.default, [
+            Route(self.logs, loggers='db', types='timer')])
+        client = HekaClient(stream, self.logger)
+        client.timer_send('a', 1)
+        client.timer_send('b', 1, logger='db')
+        eq_(len(self.logs.msgs), 1)
+        eq_(len(self.default.msgs), 1)
+
+    def test_lookup_cached(self):
+        routes = self.stream.routes_for('counter', 'tests', 6)
+        eq_(routes, (self.stream.routes[0],))
+        ok_(self.stream.routes_for('counter', 'tests', 6) is routes)
+        eq_(self.stream.routes_for('counter', 'tests', 1),
+            (self.stream.routes[0], self.stream.routes[2]))
+
+    def test_batch_per_route(self):
+        self.client.heka_many([('counter',), ('other',), ('counter',)])
+        # one write per route
+        eq_(len(self.metrics.msgs), 1)
+        eq_(len(decode_frames(self.metrics.msgs[0])), 2)
+        eq_(_types(self.default), ['other'])
+
+    def test_filters_once(self):
+        self.client.filters = [type_blacklist_provider(['counter'])]
+        self.client.incr('foo')
+        self.client.critical('oops')
+        eq_(len(self.metrics.msgs), 0)
+        eq_(len(self.spool.msgs), 1)
+        eq_(len(self.logs.msgs), 1)
+        eq_(self.client.stats.emitted, 2)
+        eq_(self.client.stats.filtered, {'type_blacklist': 1})
+
+    def test_size_policy(self):
+        self.client.size_policy = chunk_policy_provider()
+        self.client.max_payload_size = 10
+        self.client.heka('other', payload='x' * 25)
+        msgs = [msg for data in self.default.msgs
+                for header, msg in decode_frames(data)]
+        eq_([first_value(msg, 'chunk.index') for msg in msgs], [0, 1, 2])
+
+    def test_define(self):
+        timer = self.client.define('timer', [('ms', int)])
+        timer(5)
+        eq_(_types(self.metrics), ['timer'])
+
+    def test_sender(self):
+        sender = BackgroundSender()
+        client = HekaClient(self.stream, self.logger, sender=sender)
+        client.incr('foo')
+        client.critical('oops')
+        sender.close()
+        eq_(_types(self.metrics), ['counter'])
+        eq_(_types(self.spool), ['oldstyle'])
+
+
+def test_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+
+    [heka_route_metrics]
+    types = timer
+        counter
+    stream_class = heka.streams.DebugCaptureStream
+
+    [heka_route_spool]
+    max_severity = critical
+    tee = true
+    encoder = heka.encoders.JsonEncoder
+    stream_class = heka.streams.DebugCaptureStream
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    stream = client.stream
+    ok_(isinstance(stream, RoutingStream))
+    ok_(isinstance(stream.default.stream, DebugCaptureStream))
+    eq_([route.name for route in stream.routes], ['metrics', 'spool'])
+    metrics, spool = stream.routes
+    eq_(metrics.types, frozenset(['timer', 'counter']))
+    eq_(spool.max_severity, SEVERITY.CRITICAL)
+    ok_(spool.tee)
+    eq_(spool.encoder.__class__.__name__, 'JsonEncoder')
+    client.incr('foo')
+    eq_(_types(metrics.stream), ['counter'])
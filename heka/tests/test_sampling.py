@@ -0,0 +1,219 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.client import SEVERITY
+from heka.encoders import ProtobufEncoder
+from heka.message import Header, Message
+from heka.message import first_value
+from heka.sampling import AdaptiveSampler
+from heka.sampling import RequestBufferMiddleware
+from heka.sampling import tail_policy_provider
+from heka.streams import DebugCaptureStream
+from mock import patch
+from nose.tools import eq_, ok_, raises
+import random
+
+
+def _split_frames(data):
+    msgs = []
+    pos = 0
+    while pos < len(data):
+        header_len = ord(data[pos + 1])
+        header = Header()
+        header.ParseFromString(data[pos + 2:pos + 2 + header_len])
+        start = pos + header_len + 3
+        msg = Message()
+        msg.ParseFromString(data[start:start + header.message_length])
+        msgs.append(msg)
+        pos = start + header.message_length
+    return msgs
+
+
+class TestRequestBuffer(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+        self.policy = tail_policy_provider(severity=SEVERITY.ERROR,
+                                           slow=None, rate=0)
+
+    def tearDown(self):
+        del self.stream
+        del self.client
+
+    def test_drop_without_encoding(self):
+        with patch.object(ProtobufEncoder, 'encode') as mock_encode:
+            with self.client.request_buffer(self.policy):
+                self.client.incr('foo')
+                self.client.info('all is well')
+        ok_(not mock_encode.called)
+        eq_(len(self.stream.msgs), 0)
+
+    def test_keep_on_severity(self):
+        with self.client.request_buffer(self.policy) as buf:
+            self.client.incr('foo')
+            self.client.error('oops')
+            eq_(len(self.stream.msgs), 0)
+        eq_(buf.severity, SEVERITY.ERROR)
+        # both messages went out in a single write
+        eq_(len(self.stream.msgs), 1)
+        msgs = _split_frames(self.stream.msgs[0])
+        eq_([m.type for m in msgs], ['counter', 'oldstyle'])
+        eq_(msgs[1].payload, 'oops')
+
+    def test_keep_on_flag(self):
+        with self.client.request_buffer(self.policy) as buf:
+            self.client.incr('foo')
+            buf.flag()
+        eq_(len(self.stream.msgs), 1)
+
+    def test_keep_slow(self):
+        policy = tail_policy_provider(slow=0, rate=0)
+        with self.client.request_buffer(policy):
+            self.client.incr('foo')
+        eq_(len(self.stream.msgs), 1)
+
+    @raises(NameError)
+    def test_keep_on_exception(self):
+        try:
+            with self.client.request_buffer(self.policy):
+                self.client.incr('foo')
+                a = b  # NOQA
+        finally:
+            eq_(len(self.stream.msgs), 1)
+
+    def test_fields_copied(self):
+        fields = {'tags': {'a': 1}}
+        with self.client.request_buffer(self.policy) as buf:
+            self.client.incr('a', fields=fields)
+            fields['tags']['a'] = 2
+            self.client.incr('b', fields=fields)
+            buf.flag()
+        msgs = _split_frames(self.stream.msgs[0])
+        eq_([first_value(m, 'name') for m in msgs], ['a', 'b'])
+        eq_([first_value(m, 'tags.a') for m in msgs], [1, 2])
+
+    def test_max_events(self):
+        with self.client.request_buffer(self.policy, max_events=2):
+            for i in range(4):
+                self.client.incr('foo%d' % i)
+            self.client.error('oops')
+        msgs = _split_frames(self.stream.msgs[0])
+        eq_([first_value(m, 'name') for m in msgs], ['foo0', 'foo1'])
+        eq_(self.client.stats.dropped, 3)
+        eq_(self.client.stats.send_errors, {'BufferFull': 3})
+
+    def test_unbuffered_after_exit(self):
+        with self.client.request_buffer(self.policy):
+            pass
+        self.client.incr('foo')
+        eq_(len(self.stream.msgs), 1)
+
+
+class TestRequestBufferMiddleware(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+        self.policy = tail_policy_provider(slow=None, rate=0)
+
+    def _make_app(self, status):
+        client = self.client
+
+        def app(environ, start_response):
+            client.incr('hits')
+            start_response(status, [])
+            return ['body']
+        return RequestBufferMiddleware(app, self.client, self.policy)
+
+    def _call(self, app):
+        result = app({}, lambda status, headers: None)
+        body = list(result)
+        result.close()
+        return body
+
+    def test_ok_dropped(self):
+        eq_(self._call(self._make_app('200 OK')), ['body'])
+        eq_(len(self.stream.msgs), 0)
+
+    def test_server_error_kept(self):
+        eq_(self._call(self._make_app('500 Server Error')), ['body'])
+        eq_(len(self.stream.msgs), 1)
+
+
+class TestAdaptiveSampler(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.sampler = AdaptiveSampler(budget=10, halflife=1)
+        self.client = HekaClient(self.stream, self.logger,
+                                 sampler=self.sampler)
+
+    def tearDown(self):
+        del self.stream
+        del self.client
+
+    def test_under_budget(self):
+        with patch('heka.sampling.time') as mock_time:
+            for i in range(20):
+                mock_time.time.return_value = i
+                eq_(self.sampler.sample_rate('slow'), 1.0)
+
+    def test_over_budget(self):
+        with patch('heka.sampling.time') as mock_time:
+            # 1000 calls/sec
+            for i in range(5000):
+                mock_time.time.return_value = i / 1000.0
+                rate = self.sampler.sample_rate('fast')
+            ok_(900 < self.sampler.observed_rate('fast') < 1100)
+        ok_(0.008 < rate < 0.012)
+
+    def test_names_are_independent(self):
+        with patch('heka.sampling.time') as mock_time:
+            for i in range(5000):
+                mock_time.time.return_value = i / 1000.0
+                self.sampler.sample_rate('fast')
+            eq_(self.sampler.sample_rate('slow'), 1.0)
+
+    def test_max_names(self):
+        sampler = AdaptiveSampler(budget=10, halflife=1, max_names=3)
+        with patch('heka.sampling.time') as mock_time:
+            for i in range(5000):
+                mock_time.time.return_value = i / 1000.0
+                sampler.sample_rate('fast')
+            for name in ('a', 'b', 'c'):
+                sampler.sample_rate(name)
+            # the names within budget made way, the busy one is kept
+            eq_(sorted(sampler._names), ['c', 'fast'])
+            ok_(sampler.sample_rate('fast') < 0.02)
+        for i in range(10):
+            sampler.sample_rate('name%d' % i)
+        ok_(len(sampler._names) <= 3)
+
+    def test_rate_recorded(self):
+        with patch('heka.sampling.time') as mock_time:
+            # seeded, so the sampled count doesn't vary between runs
+            with patch('heka.client.random', random.Random(42)):
+                # 1000 calls/sec for 5 seconds
+                for i in range(5000):
+                    mock_time.time.return_value = i / 1000.0
+                    self.client.incr('fast')
+        # roughly 10 msgs/sec once the estimate has warmed up
+        sent = len(self.stream.msgs)
+        ok_(20 < sent < 200, sent)
+        [msg] = _split_frames(self.stream.msgs[-1])
+        ok_(first_value(msg, 'rate') < 0.02)
@@ -0,0 +1,267 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient, SEVERITY
+from heka.encoders import ProtobufEncoder
+from heka.config import client_from_text_config
+from heka.decoders import decode_frames
+from heka.message import first_value
+from heka.sender import BackgroundSender, Event, ProcessSender
+from heka.sender import severity_level
+from heka.streams import DebugCaptureStream, FileStream
+from mock import patch
+from nose.tools import eq_, ok_
+import StringIO
+import array
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+class TestBackgroundSender(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.sender = BackgroundSender()
+        self.client = HekaClient(self.stream, self.logger,
+                                 sender=self.sender)
+
+    def tearDown(self):
+        self.sender.close()
+
+    def _sent(self):
+        return [msg for data in self.stream.msgs
+                for header, msg in decode_frames(data)]
+
+    def test_delivered(self):
+        self.client.heka('test', payload='one', fields={'a': 1})
+        self.client.incr('foo')
+        self.sender.flush()
+        msgs = self._sent()
+        eq_([msg.type for msg in msgs], ['test', 'counter'])
+        eq_(first_value(msgs[0], 'a'), 1)
+        eq_(self.client.stats.sent, 2)
+
+    def test_encoded_off_thread(self):
+        threads = []
+        self.client.filters = [lambda msg: threads.append(
+            threading.current_thread()) or True]
+        self.client.heka('test')
+        self.sender.flush()
+        eq_(len(threads), 1)
+        ok_(threads[0] is not threading.current_thread())
+
+    def test_timestamp_taken_on_emit(self):
+        self.client.heka('test')
+        self.client.heka('test', timestamp=1234)
+        self.sender.flush()
+        first, second = self._sent()
+        ok_(first.timestamp > 0)
+        eq_(second.timestamp, 1234 * 1000000000)
+
+    def test_fields_copied(self):
+        fields = {'tags': {'a': 1}}
+        self.client.incr('a', fields=fields)
+        fields['tags']['a'] = 2
+        self.client.incr('b', fields=fields)
+        self.client.heka_many([('test', None, None, '', fields)])
+        self.sender.flush()
+        msgs = self._sent()
+        eq_([first_value(msg, 'name') for msg in msgs], ['a', 'b', 'b'])
+        eq_([first_value(msg, 'tags.a') for msg in msgs], [1, 2, 2])
+        with patch.object(self.sender, 'put') as mock_put:
+            self.client.heka('test', fields=fields)
+        ok_(mock_put.call_args[0][0].fields is not fields)
+
+    def test_mutable_values_copied(self):
+        data = bytearray('abc')
+        numbers = array.array('d', [1.0, 2.0])
+        fields = {'data': data, 'view': memoryview(data),
+                  'numbers': numbers, 'list': [bytearray('x')]}
+        with patch.object(self.sender, 'put') as mock_put:
+            self.client.heka('test', fields=fields)
+        data[0] = ord('z')
+        numbers[0] = 3.0
+        fields['list'][0][0] = ord('y')
+        self.sender.put(mock_put.call_args[0][0])
+        self.sender.flush()
+        msg = self._sent()[0]
+        eq_(first_value(msg, 'data'), 'abc')
+        eq_(first_value(msg, 'view'), 'abc')
+        numbers = [f for f in msg.fields if f.name == 'numbers'][0]
+        eq_(list(numbers.value_double), [1.0, 2.0])
+        eq_(first_value(msg, 'list'), 'x')
+
+    def test_bulk(self):
+        self.client.incr_many(['a', 'b', 'c'])
+        self.sender.flush()
+        eq_(len(self._sent()), 3)
+
+    def test_queue_full(self):
+        self.sender.close()
+        sender = BackgroundSender(max_queue_size=1)
+        # not started, so nothing is taken off the queue
+        sender.client = self.client
+        sender.put(Event('a', '', 6, '', {}, 1))
+        sender.put(Event('b', '', 6, '', {}, 1))
+        eq_(self.client.stats.dropped, 1)
+        eq_(self.client.stats.send_errors, {'QueueFull': 1})
+
+    def test_priority_not_dropped(self):
+        self.sender.close()
+        sender = BackgroundSender(max_queue_size=1)
+        sender.client = self.client
+        sender.put(Event('a', '', 6, '', {}, 1))
+        sender.put(Event('b', '', 6, '', {}, 1))
+        sender.put(Event('c', '', SEVERITY.ALERT, '', {}, 1))
+        eq_(self.client.stats.dropped, 1)
+        eq_(sender._queue.qsize(), 2)
+
+    def test_priority_first(self):
+        self.sender.close()
+        sender = BackgroundSender(priority_severity='critical')
+        # in the client's pipeline, but not attached and started yet
+        sender.client = self.client
+        self.client._pipeline = self.client._pipeline.replace(sender=sender)
+        for i in range(3):
+            self.client.incr('foo')
+        self.client.heka('error', severity=SEVERITY.ERROR)
+        self.client.heka('alert', severity=SEVERITY.ALERT)
+        # only started now, with the whole backlog queued
+        sender.attach(self.client)
+        sender.close()
+        eq_([msg.type for msg in self._sent()],
+            ['alert', 'counter', 'counter', 'counter', 'error'])
+
+    def test_no_priority_lane(self):
+        self.sender.close()
+        sender = BackgroundSender(max_queue_size=1, priority_severity=None)
+        sender.client = self.client
+        sender.put(Event('a', '', 6, '', {}, 1))
+        sender.put(Event('b', '', SEVERITY.EMERGENCY, '', {}, 1))
+        eq_(self.client.stats.dropped, 1)
+
+    def test_invalid_event(self):
+        old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.client.heka('test', fields={'bad': object()})
+            self.client.heka('test')
+            self.sender.flush()
+        finally:
+            sys.stderr = old_stderr
+        # the error is reported, the sender carries on
+        eq_(len(self._sent()), 1)
+
+    def test_close_drains(self):
+        for i in range(10):
+            self.client.heka('test')
+        self.sender.close()
+        eq_(len(self._sent()), 10)
+
+
+def test_severity_level():
+    eq_(severity_level('alert'), SEVERITY.ALERT)
+    eq_(severity_level('3'), SEVERITY.ERROR)
+    eq_(severity_level(2), SEVERITY.CRITICAL)
+    eq_(severity_level(''), None)
+
+
+def test_event_slots():
+    event = Event('test', 'tests', 6, '', {}, 1)
+    ok_(not hasattr(event, '__dict__'))
+    eq_(event.args(), ('test', 'tests', 6, '', {}, 1))
+
+
+def test_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+    sender_max_queue_size = 50
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    ok_(isinstance(client.sender, BackgroundSender))
+    eq_(client.sender.max_queue_size, 50)
+    client.sender.close()
+
+
+class TestProcessSender(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'out')
+        self.sender = ProcessSender()
+        self.client = HekaClient(FileStream(self.path), self.logger,
+                                 encoder=ProtobufEncoder,
+                                 hmc={'signer': 'tests', 'key_version': 1,
+                                      'hash_function': 'SHA1',
+                                      'key': 'secret'},
+                                 sender=self.sender)
+
+    def tearDown(self):
+        self.sender.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_delivered_by_worker(self):
+        pids = []
+        self.client.filters = [lambda msg: pids.append(os.getpid()) or True]
+        self.client.heka('test', payload='one', fields={'a': [1, 2]})
+        self.client.incr('foo')
+        self.sender.flush()
+        # the filter ran in the worker, not here
+        eq_(pids, [])
+        self.sender.close()
+        with open(self.path) as output:
+            msgs = decode_frames(output.read())
+        eq_([msg.type for header, msg in msgs], ['test', 'counter'])
+        eq_([header.hmac_signer for header, msg in msgs], ['tests'] * 2)
+        eq_(msgs[0][1].pid, os.getpid())
+
+    def test_one_worker(self):
+        starts = []
+        start = self.sender._start
+
+        def slow_start():
+            starts.append(1)
+            time.sleep(0.05)
+            start()
+        self.sender._start = slow_start
+        threads = [threading.Thread(target=self.client.incr, args=('foo',))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(starts), 1)
+        self.sender.close()
+        with open(self.path) as output:
+            eq_(len(decode_frames(output.read())), 4)
+
+    def test_queue_size_unknown(self):
+        # as on Mac OS X
+        from multiprocessing.queues import Queue as ProcessQueue
+        with patch.object(ProcessQueue, 'qsize',
+                          side_effect=NotImplementedError):
+            for i in range(3):
+                for name in range(self.sender.max_batch_size):
+                    self.client.incr(str(name))
+                self.sender.flush()
+            self.sender.close()
+        with open(self.path) as output:
+            eq_(len(decode_frames(output.read())),
+                3 * self.sender.max_batch_size)
@@ -0,0 +1,169 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.client import SEVERITY
+from heka.config import client_from_text_config
+from heka.filters import severity_max_provider
+from heka.message import first_value
+from heka.stats import ClientStats, ErrorReporter, StatsReporter
+from heka.streams import DebugCaptureStream
+from heka.tests.helpers import decode_message
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+import StringIO
+import sys
+import time
+
+
+class TestClientStats(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.client = HekaClient(self.stream, self.logger)
+        self.old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.old_stderr
+
+    def test_sent(self):
+        self.client.incr('foo')
+        self.client.incr('bar')
+        stats = self.client.stats.snapshot()
+        eq_(stats['emitted'], 2)
+        eq_(stats['encoded'], 2)
+        eq_(stats['sent'], 2)
+        eq_(stats['dropped'], 0)
+        eq_(stats['bytes'], sum(len(data) for data in self.stream.msgs))
+        ok_(stats['encode_time'] > 0)
+
+    def test_filtered(self):
+        self.client.filters = [severity_max_provider(SEVERITY.ERROR)]
+        self.client.info('foo')
+        self.client.error('foo')
+        stats = self.client.stats.snapshot()
+        eq_(stats['emitted'], 2)
+        eq_(stats['filtered'], {'severity_max': 1})
+        eq_(stats['sent'], 1)
+
+    def test_send_errors(self):
+        self.client.stream = Mock()
+        self.client.stream.write.side_effect = IOError('boom')
+        self.client.incr('foo')
+        self.client.incr('foo')
+        stats = self.client.stats.snapshot()
+        eq_(stats['encoded'], 2)
+        eq_(stats['sent'], 0)
+        eq_(stats['dropped'], 2)
+        eq_(stats['send_errors'], {'IOError': 2})
+
+    def test_batch(self):
+        with self.client.request_buffer(lambda buf: True):
+            self.client.incr('foo')
+            self.client.incr('bar')
+        stats = self.client.stats.snapshot()
+        eq_(stats['sent'], 2)
+        eq_(stats['bytes'], len(self.stream.msgs[0]))
+
+    def test_queue_depth(self):
+        stats = self.client.stats
+        stats.set_queue_depth(5)
+        stats.set_queue_depth(2)
+        eq_(stats.queue_depth, 2)
+        eq_(stats.queue_high_water, 5)
+
+    def test_report(self):
+        self.client.incr('foo')
+        StatsReporter(self.client).report()
+        h, msg = decode_message(self.stream.msgs[-1])
+        eq_(msg.type, 'heka_stats')
+        eq_(first_value(msg, 'sent'), 1)
+
+    def test_reporter_thread(self):
+        reporter = self.client.start_stats_reporter(0.01)
+        time.sleep(0.1)
+        reporter.stop()
+        ok_(len(self.stream.msgs) > 1)
+
+
+class TestErrorReporter(object):
+    def setUp(self):
+        self.stats = ClientStats()
+        self.reporter = ErrorReporter(self.stats, interval=10)
+        self.old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.old_stderr
+        if self.reporter._timer is not None:
+            self.reporter._timer.cancel()
+
+    def test_suppressed(self):
+        with patch('heka.stats.time') as mock_time:
+            mock_time.time.return_value = 100
+            for i in range(1000):
+                self.reporter.report(IOError('boom'))
+            self.reporter.report(ValueError('bad'), 10)
+            eq_(len(sys.stderr.getvalue().splitlines()), 1)
+            ok_('IOError' in sys.stderr.getvalue())
+
+            mock_time.time.return_value = 111
+            self.reporter.report(IOError('boom'))
+        lines = sys.stderr.getvalue().splitlines()
+        eq_(len(lines), 2)
+        ok_('1010 dropped in the last 11s' in lines[1], lines[1])
+        ok_('IOError: 1000, ValueError: 10' in lines[1], lines[1])
+        eq_(self.stats.dropped, 1011)
+        eq_(self.stats.send_errors, {'IOError': 1001, 'ValueError': 1})
+
+    def test_summary_when_failures_stop(self):
+        reporter = self.reporter = ErrorReporter(self.stats, interval=0.05)
+        reporter.report(IOError('boom'))
+        reporter.report(IOError('boom'))
+        reporter.report(IOError('boom'))
+        eq_(len(sys.stderr.getvalue().splitlines()), 1)
+        time.sleep(0.2)
+        lines = sys.stderr.getvalue().splitlines()
+        eq_(len(lines), 2)
+        ok_('2 dropped' in lines[1], lines[1])
+
+    def test_client_does_not_format_message(self):
+        client = HekaClient(Mock(), 'tests')
+        client.stream.write.side_effect = IOError('boom')
+        with patch.object(client, 'error_reporter') as mock_reporter:
+            client.incr('foo')
+        eq_(mock_reporter.report.call_count, 1)
+
+
+def test_error_interval_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+    error_interval = 60
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    eq_(client.error_reporter.interval, 60)
+
+
+def test_stats_interval_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+    stats_interval = 60
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    ok_(client._stats_reporter is not None)
+    eq_(client._stats_reporter.interval, 60)
+    client._stats_reporter.stop()
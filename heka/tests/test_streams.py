@@ -12,10 +12,15 @@
 #   Victor Ng (vng@mozilla.com)
 #
 # ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.decoders import decode_frames
+from heka.encoders import ProtobufEncoder
+from heka.message import BATCH_SEPARATOR, MAX_BATCH_SIZE
+from heka.streams import DebugCaptureStream, ZlibBatchStream
 from heka.streams.udp import UdpStream
 from heka.streams.tcp import TcpStream
 from mock import patch, Mock
-from nose.tools import eq_
+from nose.tools import eq_, ok_, raises
 
 import json
 
@@ -67,3 +72,81 @@ class TestUdpStream(object):
         eq_(write_args[0][0][1], (hosts[0], port))
         eq_(write_args[1][0][0], self.msg)
         eq_(write_args[1][0][1], (hosts[1], port))
+
+
+class TestZlibBatchStream(object):
+    def setUp(self):
+        self.inner = DebugCaptureStream()
+        self.stream = ZlibBatchStream(self.inner, max_batch_size=1000,
+                                      max_latency=0)
+        self.client = HekaClient(self.stream, 'tests')
+
+    def tearDown(self):
+        self.stream.close()
+
+    def test_batch_on_drain(self):
+        for i in range(3):
+            self.client.incr('foo')
+        eq_(len(self.inner.msgs), 0)
+        self.stream.drain()
+        eq_(len(self.inner.msgs), 1)
+        msgs = [msg for header, msg in decode_frames(self.inner.msgs[0])]
+        eq_([msg.type for msg in msgs], ['counter'] * 3)
+
+    def test_batch_size(self):
+        for i in range(30):
+            self.client.incr('foo')
+        ok_(len(self.inner.msgs) > 1)
+        self.stream.drain()
+        total = 0
+        for batch in self.inner.msgs:
+            eq_(ord(batch[0]), BATCH_SEPARATOR)
+            frames = decode_frames(batch)
+            total += len(frames)
+            ok_(len(''.join(ProtobufEncoder().encode(msg)
+                            for header, msg in frames)) <= 1000)
+        eq_(total, 30)
+
+    def test_largest_batches_decoded(self):
+        stream = ZlibBatchStream(self.inner, max_batch_size=MAX_BATCH_SIZE,
+                                 max_latency=0)
+        client = HekaClient(stream, 'tests')
+        for i in range(15000):
+            client.incr('foo')
+        stream.drain()
+        ok_(len(self.inner.msgs) > 1)
+        eq_(sum(len(decode_frames(batch)) for batch in self.inner.msgs),
+            15000)
+
+    @raises(ValueError)
+    def test_batch_size_limited(self):
+        ZlibBatchStream(self.inner, max_batch_size=MAX_BATCH_SIZE + 1,
+                        max_latency=0)
+
+    def test_latency(self):
+        self.stream.max_latency = 5
+        with patch('heka.streams.compress.time') as mock_time:
+            mock_time.time.return_value = 100
+            self.client.incr('foo')
+            mock_time.time.return_value = 104
+            self.client.incr('foo')
+            eq_(len(self.inner.msgs), 0)
+            mock_time.time.return_value = 105
+            self.client.incr('foo')
+        eq_(len(self.inner.msgs), 1)
+        eq_(len(decode_frames(self.inner.msgs[0])), 3)
+
+    def test_stats(self):
+        for i in range(5):
+            self.client.incr('foo')
+        self.stream.drain()
+        stats = self.client.stats.snapshot()
+        eq_(stats['batches'], 1)
+        eq_(stats['batch_bytes'], stats['bytes'])
+        eq_(stats['compressed_bytes'], len(self.inner.msgs[0]) - 5)
+        ok_(stats['compression_ratio'] > 2, stats['compression_ratio'])
+
+    def test_inner_from_name(self):
+        stream = ZlibBatchStream('heka.streams.UdpStream', max_latency=0,
+                                 host='127.0.0.1', port=5565)
+        ok_(isinstance(stream.inner, UdpStream))
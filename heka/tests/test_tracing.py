@@ -0,0 +1,158 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from heka.client import HekaClient
+from heka.config import client_from_text_config
+from heka.filters import severity_max_provider
+from heka.limits import truncate_policy_provider
+from heka.streams import DebugCaptureStream
+from heka.tests.helpers import decode_message
+from heka.tracing import Histogram, Tracer
+from heka.tracing import PHASES
+from mock import Mock
+from nose.tools import eq_, ok_
+import StringIO
+import os
+import signal
+import sys
+
+
+HMAC_CONFIG = {'signer': 'tests', 'key_version': 1, 'hash_function': 'SHA1',
+               'key': 'secret'}
+
+
+class TestTracer(object):
+    logger = 'tests'
+
+    def setUp(self):
+        self.stream = DebugCaptureStream()
+        self.tracer = Tracer(rate=1.0)
+        self.client = HekaClient(self.stream, self.logger,
+                                 tracer=self.tracer)
+
+    def tearDown(self):
+        del self.stream
+        del self.client
+
+    def test_message_phases(self):
+        # a filter keeps the client from encoding the arguments directly
+        self.client.encoder.rotate_key(HMAC_CONFIG)
+        self.client.filters = [severity_max_provider(severity=7)]
+        self.client.incr('foo')
+        self.client.incr('foo')
+        snapshot = self.tracer.snapshot()
+        eq_(sorted(snapshot),
+            sorted(phase for phase in PHASES if phase != 'encode_args'))
+        for phase, stats in snapshot.items():
+            eq_(stats['count'], 2, phase)
+        # tracing doesn't change what is sent
+        eq_(decode_message(self.stream.msgs[0])[1].type, 'counter')
+
+    def test_default_phases(self):
+        self.client.incr('foo')
+        snapshot = self.tracer.snapshot()
+        eq_(sorted(snapshot), ['encode_args', 'flush', 'frame', 'normalize',
+                               'total', 'write'])
+        eq_(decode_message(self.stream.msgs[0])[1].type, 'counter')
+
+    def test_hmac_phase(self):
+        self.client.encoder.rotate_key(HMAC_CONFIG)
+        self.client.incr('foo')
+        self.client.define('test', [('a', int)])(1)
+        snapshot = self.tracer.snapshot()
+        eq_(sorted(snapshot), ['encode_args', 'flush', 'frame', 'hmac',
+                               'normalize', 'total', 'write'])
+        eq_(snapshot['hmac']['count'], 2)
+        header, msg = decode_message(self.stream.msgs[0])
+        eq_(header.hmac_signer, 'tests')
+
+    def test_unsampled(self):
+        self.tracer.rate = 0
+        self.client.incr('foo')
+        eq_(self.tracer.snapshot(), {})
+        eq_(len(self.stream.msgs), 1)
+
+    def test_filtered(self):
+        self.client.filters = [severity_max_provider(severity=0)]
+        self.client.incr('foo')
+        snapshot = self.tracer.snapshot()
+        eq_(sorted(snapshot),
+            ['filters', 'flatten', 'normalize', 'total', 'uuid'])
+
+    def test_buffered(self):
+        with self.client.request_buffer(lambda buf: False):
+            self.client.incr('foo')
+        eq_(self.tracer.snapshot()['total']['count'], 1)
+
+    def test_size_policy(self):
+        self.client.size_policy = truncate_policy_provider()
+        self.client.max_payload_size = 10
+        self.client.heka('test', payload='x' * 20)
+        eq_(self.tracer.snapshot()['total']['count'], 1)
+
+    def test_write_error(self):
+        old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.client.stream = Mock()
+            self.client.stream.write.side_effect = IOError('boom')
+            self.client.incr('foo')
+        finally:
+            sys.stderr = old_stderr
+        eq_(self.tracer.snapshot()['total']['count'], 1)
+
+    def test_dump(self):
+        self.client.filters = [severity_max_provider(severity=7)]
+        self.client.incr('foo')
+        out = StringIO.StringIO()
+        self.tracer.dump(out)
+        lines = out.getvalue().splitlines()
+        eq_(len(lines), len(self.tracer.snapshot()) + 1)
+        ok_(lines[1].startswith('normalize'))
+        ok_(lines[-1].startswith('total'))
+
+    def test_signal(self):
+        old_handler = signal.getsignal(signal.SIGUSR2)
+        old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.tracer.install_signal_handler('SIGUSR2')
+            self.client.incr('foo')
+            os.kill(os.getpid(), signal.SIGUSR2)
+            ok_('total' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = old_stderr
+            signal.signal(signal.SIGUSR2, old_handler)
+
+
+def test_histogram():
+    hist = Histogram()
+    for i in range(99):
+        hist.add(3e-6)
+    hist.add(1e-3)
+    eq_(hist.count, 100)
+    eq_(hist.percentile(50), 4e-6)
+    eq_(hist.percentile(99), 4e-6)
+    eq_(hist.percentile(100), 1e-3)
+    eq_(hist.max, 1e-3)
+
+
+def test_tracer_config():
+    cfg_txt = """
+    [heka]
+    stream_class = heka.streams.DebugCaptureStream
+    tracer_rate = 0.5
+    """
+    client = client_from_text_config(cfg_txt, 'heka')
+    ok_(isinstance(client.tracer, Tracer))
+    eq_(client.tracer.rate, 0.5)
@@ -0,0 +1,189 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Per-phase latency tracing of the HekaClient emit path.
+
+A `Tracer` attached to a client (`client.tracer`) picks a random sample
+of `heka` calls and times each phase of their delivery:
+
+normalize
+  Filling in the default logger, severity, fields and timestamp.
+flatten
+  Building the Message and flattening the fields into it.
+uuid
+  Computing the message uuid.
+filters
+  Running the client's filter chain.
+encode
+  Serializing the Message.
+encode_args
+  Serializing the `heka` arguments straight into a message, fields and
+  uuid included. This replaces the four phases above when the client
+  has no filters and its encoder supports it (`ProtobufEncoder` and
+  `JsonEncoder` do), which is the default.
+hmac
+  Signing the message, if the encoder has an HMAC key.
+frame
+  Building the header and framing the message. Encoders which don't
+  frame their output have this phase, and `hmac`, included in
+  `encode`.
+write
+  `stream.write`
+flush
+  `stream.flush`
+total
+  The whole call.
+
+Each phase has a `Histogram` with power of two microsecond buckets. The
+histograms are updated without locking, like `heka.stats.ClientStats`.
+
+"""
+from __future__ import absolute_import
+import bisect
+import random
+import signal
+import sys
+import timeit
+
+PHASES = ('normalize', 'flatten', 'uuid', 'filters', 'encode',
+          'encode_args', 'hmac', 'frame', 'write', 'flush', 'total')
+
+# bucket upper bounds in seconds, 1us to ~16s
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))
+
+_timer = timeit.default_timer
+
+
+class Histogram(object):
+    """Bucketed distribution of durations, in seconds."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def percentile(self, pct):
+        """Return the upper bound of the bucket holding the `pct`
+        percentile, i.e. an estimate that errs on the slow side.
+
+        """
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                break
+        if idx >= len(BUCKETS):
+            return self.max
+        return min(BUCKETS[idx], self.max)
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                }
+
+
+class Span(object):
+    """Timing of a single traced `heka` call."""
+    __slots__ = ('tracer', 'start', 'last')
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.start = self.last = _timer()
+
+    def mark(self, phase):
+        """Record the time since the previous mark as `phase`."""
+        now = _timer()
+        self.tracer.record(phase, now - self.last)
+        self.last = now
+
+    def finish(self):
+        self.tracer.record('total', _timer() - self.start)
+
+
+class Tracer(object):
+    """Samples `heka` calls and collects per-phase latency histograms."""
+    def __init__(self, rate=0.01, signum=None):
+        """Create a Tracer
+
+        :param rate: Fraction of calls to trace, between 0 and 1.
+        :param signum: Optional signal number, or name such as
+                       'SIGUSR2', on which the histograms are dumped to
+                       stderr.
+
+        """
+        self.rate = float(rate)
+        self.reset()
+        if signum is not None:
+            self.install_signal_handler(signum)
+
+    def reset(self):
+        self.histograms = {}
+
+    def start(self):
+        """Return a `Span` if this call should be traced, else None."""
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return None
+        return Span(self)
+
+    def record(self, phase, elapsed):
+        hist = self.histograms.get(phase)
+        if hist is None:
+            hist = self.histograms[phase] = Histogram()
+        hist.add(elapsed)
+
+    def snapshot(self):
+        """Return a `{phase: stats_dict}` dictionary."""
+        return dict((phase, hist.as_dict())
+                    for phase, hist in self.histograms.items())
+
+    def format_report(self):
+        lines = ['%-10s %8s %10s %10s %10s %10s %10s' %
+                 ('phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        snapshot = self.snapshot()
+        phases = [p for p in PHASES if p in snapshot]
+        phases += sorted(p for p in snapshot if p not in PHASES)
+        for phase in phases:
+            stats = snapshot[phase]
+            lines.append('%-10s %8d' % (phase, stats['count']) +
+                         ''.join(' %8.1fus' % (stats[key] * 1e6) for key in
+                                 ('mean', 'p50', 'p90', 'p99', 'max')))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, out=None):
+        """Write the histograms as a table to `out` (default stderr)."""
+        if out is None:
+            out = sys.stderr
+        out.write(self.format_report())
+
+    def install_signal_handler(self, signum=signal.SIGUSR2):
+        """Dump the histograms to stderr whenever `signum` arrives. Must
+        be called from the main thread.
+
+        """
+        if isinstance(signum, basestring):
+            signum = getattr(signal, signum.upper())
+        signal.signal(signum, lambda signum, frame: self.dump())
@@ -12,7 +12,9 @@
 #
 # ***** END LICENSE BLOCK *****
 """Common utilities"""
+from hashlib import sha1
 import sys
+import uuid
 
 if 'gevent.monkey' in sys.modules:
     GEVENT_MONKEY = True
@@ -28,3 +30,16 @@ try:
     import simplejson as json
 except:
     import json  # NOQA
+
+_OID_NAMESPACE = uuid.NAMESPACE_OID.bytes
+
+
+def uuid5_bytes(name):
+    """Return `uuid.uuid5(uuid.NAMESPACE_OID, name).bytes`, without
+    creating the UUID object.
+
+    """
+    digest = sha1(_OID_NAMESPACE + name).digest()
+    return ''.join((digest[:6], chr((ord(digest[6]) & 0x0f) | 0x50),
+                    digest[7], chr((ord(digest[8]) & 0x3f) | 0x80),
+                    digest[9:16]))
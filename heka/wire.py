@@ -0,0 +1,61 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Victor Ng (vng@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""Low level protocol buffer wire format helpers.
+
+The pure Python protobuf implementation is slow for the handful of
+small, fixed layout messages heka sends. These helpers build the wire
+format directly for the parts that are hot enough to matter. Anything
+they produce must parse back with the generated `heka.message` classes.
+
+"""
+from __future__ import absolute_import
+
+WIRETYPE_VARINT = 0
+WIRETYPE_LENGTH_DELIMITED = 2
+
+# single byte varints are by far the most common, don't recompute them
+_SMALL_VARINTS = [chr(i) for i in range(0x80)]
+
+
+def varint(value):
+    """Return the varint encoding of the non-negative integer `value`."""
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    chunks = []
+    while value > 0x7f:
+        chunks.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    chunks.append(chr(value))
+    return ''.join(chunks)
+
+
+def tag(field_number, wire_type):
+    """Return the encoded key of a field."""
+    return varint((field_number << 3) | wire_type)
+
+
+def signed_varint(value):
+    """Return the varint encoding of an int32 or int64 `value`, negative
+    values taking 10 bytes as two's complement.
+
+    """
+    if value < 0:
+        value += 1 << 64
+    return varint(value)
+
+
+def length_delimited(field_number, data):
+    """Return a length delimited field holding the bytes `data`."""
+    return ''.join((tag(field_number, WIRETYPE_LENGTH_DELIMITED),
+                    varint(len(data)), data))
@@ -49,6 +49,8 @@ setup(name='heka-py',
       entry_points={
           'console_scripts': [
               'mb = heka.command:mb',
+              'hekabench = heka.command:bench',
+              'hekarecv = heka.command:hekarecv',
               ],
           },
       )